@@ -0,0 +1,64 @@
+# Copyright (c) 2018 Kevin Murray <kdmfoss@gmail.com>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark the serial and parallel TimeStream walkers on a synthetic deep tree.
+
+    python benchmarks/walk.py [--root /mnt/nfs/scratch] [--days 60] [--per-hour 4]
+
+Point --root at a network filesystem to see the effect of concurrent directory listing.
+"""
+
+import argparse
+import datetime as dt
+import os
+import os.path as op
+import shutil
+import tempfile
+import time
+
+from pyts2 import TimeStream
+from pyts2.utils import serial_walk, parallel_walk
+
+
+def make_tree(root, days, per_hour):
+    start = dt.datetime(2001, 1, 1)
+    for day in range(days):
+        for hour in range(24):
+            for i in range(per_hour):
+                instant = start + dt.timedelta(days=day, hours=hour, minutes=i)
+                path = instant.strftime("%Y/%Y_%m/%Y_%m_%d/%Y_%m_%d_%H/bench_%Y_%m_%d_%H_%M_%S_00.jpg")
+                path = op.join(root, path)
+                os.makedirs(op.dirname(path), exist_ok=True)
+                with open(path, "wb") as fh:
+                    fh.write(b"\xff\xd8\xff")
+
+
+def timeit(label, func):
+    start = time.perf_counter()
+    n = func()
+    print(f"{label:>24}: {time.perf_counter() - start:8.3f}s ({n} items)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", default=None, help="Directory in which to make the tree")
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--per-hour", type=int, default=4)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(dir=args.root)
+    try:
+        make_tree(tmp, args.days, args.per_hour)
+        for walker, func in [("serial", serial_walk), ("parallel", parallel_walk)]:
+            timeit(f"{walker}_walk", lambda: sum(len(f) for _, _, f in func(tmp)))
+        for walker in ["serial", "parallel"]:
+            timeit(f"TimeStream({walker})",
+                   lambda: sum(1 for _ in TimeStream(tmp, index="off", walker=walker)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
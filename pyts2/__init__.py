@@ -4,8 +4,9 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-from pyts2.time import TSInstant, TimeFilter
-from pyts2.timestream import TimeStream, TimestreamFile
+from pyts2.time import TSInstant, TimeFilter, DaylightFilter
+from pyts2.timestream import TimeStream, TimestreamFile, TimeStreamWriter
+from pyts2.index import TimeStreamIndex, InstantIndex
 from pyts2._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
@@ -14,5 +15,8 @@ __all__ = [
     'TimestreamFile',
     'TSInstant',
     'TimeStream',
+    'TimeStreamWriter',
+    'TimeStreamIndex',
+    'InstantIndex',
 ]
 
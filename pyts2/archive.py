@@ -0,0 +1,542 @@
+# Copyright (c) 2018 Kevin Murray <kdmfoss@gmail.com>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, RLock
+import io
+import itertools
+import json
+import mmap
+import os
+import os.path as op
+import shutil
+import stat
+import struct
+import tarfile
+import time
+import warnings
+import zipfile
+import zlib
+
+from pyts2.filelock import FileLock
+from pyts2.utils import CHUNK_SIZE, FileSlice, copy_range
+
+
+def sniff_archive(path):
+    """Classifies the file at path as a "zip" or "tar" archive, or None, from its first block.
+
+    This is one small read, where zipfile.is_zipfile and tarfile.is_tarfile each open the file,
+    and the latter may read far into it. A zip must start with a local file header (or, if
+    empty, its end of central directory), except for ".zip" files, which are also checked as
+    zipfile does to allow for e.g. self-extracting archives. A tar must start with a header
+    block with a valid checksum.
+    """
+    with open(path, "rb") as fh:
+        header = fh.read(tarfile.BLOCKSIZE)
+    if header[:4] in (zipfile.stringFileHeader, zipfile.stringEndArchive):
+        return "zip"
+    if len(header) == tarfile.BLOCKSIZE and any(header):
+        try:
+            checksum = int(header[148:156].strip(b" \x00") or b"0", 8)
+        except ValueError:
+            checksum = None
+        if checksum == sum(header[:148]) + 8 * ord(" ") + sum(header[156:]):
+            return "tar"
+    if str(path).lower().endswith(".zip") and zipfile.is_zipfile(path):
+        return "zip"
+    return None
+
+
+class TarReader(object):
+    """Random-access reader for the members of an (uncompressed) tar archive.
+
+    Tar has no central directory, so finding a member means scanning every header before it.
+    TarReader scans the headers once to build an index of each regular member's data offset and
+    size, and caches that index in a hidden sidecar next to the tar (`.<name>.tar.tarindex`),
+    so reading any member is a single seek and read, in this and later processes.
+    """
+    suffix = ".tarindex"
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.fh = open(self.path, "rb")
+        self.members = self._load_index()
+
+    @property
+    def sidecar(self):
+        dirname, basename = op.split(self.path)
+        return op.join(dirname, f".{basename}{self.suffix}")
+
+    def _load_index(self):
+        st = os.fstat(self.fh.fileno())
+        key = [st.st_mtime_ns, st.st_size]
+        try:
+            with open(self.sidecar) as fh:
+                saved = json.load(fh)
+            if saved["key"] == key:
+                return {name: (offset, size) for name, offset, size in saved["members"]}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        members = {}
+        with tarfile.TarFile(fileobj=self.fh) as tar:
+            for entry in tar:
+                if entry.isfile():
+                    members[entry.name] = (entry.offset_data, entry.size)
+        try:
+            tmp = f"{self.sidecar}.{os.getpid()}.tmp"
+            with open(tmp, "w") as fh:
+                json.dump({"key": key,
+                           "members": [(name, offset, size) for name, (offset, size)
+                                       in members.items()]}, fh)
+            os.replace(tmp, self.sidecar)
+        except OSError:
+            # e.g. a read-only archive directory, just keep the index in memory
+            pass
+        return members
+
+    def read(self, member):
+        offset, size = self.members[member]
+        self.fh.seek(offset)
+        return self.fh.read(size)
+
+    def header(self, member):
+        """The TarInfo of member, from its header (the block before its data)"""
+        offset, size = self.members[member]
+        self.fh.seek(offset - tarfile.BLOCKSIZE)
+        return tarfile.TarInfo.frombuf(self.fh.read(tarfile.BLOCKSIZE), tarfile.ENCODING,
+                                       "surrogateescape")
+
+    def close(self):
+        self.fh.close()
+
+
+class ZipMapping(object):
+    """Zero-copy reader for the uncompressed (ZIP_STORED) members of a zip archive.
+
+    The archive is memory-mapped once, and `view` returns a memoryview of a member's data
+    straight from the mapping, found from the member's local header. This avoids zipfile's
+    buffered reads and the copy of each member into bytes, leaving the data in the page cache.
+    Unlike zipfile, the member's CRC is not checked when read.
+    """
+    local_header = struct.Struct("<4s22xHH")  # signature, ..., filename length, extra length
+
+    def __init__(self, path):
+        self.path = str(path)
+        with zipfile.ZipFile(self.path) as zip:
+            self.members = {info.filename: info for info in zip.infolist()}
+        with open(self.path, "rb") as fh:
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def span(self, member):
+        """The (offset, size) of member's data, or None if it is compressed or encrypted"""
+        info = self.members[member]
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return None
+        offset = info.header_offset
+        signature, namelen, extralen = self.local_header.unpack_from(self.mmap, offset)
+        if signature != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local header for '{member}' in '{self.path}'")
+        return offset + self.local_header.size + namelen + extralen, info.file_size
+
+    def view(self, member):
+        """A memoryview of member's data, or None if it is compressed or encrypted"""
+        span = self.span(member)
+        if span is None:
+            return None
+        start, size = span
+        return memoryview(self.mmap)[start:start + size]
+
+    def close(self):
+        try:
+            self.mmap.close()
+        except BufferError:
+            # views of it are still in use, the mapping is unmapped once they are released
+            pass
+
+
+def recover_zip(path):
+    """Rebuilds a zip bundle left without a valid central directory, e.g. by a crash while
+    appending to it, from the local headers of its stored members.
+
+    Members are recovered from the start of the file up to the first incomplete or compressed
+    one, and written to a new zip which replaces path. A member whose header still has the
+    placeholder sizes and CRC written before its data (i.e. it was being streamed in) is
+    incomplete. The damaged file is kept, hidden, as `.<name>.damaged` next to path (or
+    `.<name>.damaged.<n>`), as anything after the first incomplete member is lost from path.
+    Returns the number of members recovered, or None (leaving path untouched) if path doesn't
+    start with a zip member.
+    """
+    header = struct.Struct(zipfile.structFileHeader)
+    size = os.path.getsize(path)
+    members = []
+    with open(path, "rb") as fh:
+        offset = 0
+        while offset + header.size <= size:
+            fh.seek(offset)
+            fields = header.unpack(fh.read(header.size))
+            signature, flags, method, mtime, mdate, crc, csize, usize, namelen, extralen = \
+                fields[0], fields[3], fields[4], fields[5], fields[6], fields[7], fields[8], \
+                fields[9], fields[10], fields[11]
+            if signature != zipfile.stringFileHeader or method != zipfile.ZIP_STORED \
+                    or flags & 0x9 or csize == 0xFFFFFFFF or csize != usize:
+                # not a member, or one that's encrypted, or whose size isn't in its header, or
+                # (as stored members' sizes are equal) whose header was never completed
+                break
+            start = offset + header.size + namelen + extralen
+            if start + csize > size:
+                break
+            name = fh.read(namelen).decode("utf-8" if flags & 0x800 else "cp437")
+            members.append((name, mtime, mdate, crc, start, csize))
+            offset = start + csize
+    if not members:
+        return None
+
+    tmp = f"{path}.{os.getpid()}.recover"
+    with open(path, "rb") as fh, \
+            zipfile.ZipFile(tmp, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as zip:
+        for name, mtime, mdate, crc, start, csize in members:
+            fh.seek(start)
+            data = fh.read(csize)
+            if zlib.crc32(data) != crc:
+                break
+            date_time = ((mdate >> 9) + 1980, (mdate >> 5) & 0xF, mdate & 0x1F,
+                         mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2)
+            zip.writestr(zipfile.ZipInfo(name, date_time=date_time), data)
+        nrecovered = len(zip.filelist)
+    dirname, basename = op.split(path)
+    damaged = op.join(dirname, f".{basename}.damaged")
+    for n in itertools.count(1):
+        if not op.lexists(damaged):
+            break
+        damaged = op.join(dirname, f".{basename}.damaged.{n}")
+    try:
+        os.link(path, damaged)
+    except OSError:
+        shutil.copyfile(path, damaged)
+    os.replace(tmp, path)
+    return nrecovered
+
+
+def stream_crc32(fileobj, chunk_size=CHUNK_SIZE):
+    """The CRC-32 of the rest of fileobj, read in chunks"""
+    crc = 0
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return crc
+        crc = zlib.crc32(chunk, crc)
+
+
+class ZipAppender(object):
+    """A zip bundle kept open for appending stored members, across many writes.
+
+    Opening a zip for appending re-reads its central directory, and closing it rewrites it, so
+    appending files one at a time to a large bundle is quadratic. A ZipAppender opens the
+    bundle once, and keeps its member names and CRCs in memory. It holds the bundle's FileLock
+    until it is closed, as while open the bundle has no valid central directory (it is
+    overwritten by new members, and only rewritten on close), so it must be closed promptly:
+    see TimeStream's `flush_interval`. Bundles left like this by a crash are repaired with
+    `recover_zip` when next opened for appending.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = FileLock(self.path)
+        self.lock.acquire()
+        try:
+            self.zip = self._open()
+        except BaseException:
+            self.lock.release()
+            raise
+        self.crcs = {info.filename: info.CRC for info in self.zip.infolist()}
+        self.opened = time.monotonic()
+
+    def _open(self):
+        if op.exists(self.path) and op.getsize(self.path) > 0:
+            # zipfile would silently start a new zip after the end of a damaged one
+            try:
+                zipfile.ZipFile(self.path).close()
+            except zipfile.BadZipFile:
+                recovered = recover_zip(self.path)
+                if recovered is None:
+                    raise
+                warnings.warn(f"Recovered {recovered} files from damaged bundle '{self.path}' "
+                              f"(the damaged file is kept alongside it)")
+        return zipfile.ZipFile(self.path, mode="a", compression=zipfile.ZIP_STORED,
+                               allowZip64=True)
+
+    def write(self, name, content):
+        """Adds member name, unless it already exists with the same content
+
+        Raises RuntimeError if name exists with different content (by CRC-32).
+        """
+        crc = self.crcs.get(name)
+        if crc is not None:
+            self._check_same(name, crc, zlib.crc32(content))
+            return
+        self.zip.writestr(name, content)
+        self.crcs[name] = self.zip.getinfo(name).CRC
+
+    def write_file(self, name, path, chunk_size=CHUNK_SIZE):
+        """Like write(), with the content of the file at path, streamed in chunks"""
+        with open(path, "rb") as fh:
+            self.write_stream(name, fh, chunk_size)
+
+    def write_stream(self, name, fileobj, chunk_size=CHUNK_SIZE):
+        """Like write(), with the content of the seekable binary file fileobj, streamed in
+        chunks
+
+        If reading fileobj fails, or gives other than its size (as found by seeking to its
+        end), the partly written member is removed, and the error raised.
+        """
+        crc = self.crcs.get(name)
+        if crc is not None:
+            self._check_same(name, crc, stream_crc32(fileobj, chunk_size))
+            return
+        # as ZipFile.writestr() does
+        info = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = 0o600 << 16
+        start = fileobj.tell()
+        info.file_size = fileobj.seek(0, io.SEEK_END) - start  # so zip64 is used if needed
+        fileobj.seek(start)
+        size = info.file_size
+        member = self.zip.open(info, "w")
+        try:
+            # closing member adds it to the zip, with the CRC of whatever was written
+            with member:
+                shutil.copyfileobj(fileobj, member, chunk_size)
+            if info.file_size != size:
+                raise EOFError(f"read {info.file_size} of {size} bytes for {name} in {self.path}")
+        except BaseException:
+            self._rollback(info)
+            raise
+        self.crcs[name] = info.CRC
+
+    def write_raw(self, name, path, offset, size, crc):
+        """Like write_file(), with the size bytes at offset in the file at path (e.g. the data
+        of a stored member of another zip), whose CRC-32 is already known
+
+        The data is copied by the kernel where possible (see `pyts2.utils.copy_range`), and is
+        neither read by python nor checksummed again.
+        """
+        existing = self.crcs.get(name)
+        if existing is not None:
+            self._check_same(name, existing, crc)
+            return
+        info = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = 0o600 << 16
+        info.file_size = info.compress_size = size
+        info.CRC = crc
+        zip = self.zip
+        # as ZipFile._open_to_write() and _ZipWriteFile.close() do, but with the data copied
+        # raw, and its CRC and size known up front
+        with zip._lock:
+            if zip._writing:
+                raise ValueError("Can't write to the ZIP file while there is another write "
+                                 "handle open on it.")
+            zip.fp.seek(zip.start_dir)
+            info.header_offset = zip.fp.tell()
+            zip._writecheck(info)
+            zip._didModify = True
+            header = info.FileHeader(size * 1.05 > zipfile.ZIP64_LIMIT)
+            zip.fp.write(header)
+            zip.fp.flush()
+            try:
+                with open(path, "rb") as src:
+                    copy_range(src.fileno(), zip.fp.fileno(), offset, size)
+            except BaseException:
+                self._rollback(info)
+                raise
+            zip.start_dir = zip.fp.seek(info.header_offset + len(header) + size)
+            zip.filelist.append(info)
+            zip.NameToInfo[name] = info
+        self.crcs[name] = crc
+
+    def _rollback(self, info):
+        """Removes the member info being (or last) written, truncating the zip to before it"""
+        zip = self.zip
+        with zip._lock:
+            if zip.NameToInfo.get(info.filename) is info:
+                zip.filelist.remove(info)
+                del zip.NameToInfo[info.filename]
+            zip.fp.seek(info.header_offset)
+            zip.fp.truncate()
+            zip.start_dir = info.header_offset
+
+    def _check_same(self, name, crc, newcrc):
+        if newcrc != crc:
+            raise RuntimeError(f"ERROR: trying to overwrite file with different content: "
+                               f"zip={self.path}, subpath={name}")
+
+    def close(self):
+        """Writes the central directory, closes the bundle, and releases its lock"""
+        try:
+            self.zip.close()
+        finally:
+            self.lock.release()
+
+
+class PooledArchive(object):
+    """An open archive handle, and the (mtime, size) of the file when it was opened"""
+
+    def __init__(self, handle, key):
+        self.handle = handle
+        self.key = key
+        self.lock = RLock()
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.handle.close()
+                self.closed = True
+
+
+class ArchivePool(object):
+    """A per-process LRU pool of open zip and tar archive handles.
+
+    Opening a zip re-reads its central directory (and opening a tar scans its headers), which for
+    large bundles costs far more than reading a single member. The pool keeps up to `maxopen`
+    archives open, keyed by path, so consecutive reads from the same bundle reuse one handle.
+    Handles are re-opened if the archive's mtime or size have changed, and are never shared
+    across processes (handles inherited over fork would share file offsets with the parent).
+    """
+
+    def __init__(self, maxopen=32, maxkinds=100000):
+        self.maxopen = maxopen
+        self.maxkinds = maxkinds
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self._handles = OrderedDict()
+        self._kinds = OrderedDict()
+
+    def _get(self, path, opener):
+        path = str(path)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if self._pid != os.getpid():
+                # We're in a forked child: forget (but don't close) the parent's handles
+                self._pid = os.getpid()
+                self._handles = OrderedDict()
+            archive = self._handles.get((path, opener))
+            if archive is not None and archive.key == key and not archive.closed:
+                self._handles.move_to_end((path, opener))
+                return archive
+            if archive is not None:
+                archive.close()
+            archive = PooledArchive(opener(path), key)
+            self._handles[(path, opener)] = archive
+            while len(self._handles) > self.maxopen:
+                _, oldest = self._handles.popitem(last=False)
+                oldest.close()
+            return archive
+
+    @contextmanager
+    def _open(self, path, opener):
+        while True:
+            archive = self._get(path, opener)
+            with archive.lock:
+                # it may have been evicted by another thread between _get and taking the lock
+                if archive.closed:
+                    continue
+                yield archive.handle
+                return
+
+    def kind(self, path):
+        """Returns "zip", "tar" or None for the file at path (see `sniff_archive`)
+
+        The verdict is cached (for up to `maxkinds` paths), and only re-sniffed if the
+        file's mtime or size change.
+        """
+        path = str(path)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._kinds.get(path)
+            if cached is not None and cached[0] == key:
+                self._kinds.move_to_end(path)
+                return cached[1]
+        kind = sniff_archive(path) if stat.S_ISREG(st.st_mode) else None
+        with self._lock:
+            self._kinds[path] = (key, kind)
+            self._kinds.move_to_end(path)
+            while len(self._kinds) > self.maxkinds:
+                self._kinds.popitem(last=False)
+        return kind
+
+    def open_zip(self, path):
+        """Context manager giving exclusive use of a pooled zipfile.ZipFile for path"""
+        return self._open(path, zipfile.ZipFile)
+
+    def open_tar(self, path):
+        """Context manager giving exclusive use of a pooled TarReader for path"""
+        return self._open(path, TarReader)
+
+    def read_zip(self, path, member):
+        with self.open_zip(path) as zip:
+            return zip.read(member)
+
+    def view_zip(self, path, member):
+        """Returns a zero-copy memoryview of member's data (see ZipMapping)
+
+        Compressed or encrypted members are read as bytes, as with `read_zip`.
+        """
+        with self._open(path, ZipMapping) as mapping:
+            view = mapping.view(member)
+        if view is None:
+            return self.read_zip(path, member)
+        return view
+
+    def zip_span(self, path, member):
+        """The (offset, size) of member's data in the file, or None if it is compressed"""
+        with self._open(path, ZipMapping) as mapping:
+            return mapping.span(member)
+
+    def stream_zip(self, path, member):
+        """Returns a seekable binary stream of member's data, which is read as needed"""
+        span = self.zip_span(path, member)
+        if span is not None:
+            return io.BufferedReader(FileSlice(path, *span))
+        zip = zipfile.ZipFile(path)
+        try:
+            return zip.open(member)
+        finally:
+            zip.close()  # the file stays open until the member is closed
+
+    def read_tar(self, path, member):
+        with self.open_tar(path) as tar:
+            return tar.read(member)
+
+    def stream_tar(self, path, member):
+        """Returns a seekable binary stream of member's data, which is read as needed"""
+        offset, size = self.tar_members(path)[member]
+        return io.BufferedReader(FileSlice(path, offset, size))
+
+    def tar_header(self, path, member):
+        with self.open_tar(path) as tar:
+            return tar.header(member)
+
+    def tar_members(self, path):
+        """Returns {name: (data offset, size)} for each regular file in the tar at path"""
+        with self.open_tar(path) as tar:
+            return tar.members
+
+    def close(self):
+        with self._lock:
+            for archive in self._handles.values():
+                archive.close()
+            self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+
+# The pool shared by all content fetchers in this process
+archive_pool = ArchivePool()
@@ -3,11 +3,14 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from pyts2 import TimeStream
+from pyts2 import TimeStream, TimeStreamIndex, TimeStreamWriter
+from pyts2.time import DaylightFilter
 from pyts2.timestream import FileContentFetcher
 from pyts2.pipeline import *
+from pyts2.rebundle import rebundle as rebundle_stream
 from pyts2.utils import CatchSignalThenExit
 import argparse as ap
+import functools
 import os
 from os.path import realpath
 import sys
@@ -17,11 +20,33 @@ from click import Choice, Path, DateTime
 from tqdm import tqdm
 
 
+# Output bundles are kept open (and files pending a group sync) for up to this many seconds
+# across writes. Commands must close() their outputs (see TimeStream)
+FLUSH_INTERVAL = 2.0
+
+
 @click.group()
 def tstk_main():
     pass
 
 
+def daylight_options(func):
+    """Adds options to skip night-time images, given as a `daylight` DaylightFilter (or None)"""
+    @click.option("--daylight", nargs=2, type=float, default=None, metavar="LAT LON",
+                  help="Skip images taken at night at this latitude and longitude")
+    @click.option("--timezone", default=None,
+                  help="Timezone of image times for --daylight, e.g. Australia/Sydney (default UTC)")
+    @click.option("--twilight", default=0.0,
+                  help="Minutes before sunrise and after sunset to keep with --daylight")
+    @functools.wraps(func)
+    def wrapped(*args, daylight=None, timezone=None, twilight=0.0, **kwargs):
+        if daylight is not None:
+            lat, lon = daylight
+            daylight = DaylightFilter(lat, lon, timezone=timezone, margin=twilight)
+        return func(*args, daylight=daylight, **kwargs)
+    return wrapped
+
+
 @tstk_main.command()
 @click.option("--force", default=False,
               help="Force writing to an existing stream")
@@ -29,20 +54,44 @@ def tstk_main():
               help="Input image format (use extension as lower case for raw formats)")
 @click.option("--bundle", "-b", type=Choice(TimeStream.bundle_levels), default="none",
               help="Level at which to bundle files")
+@click.option("--link", default=False, is_flag=True,
+              help="Hardlink unbundled output to input files where possible, rather than copy")
 @click.argument("input")
                 #help="Input files in timestream format of any form but msgpack")
 @click.argument("output")
                 #help="Output file or directory")
-def bundle(force, informat, bundle, input, output):
+def bundle(force, informat, bundle, link, input, output):
     input = TimeStream(input, format=informat)
     if os.path.exists(output) and not force:
         click.echo(f"ERROR: output exists: {output}", err=True)
         sys.exit(1)
-    output =  TimeStream(output, bundle_level=bundle)
-    for image in input:
-        with CatchSignalThenExit():
-            output.write(image)
-        click.echo(f"Processing {image}")
+    output =  TimeStream(output, bundle_level=bundle, link=link, flush_interval=FLUSH_INTERVAL)
+    with output:
+        for image in input:
+            with CatchSignalThenExit():
+                output.write(image)
+            click.echo(f"Processing {image}")
+
+
+@tstk_main.command()
+@click.option("--informat", "-F", default=None,
+              help="Input image format (use extension as lower case for raw formats)")
+@click.option("--bundle", "-b", type=Choice(TimeStream.bundle_levels), required=True,
+              help="Level at which to bundle files")
+@click.option("--ncpus", "-j", default=1,
+              help="Number of parallel workers")
+@click.option("--delete", default=False, is_flag=True,
+              help="Delete input bundles (or files) once all their files are copied and verified")
+@click.argument("input")
+@click.argument("output")
+def rebundle(informat, bundle, ncpus, delete, input, output):
+    """Copies INPUT to OUTPUT bundled at another level, copying zip members raw"""
+    input = TimeStream(input, format=informat)
+    output = TimeStream(output, bundle_level=bundle, flush_interval=FLUSH_INTERVAL)
+    with output:
+        copied, deleted = rebundle_stream(input, output, ncpus=ncpus, delete=delete)
+    click.echo(f"Rebundled {copied} files from {input.path} to {output.path}" +
+               (f", deleting {len(deleted)} sources" if delete else ""))
 
 
 @tstk_main.command()
@@ -52,8 +101,11 @@ def bundle(force, informat, bundle, input, output):
               help="Number of parallel workers")
 @click.option("--informat", "-F", default=None,
               help="Input image format (use extension as lower case for raw formats)")
+@click.option("--prefetch", "-p", default=0,
+              help="Number of files to read ahead in the background")
+@daylight_options
 @click.argument("input")
-def audit(output, input, ncpus=1, informat=None):
+def audit(output, input, ncpus=1, informat=None, prefetch=0, daylight=None):
     pipe = TSPipeline(
         FileStatsStep(),
         DecodeImageFileStep(),
@@ -61,9 +113,9 @@ def audit(output, input, ncpus=1, informat=None):
         ScanQRCodesStep(),
     )
 
-    ints = TimeStream(input, format=informat)
+    ints = TimeStream(input, format=informat, timefilter=daylight)
     try:
-        for image in pipe.process(ints, ncpus=ncpus):
+        for image in pipe.process(ints.iter(prefetch=prefetch), ncpus=ncpus):
             if pipe.n % 1000 == 0:
                 pipe.report.save(output)
     finally:
@@ -90,8 +142,11 @@ def audit(output, input, ncpus=1, informat=None):
                    "--size pixels at original resolution.")
 @click.option("--size", "-s", default='720x',
               help="Output size. Use ROWSxCOLS. One of ROWS or COLS can be omitted to keep aspect ratio.")
+@click.option("--prefetch", "-p", default=0,
+              help="Number of files to read ahead in the background")
+@daylight_options
 @click.argument("input")
-def downsize(input, output, ncpus, informat, outformat, size, bundle, mode):
+def downsize(input, output, ncpus, informat, outformat, size, bundle, mode, prefetch, daylight):
     if mode == "resize":
         downsizer = ResizeImageStep(geom=size)
     elif mode == "centrecrop" or mode == "crop":
@@ -101,11 +156,13 @@ def downsize(input, output, ncpus, informat, outformat, size, bundle, mode):
         downsizer,
         EncodeImageFileStep(format=outformat),
     )
-    ints = TimeStream(input, format=informat)
-    outts = TimeStream(output, format=outformat, bundle_level=bundle)
+    ints = TimeStream(input, format=informat, timefilter=daylight)
+    outts = TimeStream(output, format=outformat, bundle_level=bundle,
+                       flush_interval=FLUSH_INTERVAL)
     try:
-        pipe.process_to(ints, outts, ncpus=ncpus)
+        pipe.process_to(ints.iter(prefetch=prefetch), outts, ncpus=ncpus)
     finally:
+        outts.close()
         click.echo(f"{mode} {input}:{informat} to {output}:{outformat}, found {pipe.n} files")
 
 
@@ -131,9 +188,18 @@ def downsize(input, output, ncpus, informat, outformat, size, bundle, mode):
               help="Level at which to bundle downsized images.")
 @click.option("--audit-output", "-a", type=Path(writable=True), default=None,
               help="Audit log output TSV. If given, input images will be audited, with the log saved here.")
-def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_size, downsized_bundle, audit_output):
+@click.option("--prefetch", "-p", default=0,
+              help="Number of files to read ahead in the background")
+@click.option("--writers", "-w", default=1,
+              help="Number of processes writing each output, with --ncpus > 1")
+@click.option("--link", default=False, is_flag=True,
+              help="Hardlink unbundled output to input files where possible, rather than copy")
+def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_size, downsized_bundle, audit_output, prefetch, writers, link):
     ints = TimeStream(input, format=informat)
-    outts = TimeStream(output, bundle_level=bundle)
+    outts = TimeStream(output, bundle_level=bundle, link=link, flush_interval=FLUSH_INTERVAL)
+    if ncpus > 1:
+        # workers send files to dedicated writers, rather than all contending for bundles
+        outts = TimeStreamWriter(outts, writers=writers)
 
     steps = [WriteFileStep(outts)]
 
@@ -151,7 +217,10 @@ def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_s
 
 
     if downsized_output is not None:
-        downsized_ts = TimeStream(downsized_output, bundle_level=downsized_bundle)
+        downsized_ts = TimeStream(downsized_output, bundle_level=downsized_bundle,
+                                  flush_interval=FLUSH_INTERVAL)
+        if ncpus > 1:
+            downsized_ts = TimeStreamWriter(downsized_ts, writers=writers)
         downsize_pipeline = TSPipeline(
             DecodeImageFileStep(),
             ResizeImageStep(geom=downsized_size),
@@ -163,7 +232,7 @@ def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_s
     pipe = TSPipeline(*steps)
 
     try:
-        for image in pipe.process(ints, ncpus=ncpus):
+        for image in pipe.process(ints.iter(prefetch=prefetch), ncpus=ncpus):
             pass
     finally:
         pipe.finish()
@@ -172,6 +241,19 @@ def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_s
         click.echo(f"Ingested {input}:{informat} to {output}, found {pipe.n} files")
 
 
+@tstk_main.command()
+@click.option("--rebuild", default=False, is_flag=True,
+              help="Discard any existing index and re-index from scratch")
+@click.argument("input")
+def index(input, rebuild):
+    """Create or refresh the on-disk index of a timestream"""
+    with TimeStreamIndex(input) as idx:
+        if rebuild:
+            idx.clear()
+        idx.update()
+        click.echo(f"Indexed {input} to {idx.path}, found {len(idx)} files")
+
+
 @tstk_main.command()
 @click.option("--ephemeral", "-e", type=Path(readable=True), required=True,
         help="Ephemeral image source location")
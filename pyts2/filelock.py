@@ -27,20 +27,87 @@
 import os
 import time
 import errno
-import random
+import threading
+try:
+    import fcntl
+except ImportError:  # e.g. windows, where we fall back to polling for lockfiles
+    fcntl = None
 
 class FileLockException(Exception):
     pass
 
+
+class _Abandoned(Exception):
+    """We stopped waiting for a lock, which a waiting thread will release"""
+    pass
+
+
+class _Entry(object):
+    """A process's lock on a lockfile, shared by all of its threads"""
+    def __init__(self):
+        self.lock = threading.Lock()  # held by the thread holding the FileLock
+        self.fd = None  # open (and locked) lockfile, while any thread holds or awaits it
+        self.users = 0  # threads holding or waiting for the lock
+
+
+# lockfile path -> _Entry. POSIX locks belong to a process, not a thread, and are dropped
+# when any of its descriptors of the file are closed, so each process must only open a
+# lockfile once, and serialise its own threads.
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _reset_registry():
+    # locks held by the parent's threads aren't inherited by (or relevant to) a fork
+    global _registry_lock
+    _registry.clear()
+    _registry_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_registry)
+
+
+def _leave(path, entry):
+    """Stop using entry, unlocking and removing the lockfile if no other thread needs it"""
+    with _registry_lock:
+        entry.users -= 1
+        if entry.users > 0:
+            return
+        if _registry.get(path) is entry:
+            del _registry[path]
+        if entry.fd is not None:
+            # unlink while still locked, so the next holder can tell it has a stale file
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            os.close(entry.fd)
+            entry.fd = None
+
+
+def _same_file(fd, path):
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
 class FileLock(object):
     """ A file locking mechanism that has context-manager support so
-        you can use it in a with statement. This should be relatively cross
-        compatible as it doesn't rely on msvcrt or fcntl for the locking.
+        you can use it in a with statement.
+
+        The lock is a POSIX (fcntl) lock on a lockfile next to file_name, so waiting for
+        it blocks in the kernel, and it is released if the process dies. Threads of a
+        process share its lock on the file, queueing for it in the process. On platforms
+        without fcntl, the lockfile's existence is the lock, and is polled for.
     """
 
     def __init__(self, file_name, timeout=10, delay=.05):
         """ Prepare the file locker. Specify the file to lock and optionally
             the maximum timeout and the delay between each attempt to lock.
+
+            timeout=None fails immediately if the lock is held. delay is only used where
+            fcntl is unavailable.
         """
         if timeout is not None and delay is None:
             raise ValueError("If timeout is not None, then delay must not be None.")
@@ -52,12 +119,69 @@ class FileLock(object):
 
 
     def acquire(self):
-        """ Acquire the lock, if possible. If the lock is in use, it check again
-            every `delay` seconds. It does this until it either gets the lock or
-            exceeds `timeout` number of seconds, in which case it throws
-            an exception.
+        """ Acquire the lock, if possible. If the lock is in use, it waits for up to
+            `timeout` seconds for it, after which it throws an exception.
         """
-        time.sleep(random.randrange(1, 10) / 1000)  # 1-10 millisec delay
+        if fcntl is None:
+            return self._acquire_polling()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        path = os.path.abspath(self.lockfile)
+        with _registry_lock:
+            entry = _registry.setdefault(path, _Entry())
+            entry.users += 1
+        if self.timeout is None:
+            got = entry.lock.acquire(blocking=False)
+        else:
+            got = entry.lock.acquire(timeout=max(self.timeout, 0))
+        if not got:
+            _leave(path, entry)
+            self._fail()
+        try:
+            if entry.fd is None:  # i.e. not kept locked by another of our threads
+                entry.fd = self._lock_file(path, entry, deadline)
+        except _Abandoned:
+            self._fail()
+        except BaseException:
+            entry.lock.release()
+            _leave(path, entry)
+            raise
+        self._entry = entry
+        self.is_locked = True
+
+    def _fail(self):
+        if self.timeout is None:
+            raise FileLockException("Could not acquire lock on {}".format(self.file_name))
+        raise FileLockException("Timeout occured.")
+
+    def _lock_file(self, path, entry, deadline):
+        """Opens and locks the lockfile at path, returning its descriptor"""
+        def abandon():
+            entry.lock.release()
+            _leave(path, entry)
+
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR | getattr(os, "O_CLOEXEC", 0), 0o644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    os.close(fd)
+                    raise
+                if deadline is None:
+                    os.close(fd)
+                    self._fail()
+                locked = _wait_for_lock(fd, deadline - time.monotonic(), abandon)
+                if locked is None:
+                    raise _Abandoned()
+                if not locked:
+                    os.close(fd)
+                    self._fail()
+            # the previous holder may have removed the lockfile before we got the lock
+            if _same_file(fd, path):
+                return fd
+            os.close(fd)
+
+    def _acquire_polling(self):
         start_time = time.time()
         while True:
             try:
@@ -75,14 +199,20 @@ class FileLock(object):
 
 
     def release(self):
-        """ Get rid of the lock by deleting the lockfile.
-            When working in a `with` statement, this gets automatically
+        """ Release the lock, removing the lockfile unless another thread of this process
+            is waiting for it. When working in a `with` statement, this gets automatically
             called at the end.
         """
-        if self.is_locked:
+        if not self.is_locked:
+            return
+        self.is_locked = False
+        if fcntl is None:
             os.close(self.fd)
             os.unlink(self.lockfile)
-            self.is_locked = False
+            return
+        entry, self._entry = self._entry, None
+        entry.lock.release()
+        _leave(os.path.abspath(self.lockfile), entry)
 
 
     def __enter__(self):
@@ -107,3 +237,36 @@ class FileLock(object):
             lying around.
         """
         self.release()
+
+
+def _wait_for_lock(fd, timeout, abandon):
+    """Waits up to timeout seconds to lock fd, returning whether it was locked.
+
+    fcntl can't wait with a timeout, so the wait happens in another thread. If we stop waiting
+    (returning None), that thread closes fd once it gets the lock, then calls abandon().
+    """
+    done = threading.Event()
+    state = {"abandoned": False, "locked": False}
+    state_lock = threading.Lock()
+
+    def wait():
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            locked = True
+        except OSError:
+            locked = False
+        with state_lock:
+            state["locked"] = locked
+            abandoned = state["abandoned"]
+            done.set()
+        if abandoned:
+            os.close(fd)
+            abandon()
+
+    threading.Thread(target=wait, daemon=True).start()
+    done.wait(max(timeout, 0))
+    with state_lock:
+        if not done.is_set():
+            state["abandoned"] = True
+            return None
+    return state["locked"]
@@ -0,0 +1,451 @@
+# Copyright (c) 2018 Kevin Murray <kdmfoss@gmail.com>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+import datetime
+import os
+import os.path as op
+import sqlite3
+import tarfile
+import warnings
+import zipfile
+
+import numpy as np
+
+from pyts2.time import *
+from pyts2.timestream import *
+from pyts2.archive import archive_pool
+
+
+class TimeStreamIndex(object):
+    """A persistent index of the files within a timestream.
+
+    The index is an SQLite database kept next to the timestream root (i.e.
+    `/data/stream` is indexed in `/data/stream.tsidx`). It records the instant, location (a
+    loose file, or a member of a zip/tar bundle), size and, for zip bundles, CRC-32 of every
+    timestream file. Each directory and bundle is recorded with its mtime and size, so
+    `update()` only re-lists directories and re-reads bundles that have changed, and
+    `is_fresh()` only needs to stat directories and bundles, not each file.
+    """
+    suffix = ".tsidx"
+    schema = """
+        CREATE TABLE IF NOT EXISTS sources (
+            source TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            source TEXT NOT NULL,
+            member TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            datetime TEXT NOT NULL,
+            subsecond INTEGER NOT NULL,
+            idx TEXT,
+            size INTEGER,
+            crc INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_instant ON files (datetime, subsecond, idx);
+        CREATE INDEX IF NOT EXISTS files_source ON files (source);
+        CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+    """
+
+    def __init__(self, stream_path, path=None):
+        """stream_path is the root of a timestream (a directory or a bundle)"""
+        self.stream_path = op.normpath(str(stream_path))
+        if path is None:
+            path = self.stream_path + self.suffix
+        self.path = str(path)
+        self._db = None
+
+    @property
+    def exists(self):
+        return op.isfile(self.path)
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.executescript(self.schema)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __getstate__(self):
+        # sqlite connections can't be pickled, so are re-opened on demand after unpickling
+        state = self.__dict__.copy()
+        state["_db"] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM files").fetchone()[0]
+
+    def _relpath(self, path):
+        return op.relpath(path, self.stream_path)
+
+    def _abspath(self, source):
+        return op.normpath(op.join(self.stream_path, source))
+
+    def is_fresh(self):
+        """Is the index present, and does it match the directories and bundles on disk?"""
+        if not self.exists or not op.exists(self.stream_path):
+            return False
+        sources = self.db.execute("SELECT source, mtime, size FROM sources").fetchall()
+        if len(sources) == 0:
+            return False
+        for source, mtime, size in sources:
+            try:
+                st = os.stat(self._abspath(source))
+            except OSError:
+                return False
+            if (st.st_mtime_ns, st.st_size) != (mtime, size):
+                return False
+        return True
+
+    def clear(self):
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM sources")
+
+    def update(self):
+        """Bring the index up to date with the timestream on disk.
+
+        Directories whose mtime and size are unchanged keep their indexed loose files, and
+        unchanged bundles are not re-read.
+        """
+        known = {source: (kind, mtime, size) for source, kind, mtime, size in
+                 self.db.execute("SELECT source, kind, mtime, size FROM sources")}
+        seen = set()
+        with self.db:
+            if op.isfile(self.stream_path):
+                self._update_bundle(self.stream_path, known, seen)
+            for root, dirs, files in os.walk(self.stream_path):
+                source = self._relpath(root)
+                seen.add(source)
+                st = os.stat(root)
+                changed = known.get(source) != ("dir", st.st_mtime_ns, st.st_size)
+                if changed:
+                    self.db.execute("DELETE FROM files WHERE source = ?", (source, ))
+                reread = False
+                damaged = False
+                loose = []  # (name, size, None) of files that may be timestream images
+                for file in files:
+                    if file.startswith("."):
+                        continue
+                    path = op.join(root, file)
+                    if self._relpath(path) in known:
+                        # a bundle we already know about
+                        result = self._update_bundle(path, known, seen)
+                        reread |= result == "updated"
+                        damaged |= result == "damaged"
+                    elif changed:
+                        if not (op.isfile(path) and os.access(path, os.R_OK)):
+                            continue
+                        if path_may_be_archive(file):
+                            result = self._update_bundle(path, known, seen)
+                            damaged |= result == "damaged"
+                            if result is not None:
+                                continue
+                        loose.append((file, op.getsize(path), None))
+                self._insert_many(source, loose, root)
+                if damaged:
+                    # nor is the directory recorded, so the bundle is re-read once repaired
+                    self.db.execute("DELETE FROM sources WHERE source = ?", (source, ))
+                elif changed or reread:
+                    # re-reading tar bundles can write their member index sidecars, which
+                    # changes the directory's mtime, so only now record the directory
+                    st = os.stat(root)
+                    self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                                    (source, "dir", st.st_mtime_ns, st.st_size))
+            for source in set(known) - seen:
+                self.db.execute("DELETE FROM files WHERE source = ?", (source, ))
+                self.db.execute("DELETE FROM sources WHERE source = ?", (source, ))
+
+    def _update_bundle(self, path, known, seen):
+        """Re-index bundle at path if it has changed.
+
+        Returns "unchanged", "updated", or "damaged" (warning, and leaving it unrecorded, if its
+        members can't be listed), or None if path isn't a bundle.
+        """
+        source = self._relpath(path)
+        st = os.stat(path)
+        if source in known:
+            kind, mtime, size = known[source]
+            if (mtime, size) == (st.st_mtime_ns, st.st_size):
+                seen.add(source)
+                return "unchanged"
+        try:
+            kind = archive_pool.kind(path)
+            if kind == "zip":
+                with archive_pool.open_zip(path) as zip:
+                    members = [(entry.filename, entry.file_size, entry.CRC)
+                               for entry in zip.infolist() if not entry.is_dir()]
+            elif kind == "tar":
+                members = [(name, size, None) for name, (offset, size)
+                           in archive_pool.tar_members(path).items()]
+            else:
+                return None
+        except (zipfile.BadZipFile, tarfile.TarError, OSError) as exc:
+            # as the walk does, skip it; it isn't seen, so any indexed files of it are removed
+            warnings.warn(f"{exc.__class__.__name__}: {str(exc)} at '{path}'")
+            return "damaged"
+        seen.add(source)
+        self.db.execute("DELETE FROM files WHERE source = ?", (source, ))
+        self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                        (source, kind, st.st_mtime_ns, st.st_size))
+        self._insert_many(source, members, path)
+        return "updated"
+
+    @staticmethod
+    def _parse_or_warn(name, path):
+        """The instant of name (in path), or None, warning as iteration does if its date is invalid"""
+        try:
+            return parse_ts_filename(name)
+        except ValueError as exc:
+            warnings.warn(f"{exc.__class__.__name__}: {str(exc)} at '{path}'")
+            return None
+
+    def _insert_many(self, source, members, path):
+        """Indexes those of members, (name, size, crc) of files in source (at path), that are
+        named as timestream files
+
+        Names are parsed all at once (see `parse_ts_filenames`), so only those without a valid
+        timestream date are looked at one by one, to warn about invalid dates.
+        """
+        if not members:
+            return
+        times, subsecs, indices = parse_ts_filenames([name for name, _, _ in members])
+        isotimes = np.datetime_as_string(times, unit="s")
+        rows = []
+        for i, (name, size, crc) in enumerate(members):
+            if np.isnat(times[i]):
+                instant = self._parse_or_warn(name, op.join(path, name))
+                if instant is not None:
+                    rows.append((source, name, op.basename(name), instant.datetime.isoformat(),
+                                 instant.subsecond, instant.index, size, crc))
+                continue
+            rows.append((source, name, op.basename(name), str(isotimes[i]), int(subsecs[i]),
+                         indices[i], size, crc))
+        self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _file(self, row, mmap=False):
+        source, kind, member, datetimestr, subsecond, index, size, crc = row
+        instant = TSInstant(datetime.datetime.fromisoformat(datetimestr), subsecond, index)
+        path = self._abspath(source)
+        if kind == "zip":
+            fetcher = ZipContentFetcher(path, member, mmap=mmap, size=size, crc32=crc)
+        elif kind == "tar":
+            fetcher = TarContentFetcher(path, member, size=size)
+        else:
+            fetcher = FileContentFetcher(op.join(path, member), size=size)
+        return TimestreamFile(instant=instant, filename=member, fetcher=fetcher)
+
+    _select = """SELECT files.source, sources.kind, member, datetime, subsecond, idx,
+                        files.size, crc
+                 FROM files JOIN sources ON files.source = sources.source"""
+
+    def files(self, mmap=False, timefilters=(), batch=4096):
+        """Yields a TimestreamFile for each indexed file, in instant order
+
+        mmap is passed on to the ZipContentFetcher of files in zip bundles. Only files within
+        all of timefilters (each a TimeFilter) are yielded: rows are read batch at a time, and
+        their times tested at once (see `TimeFilter.mask`), so no file is made for the rest.
+        """
+        cursor = self.db.execute(f"{self._select} ORDER BY datetime, subsecond, idx")
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            if timefilters:
+                times = np.array([row[3] for row in rows], dtype="M8[us]")
+                wanted = np.ones(len(rows), dtype=bool)
+                for timefilter in timefilters:
+                    wanted &= timefilter.mask(times)
+                rows = [rows[i] for i in np.flatnonzero(wanted)]
+            for row in rows:
+                yield self._file(row, mmap=mmap)
+
+    def get(self, filename, mmap=False):
+        """Gets the TimestreamFile with basename `filename`, raising KeyError if not indexed"""
+        row = self.db.execute(f"{self._select} WHERE filename = ?", (filename, )).fetchone()
+        if row is None:
+            raise KeyError(filename)
+        return self._file(row, mmap=mmap)
+
+
+class InstantIndex(Mapping):
+    """A compact, sorted, in-memory index of the files in a timestream.
+
+    Behaves like a read-only dict of TSInstant -> TimestreamFile, but rather than holding a
+    TimestreamFile (and fetcher) per file, each file is a row of numpy columns: microseconds
+    since the epoch, subsecond, and an ordinal of its index, all sorted; the id of its source (a
+    bundle, or a directory of loose files); and the offset and length of its member name within a
+    single blob of names. Lookups are binary searches, and TSInstants and TimestreamFiles are
+    only created when asked for.
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, files=()):
+        """files is an iterable of TimestreamFiles with fetchers, e.g. TimeStream.iter()"""
+        self.sources = []  # (fetcher class, path, mmap) of each source
+        sourceids = {}
+        times, subsecs, sources, offsets, lengths = (array("q") for _ in range(5))
+        indices = []
+        names = bytearray()
+        for file in files:
+            source, member = self._location(file)
+            if source not in sourceids:
+                sourceids[source] = len(self.sources)
+                self.sources.append(source)
+            member = member.encode("utf8")
+            times.append(self._microseconds(file.instant.datetime))
+            subsecs.append(file.instant.subsecond)
+            indices.append(file.instant.index)
+            sources.append(sourceids[source])
+            offsets.append(len(names))
+            lengths.append(len(member))
+            names.extend(member)
+
+        # indices are arbitrary strings, so store each as its position in the sorted list of
+        # distinct indices, which sorts the same way. No index (None) sorts first, as -1.
+        self.indices = sorted({index for index in indices if index is not None})
+        ordinal = {index: i for i, index in enumerate(self.indices)}
+        ordinals = np.fromiter((ordinal.get(index, -1) for index in indices), dtype=np.int32,
+                               count=len(indices))
+        del indices
+
+        times = np.frombuffer(times, dtype=np.int64)
+        subsecs = np.frombuffer(subsecs, dtype=np.int64)
+        order = np.lexsort((ordinals, subsecs, times))
+        self.times = times[order]
+        self.subsecs = subsecs[order].astype(np.int32)
+        self.ordinals = ordinals[order]
+        self.source_ids = np.frombuffer(sources, dtype=np.int64)[order].astype(np.int32)
+        self.name_offsets = np.frombuffer(offsets, dtype=np.int64)[order]
+        self.name_lengths = np.frombuffer(lengths, dtype=np.int64)[order].astype(np.int32)
+        self.names = bytes(names)
+
+    @staticmethod
+    def _location(file):
+        fetcher = file.fetcher
+        if isinstance(fetcher, ZipContentFetcher):
+            return (ZipContentFetcher, str(fetcher.zipfile), fetcher.mmap), fetcher.pathinzip
+        if isinstance(fetcher, TarContentFetcher):
+            return (TarContentFetcher, str(fetcher.tarfile), False), fetcher.pathintar
+        if isinstance(fetcher, FileContentFetcher):
+            return (FileContentFetcher, str(fetcher.path.parent), False), fetcher.path.name
+        raise ValueError(f"Can't index {file.filename}, as it isn't stored in a timestream")
+
+    @classmethod
+    def _microseconds(cls, datetime_):
+        return (datetime_ - cls.epoch) // datetime.timedelta(microseconds=1)
+
+    def __len__(self):
+        return len(self.times)
+
+    def instant(self, i):
+        """The TSInstant of the i-th file"""
+        index = None if self.ordinals[i] < 0 else self.indices[self.ordinals[i]]
+        datetime_ = self.epoch + datetime.timedelta(microseconds=int(self.times[i]))
+        return TSInstant(datetime_, int(self.subsecs[i]), index)
+
+    def member(self, i):
+        """The name of the i-th file within its source (a bundle or directory)"""
+        start = self.name_offsets[i]
+        return self.names[start:start + self.name_lengths[i]].decode("utf8")
+
+    def file(self, i, filename=None):
+        """The TimestreamFile of the i-th file"""
+        fetcher_class, path, mmap = self.sources[self.source_ids[i]]
+        member = self.member(i)
+        if fetcher_class is FileContentFetcher:
+            fetcher = FileContentFetcher(op.join(path, member))
+        elif fetcher_class is ZipContentFetcher:
+            fetcher = ZipContentFetcher(path, member, mmap=mmap)
+        else:
+            fetcher = fetcher_class(path, member)
+        if filename is None:
+            filename = member
+        return TimestreamFile(instant=self.instant(i), filename=filename, fetcher=fetcher)
+
+    def rows(self, instant):
+        """Returns the rows of files at exactly instant"""
+        micros = self._microseconds(instant.datetime)
+        lo = np.searchsorted(self.times, micros, side="left")
+        hi = np.searchsorted(self.times, micros, side="right")
+        if instant.index is None:
+            ordinal = -1
+        else:
+            ordinal = bisect_left(self.indices, instant.index)
+            if ordinal == len(self.indices) or self.indices[ordinal] != instant.index:
+                return []
+        return [i for i in range(lo, hi)
+                if self.subsecs[i] == instant.subsecond and self.ordinals[i] == ordinal]
+
+    def range(self, start=None, end=None, inclusive=False):
+        """Returns the rows of files from datetime start to before end (or to end, if inclusive)
+
+        Either of start and end may be None, for no limit.
+        """
+        lo, hi = 0, len(self)
+        if start is not None:
+            lo = np.searchsorted(self.times, self._microseconds(start), side="left")
+        if end is not None:
+            side = "right" if inclusive else "left"
+            hi = np.searchsorted(self.times, self._microseconds(end), side=side)
+        return range(lo, max(lo, hi))
+
+    def select(self, timefilter):
+        """Returns an array of the rows of files within timefilter (a TimeFilter)"""
+        return np.flatnonzero(timefilter.mask(self.times))
+
+    def nearest(self, datetime_):
+        """Returns the row of the file closest in time to datetime_, or None if empty"""
+        if len(self) == 0:
+            return None
+        micros = self._microseconds(datetime_)
+        i = np.searchsorted(self.times, micros)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(self)]
+        return min(candidates, key=lambda j: abs(int(self.times[j]) - micros))
+
+    def find(self, filename):
+        """Returns the row of the file with basename `filename`, or raises KeyError"""
+        try:
+            instant = TSInstant.from_path(filename)
+        except ValueError:
+            raise KeyError(filename)
+        for i in self.rows(instant):
+            if op.basename(self.member(i)) == op.basename(filename):
+                return i
+        raise KeyError(filename)
+
+    def __getitem__(self, instant):
+        rows = self.rows(instant)
+        if len(rows) == 0:
+            raise KeyError(instant)
+        return self.file(rows[0])
+
+    def __contains__(self, instant):
+        return len(self.rows(instant)) > 0
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.instant(i)
+
+    def files(self):
+        """Yields each file as a TimestreamFile, in instant order"""
+        for i in range(len(self)):
+            yield self.file(i)
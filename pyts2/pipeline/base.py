@@ -3,9 +3,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from collections import defaultdict
-from os import path as op
+from collections import defaultdict, deque
+from os import path as op, cpu_count
 from sys import stderr, stdout, stdin
+from threading import Lock
 import warnings
 import csv
 import re
@@ -22,12 +23,20 @@ csv.register_dialect('tsv',
 
 
 class TSPipeline(object):
-    def __init__(self, *args, reporter=None):
+    def __init__(self, *args, reporter=None, timefilter=None):
+        """args are the pipeline's steps
+
+        If given, files with instants outside timefilter (a pyts2.time.TimeFilter, e.g. a
+        DaylightFilter) are dropped from the input before they reach any step. Files from a
+        TimeStream are best filtered by it (TimeStream(..., timefilter=...)), which also
+        avoids listing directories and bundles outside the filter.
+        """
         self.n = 0
         self.steps = list(args)
         if reporter is None:
             reporter = ResultRecorder()
         self.report = reporter
+        self.timefilter = timefilter
 
     def add_step(self, step):
         if not hasattr(step, "process_file"):
@@ -49,12 +58,22 @@ class TSPipeline(object):
 
     def process(self, input_stream, ncpus=1, progress=True):
         from concurrent.futures import as_completed, ThreadPoolExecutor, ProcessPoolExecutor
+        from ..timestream import TimeStreamWriter
         if ncpus > 1:
-            executor = ProcessPoolExecutor(max_workers=ncpus)
+            # workers may write to any TimeStreamWriters (e.g. via a WriteFileStep)
+            executor = ProcessPoolExecutor(max_workers=ncpus,
+                                           initializer=TimeStreamWriter.share,
+                                           initargs=(TimeStreamWriter.shared(),))
+            window = 4 * ncpus
         else:
             executor = ThreadPoolExecutor()
+            window = 4 * (cpu_count() or 1)
+        if self.timefilter is not None:
+            input_stream = (file for file in input_stream
+                            if self.timefilter(file.instant.datetime))
         with executor:
-            for file in tqdm(executor.map(self.process_file, input_stream), unit=" files"):
+            results = bounded_map(executor, self.process_file, input_stream, window=window)
+            for file in tqdm(results, unit=" files"):
                 if file is None:
                     continue
                 self.report.record(file.instant, **file.report)
@@ -82,6 +101,21 @@ class TSPipeline(object):
             step.finish()
 
 
+def bounded_map(executor, func, iterable, window):
+    """Like executor.map, but only takes up to window items from iterable ahead of the results.
+
+    executor.map submits the whole of iterable at once, which holds every file (and any content
+    read ahead, e.g. by TimeStream.iter(prefetch=...)) in memory until it is processed.
+    """
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
 class ResultRecorder(object):
 
     def __init__(self):
@@ -92,7 +126,7 @@ class ResultRecorder(object):
         for key, val in kwargs.items():
             if key not in self.fields:
                 self.fields.append(key)
-            self.data[repr(instant)].update(kwargs.copy())
+            self.data[instant].update(kwargs.copy())
 
     def save(self, outpath, delim="\t"):
         if len(self.data) < 1:
@@ -101,8 +135,9 @@ class ResultRecorder(object):
         with open(outpath, "w") as fh:
             tsvw = csv.writer(fh, dialect='tsv')
             tsvw.writerow(["Instant"] + self.fields)
-            for instant, record in sorted(self.data.items()):
-                line = [instant, ]
+            for instant in sorted(self.data, key=lambda instant: instant.sortkey):
+                record = self.data[instant]
+                line = [str(instant), ]
                 for field in self.fields:
                     val = record.get(field, None)
                     if val is None:
@@ -156,17 +191,59 @@ class CopyStep(PipelineStep):
 
 
 class WriteFileStep(PipelineStep):
-    """Write each file to output, without changing the file"""
-    def __init__(self, output):
+    """Write each file to output, without changing the file
+
+    With batch > 1, files are written batch at a time with output.write_many (if it has one),
+    so each bundle is opened once per batch. Batching only happens in the process that created
+    the step, as copies of the step in worker processes can't be finished.
+    """
+    def __init__(self, output, batch=1):
         self.output = output
+        self.batch = batch
+        self.pending = []
+        self.lock = Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["pending"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.batch = 1
+        self.lock = Lock()
 
     def process_file(self, file):
-        self.output.write(file)
+        if self.batch <= 1:
+            self.output.write(file)
+            return file
+        with self.lock:
+            self.pending.append(file)
+            if len(self.pending) < self.batch:
+                return file
+            files, self.pending = self.pending, []
+        self._write(files)
         return file
 
+    def _write(self, files):
+        if hasattr(self.output, "write_many"):
+            self.output.write_many(files)
+        else:
+            for file in files:
+                self.output.write(file)
+
+    def finish(self):
+        with self.lock:
+            files, self.pending = self.pending, []
+        if files:
+            self._write(files)
+        if hasattr(self.output, "close"):
+            self.output.close()
+
 
 class FileStatsStep(PipelineStep):
     def process_file(self, file):
         file.report.update({"FileName": op.basename(file.filename),
-                            "FileSize": len(file.content)})
+                            "FileSize": file.size})
         return file
@@ -69,14 +69,20 @@ class DecodeImageFileStep(PipelineStep):
     def process_file(self, file):
         base, ext = op.splitext(file.filename)
         format = ext.lower().strip(".")
+        content = file.content
+        if not isinstance(content, bytes):
+            # e.g. a memoryview of an mmapped bundle: decode from it without copying
+            content = BufferReader(content)
         if format in ("cr2", "nef", "rw2"):
-            with rawpy.imread(io.BytesIO(file.content)) as img:
+            if isinstance(content, bytes):
+                content = io.BytesIO(content)
+            with rawpy.imread(content) as img:
                 if self.process_raws:
                     pixels = img.postprocess(**self.decode_options[format].copy())
                 else:
                     pixels = img.raw_image.copy()
         else:
-            pixels = imageio.imread(file.content)
+            pixels = imageio.imread(content)
         return TimestreamImage.from_timestreamfile(file, pixels=pixels)
 
 
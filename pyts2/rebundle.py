@@ -0,0 +1,193 @@
+# Copyright (c) 2018 Kevin Murray <kdmfoss@gmail.com>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, wait
+import os
+import os.path as op
+import warnings
+import zipfile
+
+from pyts2.archive import TarReader, archive_pool, stream_crc32
+from pyts2.timestream import FileContentFetcher, TarContentFetcher, ZipContentFetcher
+from pyts2.utils import CHUNK_SIZE
+
+
+def _source(file):
+    """(kind, path) of the bundle (or, for unbundled files, the file) file was read from"""
+    fetcher = file.fetcher
+    if isinstance(fetcher, ZipContentFetcher):
+        return "zip", str(fetcher.zipfile)
+    if isinstance(fetcher, TarContentFetcher):
+        return "tar", str(fetcher.tarfile)
+    if isinstance(fetcher, FileContentFetcher):
+        return "file", str(fetcher.path)
+    return None, None
+
+
+def _source_members(kind, path):
+    """The number of files in a source, all of which must be copied before it is deleted"""
+    if kind == "zip":
+        with archive_pool.open_zip(path) as zip:
+            return sum(1 for info in zip.infolist() if not info.is_dir())
+    if kind == "tar":
+        return len(archive_pool.tar_members(path))
+    return 1
+
+
+def _crc32(file):
+    """file's CRC-32, from its bundle's metadata if known, otherwise by reading it"""
+    if file.crc32 is not None:
+        return file.crc32
+    with file.open() as fh:
+        return stream_crc32(fh)
+
+
+def _verify(output, files, check_data):
+    """Checks that each of files was written to output, yielding (file, error or None)
+
+    Sizes, and CRC-32s where the source's are known, are checked against the destination's
+    metadata. With check_data, every file's data is read back and checked against its (if
+    needs be, computed) CRC-32 too.
+    """
+    if output.bundle == "none":
+        for file in files:
+            path = op.join(output.path, output._timestream_path(file))
+            if os.stat(path).st_size != file.size:
+                yield file, f"size of {path} differs from its source"
+                continue
+            if check_data:
+                with open(path, "rb") as fh:
+                    if stream_crc32(fh) != _crc32(file):
+                        yield file, f"content of {path} differs from its source"
+                        continue
+            yield file, None
+        return
+    bundle = output._bundle_archive_path(files[0])
+    # not from the archive pool, which may hold a handle opened before we wrote to it
+    with zipfile.ZipFile(bundle) as zip:
+        for file in files:
+            member = op.join(output.name, output._timestream_path(file))
+            try:
+                info = zip.getinfo(member)
+            except KeyError:
+                yield file, f"{member} is missing from {bundle}"
+                continue
+            crc = _crc32(file) if check_data else file.crc32
+            if info.file_size != file.size or (crc is not None and info.CRC != crc):
+                yield file, f"{member} in {bundle} differs from its source"
+                continue
+            if check_data:
+                try:
+                    # zipfile checks the CRC-32 of what it reads
+                    with zip.open(info) as fh:
+                        while fh.read(CHUNK_SIZE):
+                            pass
+                except zipfile.BadZipFile as exc:
+                    yield file, f"{member} in {bundle} is corrupt: {exc}"
+                    continue
+            yield file, None
+
+
+def _rebundle_group(output, files, check_data):
+    """Writes files, which all share a destination, to output, then verifies them
+
+    Returns the sources of the files that were verified, and the errors of those that weren't.
+    """
+    output.write_many(files)
+    output.flush()
+    verified, errors = [], []
+    for file, error in _verify(output, files, check_data):
+        if error is None:
+            verified.append(_source(file))
+        else:
+            errors.append(error)
+    return verified, errors
+
+
+def rebundle(input, output, ncpus=1, delete=False):
+    """Copies the files of the input timestream to output, bundled at output's bundle level
+
+    Members of (uncompressed) zip bundles are copied raw, by the kernel where possible (see
+    `pyts2.archive.ZipAppender.write_raw`), reusing the CRC-32 and size recorded in their
+    bundle, so are never decompressed, read by python, or checksummed again. Files from tar
+    bundles, or unbundled files, are streamed into bundles (or copied) as by
+    `TimeStream.write_many`.
+
+    Files are written in groups that share a destination bundle (or directory), so each
+    destination is written by one process at a time, with up to ncpus groups in parallel.
+    Each group is flushed, then checked against its destination's metadata.
+
+    If delete is True, each file's data is also read back from its destination and checked
+    against the source's CRC-32 (which is computed for tar and unbundled sources), and then
+    each source bundle or file, all of whose files were copied and verified, is deleted.
+    Sources with files that weren't copied (e.g. those excluded by the input's format or time
+    filters) are kept.
+
+    Returns the number of files copied, and the list of sources deleted.
+    """
+    if op.realpath(input.path) == op.realpath(output.path):
+        raise ValueError("input and output timestreams must differ")
+    verified = Counter()  # (kind, path) of source -> number of its files verified
+    copied = 0
+
+    def finish(result):
+        nonlocal copied
+        try:
+            sources, errors = result()
+        except Exception as exc:
+            warnings.warn(f"failed to rebundle: {exc}")
+            return
+        copied += len(sources)
+        verified.update(sources)
+        for error in errors:
+            warnings.warn(f"failed to verify: {error}")
+
+    def groups():
+        key, group = None, []
+        for file in input.iter(tar_contents=False):
+            destination = output._destination(file)
+            if group and destination != key:
+                yield key, group
+                group = []
+            key = destination
+            group.append(file)
+        if group:
+            yield key, group
+
+    executor = ProcessPoolExecutor(ncpus) if ncpus > 1 else None
+    try:
+        running = deque()  # (destination, future), oldest first
+        for key, group in groups():
+            # a destination is only written by one process at a time
+            wait([future for destination, future in running if destination == key])
+            if executor is None:
+                finish(lambda: _rebundle_group(output, group, delete))
+                continue
+            running.append((key, executor.submit(_rebundle_group, output, group, delete)))
+            while len(running) > 2 * ncpus:
+                finish(running.popleft()[1].result)
+        while running:
+            finish(running.popleft()[1].result)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    deleted = []
+    if delete:
+        for (kind, source), count in verified.items():
+            if kind is None:
+                continue
+            if count != _source_members(kind, source):
+                warnings.warn(f"not deleting {source}, as not all its files were copied")
+                continue
+            if kind == "tar":
+                dirname, basename = op.split(source)
+                sidecar = op.join(dirname, f".{basename}{TarReader.suffix}")
+                if op.exists(sidecar):
+                    os.unlink(sidecar)
+            os.unlink(source)
+            deleted.append(source)
+    return copied, deleted
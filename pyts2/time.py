@@ -3,16 +3,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from bisect import bisect_right
 import datetime
 import calendar
+import functools
 import re
 import os.path as op
 
 import iso8601
+import numpy as np
 
 
 TS_DATEFMT = "%Y_%m_%d_%H_%M_%S"
 TS_DATETIME_RE = re.compile(r"(\d{4}_[0-1]\d_[0-3]\d_[0-2]\d_[0-5]\d_[0-5]\d)(_\d+)?(_\w+)?")
+TS_DATE_RE = re.compile(r"\d{4}_\d\d_\d\d_\d\d_\d\d_\d\d")
+# the names of the date directories of TimeStream._timestream_path, and of the bundles of
+# TimeStream._bundle_archive_path (<stream>_<partial date>[.<format>].zip, or .tar)
+TS_PARTIAL_DIR_RE = re.compile(r"\d{4}(?:_\d\d){0,3}")
+TS_PARTIAL_BUNDLE_RE = re.compile(r".+_(\d{4}(?:_\d\d){0,5})(?:\.[^.]+)?\.(?:zip|tar)",
+                                  re.IGNORECASE)
 
 
 def extract_datetime(path):
@@ -24,10 +33,123 @@ def extract_datetime(path):
         return m[0]
 
 
+def extract_partial_date(name, parent=None):
+    """Extracts the partial date of a timestream directory or bundle name, or returns None
+
+    Only names laid out as a timestream's are dated: directories named by a partial date alone,
+    and bundles named <stream>_<partial date>[.<format>].zip (or .tar). If given, parent is the
+    partial date of the directory name is in, and a name whose date isn't within it (e.g.
+    "pos_0012.zip" in "2019") is undated.
+
+    >>> extract_partial_date("2019_12_31_23")
+    '2019_12_31_23'
+    >>> extract_partial_date("stream_2019_12.jpg.zip")
+    '2019_12'
+    >>> extract_partial_date("cam_1234") is None
+    True
+    >>> extract_partial_date("pos_0012.zip", parent="2019") is None
+    True
+    """
+    name = op.basename(name)
+    if TS_PARTIAL_DIR_RE.fullmatch(name):
+        datestr = name
+    else:
+        m = TS_PARTIAL_BUNDLE_RE.fullmatch(name)
+        if m is None:
+            return None
+        datestr = m[1]
+    if parent is not None and not datestr.startswith(parent):
+        return None
+    return datestr
+
+
+def parse_ts_datetime(datestr):
+    """Parses a date string in the timestream layout (%Y_%m_%d_%H_%M_%S) by slicing its digits
+
+    This is many times faster than strptime, but the layout isn't checked beyond that.
+
+    >>> parse_ts_datetime("2019_12_31_23_59_01")
+    datetime.datetime(2019, 12, 31, 23, 59, 1)
+    """
+    return datetime.datetime(int(datestr[0:4]), int(datestr[5:7]), int(datestr[8:10]),
+                             int(datestr[11:13]), int(datestr[14:16]), int(datestr[17:19]))
+
+
+def parse_ts_filename(path):
+    """Parses the TSInstant of a timestream file's name in one pass, or returns None
+
+    >>> parse_ts_filename("/a/b/cam_2019_12_31_23_59_01_00_left.jpg")
+    2019_12_31_23_59_01_00_left
+    >>> parse_ts_filename("not-a-timestream.jpg") is None
+    True
+    """
+    m = TS_DATETIME_RE.search(op.splitext(op.basename(path))[0])
+    if m is None:
+        return None
+    datestr, subsec, index = m.groups()
+    subsec = int(subsec[1:]) if subsec is not None else 0
+    if index is not None:
+        index = index[1:]
+    return TSInstant(parse_ts_datetime(datestr), subsec, index)
+
+
+def parse_ts_filenames(paths):
+    """Parses the instants of many timestream file names at once, into numpy arrays
+
+    Returns (datetimes, subseconds, indices): a datetime64[s] array, which is NaT for names
+    without a (valid) timestream date, an int32 array, and an object array of indices (None
+    where a name has no index). The digits of all dates are converted in one vectorised step.
+    """
+    n = len(paths)
+    valid = np.zeros(n, dtype=bool)
+    subsecs = np.zeros(n, dtype=np.int32)
+    indices = np.full(n, None, dtype=object)
+    datestrs = []
+    for i, path in enumerate(paths):
+        m = TS_DATETIME_RE.search(op.splitext(op.basename(path))[0])
+        if m is None:
+            datestrs.append("1970_01_01_00_00_00")
+            continue
+        datestr, subsec, index = m.groups()
+        datestrs.append(datestr)
+        valid[i] = True
+        if subsec is not None:
+            subsecs[i] = int(subsec[1:])
+        if index is not None:
+            indices[i] = index[1:]
+
+    digits = np.frombuffer("".join(datestrs).encode("ascii"), dtype=np.uint8)
+    digits = digits.reshape(n, 19).astype(np.int64) - ord("0")
+
+    def field(start, end):
+        return digits[:, start:end] @ (10 ** np.arange(end - start - 1, -1, -1))
+
+    year, month, day = field(0, 4), field(5, 7), field(8, 10)
+    hour, minute, second = field(11, 13), field(14, 16), field(17, 19)
+    months = (year - 1970).astype("M8[Y]").astype("M8[M]") + (month - 1).astype("m8[M]")
+    monthdays = ((months + 1).astype("M8[D]") - months.astype("M8[D]")).astype(np.int64)
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= monthdays) & (hour < 24)
+    times = months.astype("M8[D]") + (day - 1).astype("m8[D]")
+    times = times.astype("M8[s]") + (hour * 3600 + minute * 60 + second).astype("m8[s]")
+    times[~valid] = np.datetime64("NaT")
+    return times, subsecs, indices
+
+
 def parse_date(datestr):
     '''Parses dates in iso8601-ish formats to datetime.datetime objects'''
     if isinstance(datestr, datetime.datetime):
         return datestr
+    if isinstance(datestr, datetime.date):
+        return datetime.datetime.combine(datestr, datetime.time.min)
+    if isinstance(datestr, TSInstant):
+        return datestr.datetime
+
+    # timestream dates are by far the most common, and iso8601 never parses them
+    if isinstance(datestr, str) and TS_DATE_RE.fullmatch(datestr):
+        try:
+            return parse_ts_datetime(datestr)
+        except ValueError:
+            pass
 
     # first, try iso8601 of some form
     try:
@@ -50,16 +172,35 @@ def parse_date(datestr):
     raise ValueError("date string '" + datestr + "' doesn't match valid date formats")
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def instant_ticks(datetime_, subsecond=0):
+    """An integer that orders (datetime, subsecond) pairs, as TSInstant.ticks
+
+    It is the microseconds since 1970, shifted left 32 bits to make room for the subsecond,
+    which must be in [0, 2**32).
+    """
+    return (((datetime_ - EPOCH) // ONE_MICROSECOND) << 32) + subsecond
+
+
 class TSInstant(object):
     """
     TSInstant: a generalised "moment in time", including both timepoint and
     optional index within a timepoint.
 
-    >>> TSInstant(datetime.datetime(2017, 01, 02, 03, 04, 05))
+    Instants are compared and hashed by `ticks`, an integer computed once from the datetime and
+    subsecond (see `instant_ticks`), then by index, so they should be treated as immutable. As
+    before, instants where either has no index compare equal in order at the same ticks.
+    `sortkey` gives a key for sorting (or heaps) without calling comparison methods.
+
+    >>> TSInstant(datetime.datetime(2017, 1, 2, 3, 4, 5))
     2017_01_02_03_04_05_00
-    >>> TSInstant(datetime.datetime(2017, 01, 02, 03, 04, 05), 0, "0011")
+    >>> TSInstant(datetime.datetime(2017, 1, 2, 3, 4, 5), 0, "0011")
     2017_01_02_03_04_05_00_0011
     """
+    __slots__ = ("datetime", "subsecond", "index", "ticks", "_str")
 
     def __init__(self, datetime, subsecond=0, index=None):
         self.datetime = parse_date(datetime)
@@ -67,51 +208,62 @@ class TSInstant(object):
             subsecond = 0
         self.subsecond = int(subsecond)
         self.index = index
+        self.ticks = instant_ticks(self.datetime, self.subsecond)
+        self._str = None
 
     def __str__(self):
-        idx = "" if self.index is None else f"_{self.index}"
-        subsec = f"_{self.subsecond:02d}"
-        return f"{self.datetime.strftime('%Y_%m_%d_%H_%M_%S')}{subsec}{idx}"
+        if self._str is None:
+            idx = "" if self.index is None else f"_{self.index}"
+            subsec = f"_{self.subsecond:02d}"
+            self._str = f"{self.datetime.strftime('%Y_%m_%d_%H_%M_%S')}{subsec}{idx}"
+        return self._str
+
+    @property
+    def sortkey(self):
+        """Key that sorts instants by time, subsecond and index, e.g. for sorted() and heaps"""
+        return (self.ticks, "" if self.index is None else self.index)
 
+    def __getstate__(self):
+        return (self.datetime, self.subsecond, self.index)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
 
     def __eq__(self, other):
-        return (self.datetime, self.subsecond, self.index) == \
-               (other.datetime, other.subsecond, other.index)
+        if not isinstance(other, TSInstant):
+            return NotImplemented
+        return self.ticks == other.ticks and self.index == other.index
 
     def __lt__(self, other):
-        if self.index is not None and other.index is not None:
-            return (self.datetime, self.subsecond, self.index) < \
-                (other.datetime, other.subsecond, other.index)
-        else:
-            return (self.datetime, self.subsecond) < \
-                (other.datetime, other.subsecond)
+        if self.ticks != other.ticks:
+            return self.ticks < other.ticks
+        if self.index is None or other.index is None:
+            return False
+        return self.index < other.index
 
     def __le__(self, other):
-        if self.index is not None and other.index is not None:
-            return (self.datetime, self.subsecond, self.index) <= \
-                (other.datetime, other.subsecond, other.index)
-        else:
-            return (self.datetime, self.subsecond) <= \
-                (other.datetime, other.subsecond)
+        if self.ticks != other.ticks:
+            return self.ticks < other.ticks
+        if self.index is None or other.index is None:
+            return True
+        return self.index <= other.index
 
     def __gt__(self, other):
-        if self.index is not None and other.index is not None:
-            return (self.datetime, self.subsecond, self.index) > \
-                (other.datetime, other.subsecond, other.index)
-        else:
-            return (self.datetime, self.subsecond) > \
-                (other.datetime, other.subsecond)
+        if self.ticks != other.ticks:
+            return self.ticks > other.ticks
+        if self.index is None or other.index is None:
+            return False
+        return self.index > other.index
 
     def __ge__(self, other):
-        if self.index is not None and other.index is not None:
-            return (self.datetime, self.subsecond, self.index) >= \
-                (other.datetime, other.subsecond, other.index)
-        else:
-            return (self.datetime, self.subsecond) >= \
-                (other.datetime, other.subsecond)
+        if self.ticks != other.ticks:
+            return self.ticks > other.ticks
+        if self.index is None or other.index is None:
+            return True
+        return self.index >= other.index
 
     def __hash__(self):
-        return hash(str(self))
+        return hash((self.ticks, self.index))
 
     def __repr__(self):
         return str(self)
@@ -129,24 +281,10 @@ class TSInstant(object):
 
         :param path: File path, with or without directory
         """
-        fn = op.splitext(op.basename(path))[0]
-        m = TS_DATETIME_RE.search(fn)
-        if m is None:
+        instant = parse_ts_filename(path)
+        if instant is None:
             raise ValueError("path '" + path + "' doesn't contain a timestream date")
-
-        dt, subsec, index = m.groups()
-
-        datetime = parse_date(dt)
-
-        if subsec is not None:
-            try:
-                subsec = int(subsec.lstrip("_"))
-            except ValueError:
-                subsec = 0
-
-        if index is not None:
-            index = index.lstrip("_")
-        return TSInstant(datetime, subsec, index)
+        return instant
 
 def parse_partial_date(datestr, max=False):
     m = re.search(r"_?(?P<Y>\d\d\d\d)(?:_(?P<m>\d\d)(?:_(?P<d>\d\d))?(?:_(?P<H>\d\d))?(?:_(?P<M>\d\d))?(?:_(?P<S>\d\d))?)?",
@@ -176,21 +314,65 @@ def parse_partial_date(datestr, max=False):
     return d, t
 
 
+@functools.lru_cache(maxsize=65536)
+def partial_date_bounds(datestr):
+    """The days since 1970 and the microseconds of the day spanned by a partial date
+
+    Returns (first day, last day, first microsecond, last microsecond), where the latter two are
+    None if the partial date doesn't include an hour. Results are cached, as the same directory
+    and bundle names are seen repeatedly.
+    """
+    dmin, tmin = parse_partial_date(datestr, max=False)
+    dmax, tmax = parse_partial_date(datestr, max=True)
+    if tmin is None:
+        return date_days(dmin), date_days(dmax), None, None
+    return date_days(dmin), date_days(dmax), time_micros(tmin), time_micros(tmax)
+
+
+def date_days(date):
+    """Days since 1970-01-01 of a date"""
+    return date.toordinal() - EPOCH_ORDINAL
+
+
+def time_micros(time):
+    """Microseconds since midnight of a time"""
+    return ((time.hour * 60 + time.minute) * 60 + time.second) * 1000000 + time.microsecond
+
+
+EPOCH_ORDINAL = EPOCH.toordinal()
+MICROS_PER_DAY = 86400 * 1000000
+
+
 class TimeFilter(object):
-    def __init__(self, startdate=None, enddate=None, starttime=None, endtime=None):
+    """Selects instants by their date, and their time of day.
+
+    A filter has a set of date intervals, and a set of daily time intervals (each inclusive, and
+    by default unrestricted). An instant is within the filter if its date is within any of the
+    date intervals and its time within any of the time intervals. startdate, enddate, starttime
+    and endtime give one interval of each, and `dates` and `times` any number more, e.g. an
+    experiment's imaging schedule, as (start, end) pairs where either may be None for no limit.
+
+    The intervals are compiled into sorted, disjoint integer intervals (of days since 1970, and
+    microseconds since midnight), so testing one datetime is a pair of binary searches, and
+    `mask` tests a whole numpy array of times in a few vectorised operations.
+    """
+    unbounded = 2 ** 62
+
+    def __init__(self, startdate=None, enddate=None, starttime=None, endtime=None,
+                 dates=None, times=None):
         def convert_date(d):
-            if isinstance(d, datetime.date):
-                return d
-            elif isinstance(d, TSInstant):
-                return time.datetime.date()
+            if isinstance(d, TSInstant):
+                return d.datetime.date()
             elif isinstance(d, datetime.datetime):
                 return d.date()
+            elif isinstance(d, datetime.date):
+                return d
             elif isinstance(d, str):
                 return parse_date(d).date()
             elif d is None:
                 return None
             else:
-                TypeError("Bad date")
+                raise TypeError("Bad date")
 
         def convert_time(t):
             if isinstance(t, datetime.time):
@@ -204,7 +386,7 @@ class TimeFilter(object):
             elif t is None:
                 return None
             else:
-                TypeError("Bad date")
+                raise TypeError("Bad date")
 
         self.startdate = convert_date(startdate)
         self.enddate = convert_date(enddate)
@@ -216,29 +398,207 @@ class TimeFilter(object):
         if self.starttime is not None and self.endtime is not None and self.starttime > self.endtime:
             raise ValueError("Can't have starttime > endtime")
 
+        dates = [(convert_date(s), convert_date(e)) for s, e in (dates or [])]
+        if self.startdate is not None or self.enddate is not None or not dates:
+            dates.append((self.startdate, self.enddate))
+        times = [(convert_time(s), convert_time(e)) for s, e in (times or [])]
+        if self.starttime is not None or self.endtime is not None or not times:
+            times.append((self.starttime, self.endtime))
+        self.days = self._compile([(None if s is None else date_days(s),
+                                    None if e is None else date_days(e)) for s, e in dates])
+        self.micros = self._compile([(None if s is None else time_micros(s),
+                                      None if e is None else time_micros(e)) for s, e in times])
+
+    @classmethod
+    def _compile(cls, intervals):
+        """Sorts and merges inclusive integer intervals, into arrays of their starts and ends"""
+        merged = []
+        for start, end in sorted((-cls.unbounded if s is None else s, cls.unbounded if e is None else e)
+                                 for s, e in intervals):
+            if start > end:
+                raise ValueError("Can't have an interval's start > its end")
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        starts = np.array([s for s, e in merged], dtype=np.int64)
+        ends = np.array([e for s, e in merged], dtype=np.int64)
+        return starts, ends, [s for s, e in merged], [e for s, e in merged]
+
+    @staticmethod
+    def _overlaps(intervals, lo, hi):
+        """Does [lo, hi] overlap any of the compiled intervals?"""
+        _, _, starts, ends = intervals
+        i = bisect_right(starts, hi) - 1
+        return i >= 0 and ends[i] >= lo
+
+    @staticmethod
+    def _within(intervals, values):
+        """Vectorised test of which values fall within any of the compiled intervals"""
+        starts, ends, _, _ = intervals
+        i = np.searchsorted(starts, values, side="right") - 1
+        return (i >= 0) & (values <= ends[np.maximum(i, 0)])
+
     def __call__(self, datetime):
-        d = datetime.date()
-        t = datetime.time()
-        if self.startdate is not None and d < self.startdate:
-            return False
-        if self.enddate is not None and d > self.enddate:
-            return False
-        if self.starttime is not None and t < self.starttime:
+        day = datetime.toordinal() - EPOCH_ORDINAL
+        micros = time_micros(datetime)
+        return self._overlaps(self.days, day, day) and self._overlaps(self.micros, micros, micros)
+
+    def mask(self, times):
+        """Returns a boolean array of which of times are within this filter
+
+        times is an array of numpy datetime64s (where NaT is never within), or of integer
+        microseconds since 1970 (e.g. `pyts2.index.InstantIndex.times`).
+        """
+        micros, valid = self._as_micros(times)
+        days, micros = np.divmod(micros, MICROS_PER_DAY)
+        return valid & self._within(self.days, days) & self._within(self.micros, micros)
+
+    @staticmethod
+    def _as_micros(times):
+        """Returns times as int64 microseconds since 1970, and which are valid (i.e. not NaT)"""
+        times = np.asarray(times)
+        if np.issubdtype(times.dtype, np.datetime64):
+            return times.astype("M8[us]").astype(np.int64), ~np.isnat(times)
+        return times.astype(np.int64), np.ones(times.shape, dtype=bool)
+
+    def name_within(self, name, parent=None):
+        """Could the file, directory or bundle called `name` contain instants within this filter?
+
+        Names that encode neither a full timestream datetime nor a partial date (e.g. year,
+        month, day and hour directories or bundles, see `extract_partial_date`, where parent is
+        the partial date of the directory name is in), or whose digits aren't a valid date (e.g.
+        "run_2019_13"), can't be excluded, so are always within.
+        """
+        datestr = extract_partial_date(name, parent)
+        if datestr is None:
+            m = TS_DATETIME_RE.search(name)
+            if m is None:
+                return True
+            datestr = m[1]
+        try:
+            return self.partial_within(datestr)
+        except ValueError:
+            return True
+
+    def partial_within(self, datestr):
+        """Could any instant within the partial date (e.g. "2019_11_29_08") be within this filter?"""
+        dmin, dmax, tmin, tmax = partial_date_bounds(datestr)
+        if not self._overlaps(self.days, dmin, dmax):
             return False
-        if self.endtime is not None and t > self.endtime:
+        if tmin is not None and not self._overlaps(self.micros, tmin, tmax):
             return False
         return True
 
-    def partial_within(self, datestr):
-        dmin, tmin = parse_partial_date(datestr, max=False)
-        dmax, tmax = parse_partial_date(datestr, max=True)
 
-        if self.startdate is not None and dmax < self.startdate:
-            return False
-        if self.enddate is not None and dmin > self.enddate:
-            return False
-        if self.starttime is not None and tmax is not None and tmax < self.starttime:
+class DaylightFilter(TimeFilter):
+    """A TimeFilter that also excludes instants at night, from the sun's position at a site.
+
+    Sunrise and sunset are calculated for latitude and longitude (in degrees, north and east
+    positive) with NOAA's approximate solar position equations, which are good to a minute or
+    two away from the poles. They are computed for a whole year of days at once, and cached.
+    Instants are taken to be in the local time of `timezone`: a zoneinfo name (e.g.
+    "Australia/Sydney"), a tzinfo, or a fixed number of hours ahead of UTC; None means UTC.
+    Daylight is while the sun's centre is above `elevation` degrees (-0.833 is sunrise to
+    sunset, -6 civil twilight), widened by `margin` minutes at either end. Other arguments are
+    as for TimeFilter, and instants must be within both.
+    """
+
+    def __init__(self, latitude, longitude, timezone=None, elevation=-0.833, margin=0, **kwargs):
+        super().__init__(**kwargs)
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError("latitude and longitude must be in degrees")
+        self.latitude = latitude
+        self.longitude = longitude
+        if isinstance(timezone, str):
+            import zoneinfo
+            timezone = zoneinfo.ZoneInfo(timezone)
+        elif isinstance(timezone, (int, float)):
+            timezone = datetime.timezone(datetime.timedelta(hours=timezone))
+        self.timezone = timezone
+        self.elevation = elevation
+        self.margin = margin
+        self._years = {}
+
+    def _year(self, year):
+        """Returns (first day, daylight starts, daylight ends) for each day of year
+
+        Days are since 1970, and starts and ends are local microseconds since 1970. Days
+        without daylight (in polar night) have a start after their end.
+        """
+        if year in self._years:
+            return self._years[year]
+        first = date_days(datetime.date(year, 1, 1))
+        ndays = date_days(datetime.date(year + 1, 1, 1)) - first
+        # fractional year (radians) at noon of each day
+        gamma = 2 * np.pi / ndays * np.arange(ndays)
+        eqtime = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                           - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+        decl = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma)
+                - 0.006758 * np.cos(2 * gamma) + 0.000907 * np.sin(2 * gamma)
+                - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+        lat = np.radians(self.latitude)
+        cos_hourangle = ((np.sin(np.radians(self.elevation)) - np.sin(lat) * np.sin(decl))
+                         / (np.cos(lat) * np.cos(decl)))
+        hourangle = np.degrees(np.arccos(np.clip(cos_hourangle, -1, 1)))
+        noon = 720 - 4 * self.longitude - eqtime  # UTC minutes
+        offsets = np.zeros(ndays)
+        if self.timezone is not None:
+            offsets = np.array([self.timezone.utcoffset(datetime.datetime(year, 1, 1, 12)
+                                                        + datetime.timedelta(days=i))
+                                / datetime.timedelta(minutes=1) for i in range(ndays)])
+        midnights = (first + np.arange(ndays)) * 1440.0 + offsets
+        starts = (midnights + noon - 4 * hourangle - self.margin) * 60e6
+        ends = (midnights + noon + 4 * hourangle + self.margin) * 60e6
+        starts[cos_hourangle > 1] = np.inf  # the sun never rises
+        self._years[year] = first, starts, ends
+        return self._years[year]
+
+    def _days(self, firstday, lastday):
+        """Returns daylight starts and ends (see `_year`) of each day from firstday to lastday"""
+        years = range(datetime.date.fromordinal(firstday + EPOCH_ORDINAL).year,
+                      datetime.date.fromordinal(lastday + EPOCH_ORDINAL).year + 1)
+        first = self._year(years[0])[0]
+        starts = np.concatenate([self._year(year)[1] for year in years])
+        ends = np.concatenate([self._year(year)[2] for year in years])
+        return (starts[firstday - first:lastday - first + 1],
+                ends[firstday - first:lastday - first + 1])
+
+    def _daylight(self, lo, hi):
+        """Does daylight overlap each [lo, hi], arrays of local microseconds within one day?"""
+        # daylight can spill into the day before or after, in timezones far from solar time
+        firstday = int(lo.min()) // MICROS_PER_DAY - 1
+        lastday = int(hi.max()) // MICROS_PER_DAY + 1
+        starts, ends = self._days(firstday, lastday)
+        days = lo // MICROS_PER_DAY - firstday
+        overlaps = np.zeros(lo.shape, dtype=bool)
+        for shift in (-1, 0, 1):
+            overlaps |= (starts[days + shift] <= hi) & (ends[days + shift] >= lo)
+        return overlaps
+
+    def __call__(self, datetime):
+        if not super().__call__(datetime):
             return False
-        if self.endtime is not None and tmin is not None and tmin > self.endtime:
+        micros = np.array([date_days(datetime) * MICROS_PER_DAY + time_micros(datetime)])
+        return bool(self._daylight(micros, micros)[0])
+
+    def mask(self, times):
+        mask = super().mask(times)
+        micros, _ = self._as_micros(times)
+        if mask.any():
+            mask[mask] = self._daylight(micros[mask], micros[mask])
+        return mask
+
+    def partial_within(self, datestr):
+        if not super().partial_within(datestr):
             return False
-        return True
+        dmin, dmax, tmin, tmax = partial_date_bounds(datestr)
+        if tmin is None:
+            tmin, tmax = 0, MICROS_PER_DAY - 1
+        lo = np.array([dmin * MICROS_PER_DAY + tmin])
+        hi = np.array([dmax * MICROS_PER_DAY + tmax])
+        if dmax > dmin:
+            # any of the days in the range
+            days = np.arange(dmin, dmax + 1) * MICROS_PER_DAY
+            lo, hi = days + tmin, days + tmax
+        return bool(self._daylight(lo, hi).any())
@@ -3,23 +3,32 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
 import datetime as dt
 import io
 import os
 import os.path as op
+import queue
 import re
+import shutil
 import tarfile
 import warnings
 import zipfile
-from queue import Queue
-from threading import Thread
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import RLock
 import hashlib
+import heapq
+import itertools
+import multiprocessing
+import time
+import weakref
 import zlib
 
 from pyts2.time import *
 from pyts2.utils import *
-from pyts2.filelock import FileLock
+from pyts2.archive import archive_pool, ZipAppender
 
 
 def path_is_timestream_file(path, extensions=None):
@@ -41,46 +50,201 @@ def path_is_timestream_file(path, extensions=None):
     >>> path_is_timestream_file("not-a-timestream.jpg")
     False
     """
-    if isinstance(extensions, str):
-        extensions = [extensions, ]
     try:
         m = TS_DATETIME_RE.search(path)
         if m is None:
             return False
-        if extensions is not None:
-            return any([path.lower().endswith(ext) for ext in extensions])
-        return True
+        return path_has_extension(path, extensions)
     except ValueError:
         return False
 
 
-class ZipContentFetcher(object):
-    def __init__(self, zipfile, pathinzip):
+def path_has_extension(path, extensions=None):
+    """Test if path ends with one of extensions, or with anything if extensions is None
+
+    >>> path_has_extension("test.JPG", ["tif", "jpg"])
+    True
+    """
+    if extensions is None:
+        return True
+    if isinstance(extensions, str):
+        extensions = [extensions, ]
+    return any([path.lower().endswith(ext) for ext in extensions])
+
+
+def path_may_be_archive(path):
+    """False for files named like timestream images, which needn't be sniffed for archives
+
+    >>> path_may_be_archive("test_2018_12_31_23_59_59_00.jpg")
+    False
+    >>> path_may_be_archive("test_2018_12_31.zip")
+    True
+    """
+    return not path_is_timestream_file(path) or path.lower().endswith((".zip", ".tar"))
+
+
+class ContentFetcher(object):
+    """Gets a file's content, and metadata, from where it is stored
+
+    size, crc32 (the CRC-32 of the content) and mtime (in seconds since the epoch) come from
+    the metadata of the file or bundle, never its content, and are None where the metadata
+    doesn't have them (e.g. the CRC-32 of loose files). Any given when the fetcher is made
+    (e.g. from walking a bundle's directory, or the index) are used as is.
+    """
+
+    def __init__(self, size=None, crc32=None, mtime=None):
+        self._size = size
+        self._crc32 = crc32
+        self._mtime = mtime
+        self._statted = False
+
+    def _stat(self):
+        """Returns (size, crc32, mtime) from the file's metadata"""
+        raise NotImplementedError
+
+    def _metadata(self, value):
+        """Fills in metadata from _stat() (only once), if value isn't known"""
+        if value is None and not self._statted:
+            self._statted = True
+            size, crc32, mtime = self._stat()
+            if self._size is None:
+                self._size = size
+            if self._crc32 is None:
+                self._crc32 = crc32
+            if self._mtime is None:
+                self._mtime = mtime
+
+    @property
+    def size(self):
+        self._metadata(self._size)
+        return self._size
+
+    @property
+    def crc32(self):
+        self._metadata(self._crc32)
+        return self._crc32
+
+    @property
+    def mtime(self):
+        self._metadata(self._mtime)
+        return self._mtime
+
+
+class ZipContentFetcher(ContentFetcher):
+    def __init__(self, zipfile, pathinzip, mmap=False, **metadata):
+        super().__init__(**metadata)
         self.zipfile = zipfile
         self.pathinzip = pathinzip
+        self.mmap = mmap
+
+    def _stat(self):
+        with archive_pool.open_zip(self.zipfile) as zip:
+            info = zip.getinfo(self.pathinzip)
+        return info.file_size, info.CRC, time.mktime(info.date_time + (0, 0, -1))
 
     def get(self):
-        with zipfile.ZipFile(str(self.zipfile)) as zfh:
-            return zfh.read(self.pathinzip)
+        if self.mmap:
+            return archive_pool.view_zip(self.zipfile, self.pathinzip)
+        return archive_pool.read_zip(self.zipfile, self.pathinzip)
+
+    def open(self):
+        return archive_pool.stream_zip(self.zipfile, self.pathinzip)
+
 
-class TarContentFetcher(object):
-    def __init__(self, tarfile, pathintar):
+class TarContentFetcher(ContentFetcher):
+    def __init__(self, tarfile, pathintar, **metadata):
+        super().__init__(**metadata)
         self.tarfile = tarfile
         self.pathintar = pathintar
 
+    def _stat(self):
+        info = archive_pool.tar_header(self.tarfile, self.pathintar)
+        return info.size, None, float(info.mtime)
+
     def get(self):
-        with tarfile.TarFile(self.tarfile) as tfh:
-            return tfh.extractfile(self.pathintar).read()
+        return archive_pool.read_tar(self.tarfile, self.pathintar)
+
+    def open(self):
+        return archive_pool.stream_tar(self.tarfile, self.pathintar)
 
 
-class FileContentFetcher(object):
-    def __init__(self, path):
+class FileContentFetcher(ContentFetcher):
+    def __init__(self, path, **metadata):
+        super().__init__(**metadata)
         self.path = Path(path)
 
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_size, None, st.st_mtime
+
     def get(self):
         with open(self.path, "rb") as fh:
             return fh.read()
 
+    def open(self):
+        return open(self.path, "rb")
+
+
+def _unread(file):
+    """Whether file's content hasn't been read, and can be streamed from its fetcher"""
+    return file._content is None and hasattr(file.fetcher, "open")
+
+
+def _source_path(file):
+    """The path of file on disk, if its content is just that file and hasn't been read"""
+    if _unread(file) and isinstance(file.fetcher, FileContentFetcher):
+        return str(file.fetcher.path)
+    return None
+
+
+def _raw_zip_member(file):
+    """(path, offset, size, crc) of file's data, if it's an unread stored member of a zip
+    bundle whose CRC-32 is known, so it can be copied raw"""
+    fetcher = file.fetcher
+    if not _unread(file) or not isinstance(fetcher, ZipContentFetcher) or fetcher.crc32 is None:
+        return None
+    span = archive_pool.zip_span(fetcher.zipfile, fetcher.pathinzip)
+    if span is None:
+        return None
+    return (str(fetcher.zipfile), *span, fetcher.crc32)
+
+
+def prefetch_content(files, count, max_bytes=None, threads=4):
+    """Reads the content of upcoming files on background threads, yielding files in order
+
+    At most `count` files are read ahead of the one last yielded, and no more are started while
+    the content already read ahead totals `max_bytes` or more. As at most `threads` files are
+    being read at once, this may overshoot max_bytes by up to `threads` files. Errors in reading
+    are not raised here, but when the file's content is next accessed.
+    """
+    def fetch(file):
+        try:
+            return len(file.content)
+        except Exception:
+            return 0
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        files = iter(files)
+        window = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(window) < count:
+                if sum(1 for _, f in window if not f.done()) >= threads:
+                    break
+                if max_bytes is not None:
+                    resident = sum(f.result() for _, f in window if f.done())
+                    if resident >= max_bytes:
+                        break
+                file = next(files, None)
+                if file is None:
+                    exhausted = True
+                    break
+                window.append((file, executor.submit(fetch, file)))
+            if len(window) == 0:
+                return
+            file, future = window.popleft()
+            future.result()
+            yield file
 
 
 class TimestreamFile(object):
@@ -116,6 +280,26 @@ class TimestreamFile(object):
         del self._content
         self._content = None
 
+    async def aread(self, executor=None):
+        """Returns the file's content, reading it on executor so the event loop isn't blocked
+
+        executor defaults to the event loop's default executor, a bounded thread pool, so
+        thousands of files may be read concurrently without a thread per file.
+        """
+        if self._content is None and self.fetcher is not None:
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(executor, self.fetcher.get)
+            if self._content is None:
+                self._content = content
+        return self._content
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self._content, memoryview):
+            # views of mmapped bundles can't be pickled, so send a copy
+            state["_content"] = self._content.tobytes()
+        return state
+
     # TODO: work out where this should go. be careful, as setting here should sync to
     # disc perhaps?
     #@content.setter
@@ -142,12 +326,55 @@ class TimestreamFile(object):
         """convenience helper to get iso8601 string"""
         return self.instant.isodate("%Y-%m-%dT%H:%M:%S")
 
+    def open(self):
+        """Returns a seekable binary stream of the file's content
+
+        Content that hasn't been read is streamed from the file, or bundle member, it comes
+        from, rather than read into memory at once.
+        """
+        if self._content is None and hasattr(self.fetcher, "open"):
+            return self.fetcher.open()
+        return BufferReader(self.content)
+
+    def copy_to(self, fileobj, chunk_size=CHUNK_SIZE):
+        """Writes the file's content to the binary file fileobj, chunk_size at a time"""
+        if self._content is not None:
+            fileobj.write(self._content)
+            return
+        with self.open() as fh:
+            shutil.copyfileobj(fh, fileobj, chunk_size)
+
     def __len__(self):
+        return self.size
+
+    @property
+    def size(self):
+        """The size of the file's content, from its metadata unless it has been read"""
+        if self._content is None and getattr(self.fetcher, "size", None) is not None:
+            return self.fetcher.size
         return len(self.content)
 
-    def checksum(self, algorithm="md5"):
+    @property
+    def crc32(self):
+        """The CRC-32 of the file's content if it's known without reading it (e.g. from a zip
+        bundle's directory), or it has been read, otherwise None"""
+        if self._content is not None:
+            return zlib.crc32(self._content)
+        return getattr(self.fetcher, "crc32", None)
+
+    @property
+    def mtime(self):
+        """The modification time of the file (in seconds since the epoch) if known, else None"""
+        return getattr(self.fetcher, "mtime", None)
+
+    def checksum(self, algorithm="md5", chunk_size=CHUNK_SIZE):
         hasher = hashlib.new(algorithm)
-        hasher.update(self.content)
+        if self._content is not None or not hasattr(self.fetcher, "open"):
+            hasher.update(self.content)
+        else:
+            with self.open() as fh:
+                for chunk in iter(lambda: fh.read(chunk_size), b""):
+                    hasher.update(chunk)
         return hasher.hexdigest()
 
     def __repr__(self):
@@ -164,11 +391,47 @@ class TimestreamFile(object):
 
 class TimeStream(object):
     bundle_levels = ("root", "year", "month", "day", "hour", "none")
+    index_modes = ("auto", "update", "off")
+    sync_modes = ("none", "file", "group")
+    walkers = {"serial": serial_walk, "parallel": parallel_walk}
 
     def __init__(self, path=None, format=None, onerror="warn",
-                 bundle_level="none", name=None, timefilter=None):
-        """path is the base directory of a timestream"""
-        self._files = {}
+                 bundle_level="none", name=None, timefilter=None, index="auto",
+                 walker="serial", mmap=False, flush_interval=0, max_open_bundles=4,
+                 sync="none", sync_every=64, link=False):
+        """path is the base directory of a timestream
+
+        index controls use of the on-disk index (see `pyts2.index.TimeStreamIndex`): "auto"
+        uses it if it is present and fresh, "update" creates or refreshes it before use, and
+        "off" always walks the timestream.
+
+        walker selects how the timestream's directories are walked: "serial" (os.walk), or
+        "parallel", which lists sibling directories concurrently (see
+        `pyts2.utils.parallel_walk`), and is much faster on network filesystems.
+
+        If mmap is True, the content of files in (uncompressed) zip bundles is a zero-copy
+        memoryview of the memory-mapped bundle (see `pyts2.archive.ZipMapping`), not bytes.
+
+        By default, every write is complete (and any bundle it wrote to flushed) when it
+        returns. With flush_interval > 0, up to max_open_bundles bundles are kept open (and
+        locked) across writes (see `pyts2.archive.ZipAppender`), so can't be read elsewhere. A
+        bundle is then flushed (its central directory written, and its lock released) when more
+        bundles are opened, by the first write at least flush_interval seconds after it was
+        opened, and by flush() or close(), which must be called once writing is done.
+
+        Unbundled files are written to a temporary (hidden) file, then renamed into place, so
+        readers never see partially written files. sync sets how they are made durable:
+        "none" leaves it to the OS, "file" fsyncs every file (and its directory) as it is
+        written, and "group" commits files together: once sync_every files are pending, or
+        by the first write flush_interval seconds after the first was, all are fsynced at
+        once, then renamed into place, then their directories fsynced. Pending files are also
+        committed by flush() or close(). So files are only grouped with flush_interval > 0.
+
+        Files being written whose content is still just a file on disk are copied by the
+        kernel (see `pyts2.utils.copy_file`), or streamed into bundles, without being read
+        into memory. With link=True, unbundled output is hardlinked to such files where
+        possible, so they must not be modified afterwards.
+        """
         self._instants = None
         self.name = name
         self.path = None
@@ -184,9 +447,52 @@ class TimeStream(object):
             self.onerror = onerror
         else:
             raise ValueError("onerror should be one of raise, skip, or warn")
+        if index not in self.index_modes:
+            raise ValueError("index should be one of auto, update, or off")
+        self.index = index
+        if walker not in self.walkers:
+            raise ValueError("walker should be one of serial or parallel")
+        self.walker = walker
+        if sync not in self.sync_modes:
+            raise ValueError("sync should be one of none, file, or group")
+        self.sync = sync
+        self.sync_every = sync_every
+        self.link = link
+        self.mmap = mmap
+        self.flush_interval = flush_interval
+        self.max_open_bundles = max_open_bundles
+        self._bundles = OrderedDict()  # path -> ZipAppender, least recently used first
+        self._pending = []  # (temporary, final) paths of files awaiting a group commit
+        self._pending_since = None
+        self._write_lock = RLock()  # e.g. for pipelines writing from a thread pool
+        self._made_dirs = set()  # output directories known to exist
+        # flush any open bundles and pending files if we're garbage collected, or at exit
+        self._finalizer = weakref.finalize(self, self._flush_writes, self._bundles, self._pending)
         if path is not None:
             self.open(path, format=format)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_bundles"], state["_pending"], state["_write_lock"], state["_finalizer"]
+        return state
+
+    def __setstate__(self, state):
+        # An unpickled copy (e.g. in a worker process) may never be closed, so never keeps
+        # bundles open or files pending between writes
+        self.__dict__.update(state)
+        self.flush_interval = 0
+        self.sync_every = 1
+        self._bundles = OrderedDict()
+        self._pending = []
+        self._write_lock = RLock()
+        self._finalizer = weakref.finalize(self, self._flush_writes, self._bundles, self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def open(self, path, format=None):
         if self.name is None:
             self.name = op.basename(path)
@@ -200,58 +506,290 @@ class TimeStream(object):
 
     @property
     def instants(self):
+        from pyts2.index import InstantIndex
         if self._instants is None:
-            self._instants = {f.instant: f for f in self.iter(tar_contents=False)}
+            self._instants = InstantIndex(self.iter(tar_contents=False))
         return self._instants
 
+    def _wanted(self, file):
+        """Does file pass this timestream's format and time filters?"""
+        if not path_has_extension(file.filename, self.format):
+            return False
+        if self.timefilter is not None and not self.timefilter(file.instant.datetime):
+            return False
+        return True
+
+    def _fresh_index(self):
+        """Returns this timestream's TimeStreamIndex if it should be used, otherwise None"""
+        from pyts2.index import TimeStreamIndex
+        if self.index == "off" or self.path is None:
+            return None
+        index = TimeStreamIndex(self.path)
+        if self.index == "update":
+            index.update()
+            return index
+        if index.is_fresh():
+            return index
+        index.close()
+        return None
+
+    def at(self, instant):
+        """Gets the file at exactly instant, raising KeyError if there is none
+
+        instant is a TSInstant, or a datetime or date string, for the file at that time with no
+        subsecond or index.
+        """
+        if not isinstance(instant, TSInstant):
+            instant = TSInstant(parse_date(instant))
+        return self.instants[instant]
+
+    def nearest(self, instant, tolerance=None):
+        """Gets the file closest in time to instant (a TSInstant, datetime, or date string)
+
+        Raises KeyError if the timestream is empty, or if tolerance (a datetime.timedelta) is
+        given and the closest file is further than that from instant.
+        """
+        when = parse_date(instant)
+        i = self.instants.nearest(when)
+        if i is None:
+            raise KeyError(instant)
+        file = self.instants.file(i)
+        if tolerance is not None and abs(file.instant.datetime - when) > tolerance:
+            raise KeyError(instant)
+        return file
+
+    def between(self, start=None, end=None):
+        """Yields files from start to end inclusive (each a TSInstant, datetime, or date string)
+
+        Either may be None, for no limit. Unless the instants are already indexed, only the
+        directories and bundles whose names allow files in this range are walked, and
+        content is only read if asked for.
+        """
+        start = None if start is None else parse_date(start)
+        end = None if end is None else parse_date(end)
+        yield from self._range(start, end, inclusive=True)
+
+    def _range(self, start, end, inclusive=False):
+        """Yields files from datetime start to before end (or to end, if inclusive)"""
+        if start is not None and end is not None and start > end:
+            return
+        if self._instants is None:
+            index = self._fresh_index()
+            if index is None:
+                # rather than list the whole timestream, prune the walk to the range's days
+                # (and times, within one day), then check each file's time exactly
+                bounds = TimeFilter(start, end)
+                if start is not None and end is not None and start.date() == end.date():
+                    bounds = TimeFilter(start, end, start.time(), end.time())
+                for file in self._iter(tar_contents=False, bounds=bounds):
+                    when = file.instant.datetime
+                    if start is not None and when < start:
+                        continue
+                    if end is not None and (when > end if inclusive else when >= end):
+                        continue
+                    yield file
+                return
+            index.close()
+        for i in self.instants.range(start, end, inclusive=inclusive):
+            yield self.instants.file(i)
+
     def __getitem__(self, filename):
-        if len(self._files) == 0:
-            # the iterator sets up the files dict, so if we don't have any recorded files,
-            # scan through to set up the dict
-            for _ in self.iter(tar_contents=False):
+        """Gets a file by name, e.g. ts["2001_02_01_09_14_15_00.jpg"], or a list of files by
+        time range, e.g. ts[start:end], which like python slicing excludes files at end.
+        """
+        if isinstance(filename, slice):
+            if filename.step is not None:
+                raise ValueError("TimeStream slices can't have a step")
+            start, end = filename.start, filename.stop
+            start = None if start is None else parse_date(start)
+            end = None if end is None else parse_date(end)
+            return list(self._range(start, end))
+        if self._instants is None:
+            index = self._fresh_index()
+            if index is not None:
+                with index:
+                    file = index.get(filename, mmap=self.mmap)
+                if not self._wanted(file):
+                    raise KeyError(filename)
+                return file
+        return self.instants.file(self.instants.find(filename), filename=filename)
+
+    def iter(self, tar_contents=True, prefetch=0, prefetch_bytes=None, prefetch_threads=4):
+        """Iterates over the files of this timestream, in instant order
+
+        If prefetch > 0, the content of up to that many upcoming files (and if given, up to about
+        prefetch_bytes of content) is read ahead on prefetch_threads background threads, so
+        files are yielded with their content already resident (see `prefetch_content`).
+        """
+        files = self._iter(tar_contents)
+        if prefetch > 0:
+            files = prefetch_content(files, prefetch, max_bytes=prefetch_bytes,
+                                     threads=prefetch_threads)
+        return files
+
+    async def aiter(self, prefetch=0, threads=4, batch=64):
+        """Asynchronously iterates over the files of this timestream, in instant order
+
+        For use from asyncio (`async for file in ts.aiter()`): walking directories and listing
+        archives happens on a background thread, `batch` files at a time, never on the event
+        loop. If prefetch is > 0, the content of up to `prefetch` files ahead is read
+        concurrently on a pool of `threads` threads, and files are yielded with their content
+        resident.
+        Otherwise, use `await file.aread()` to read content. Errors in reading content are not
+        raised here, but when the file's content is next accessed.
+        """
+        async def fetch(file):
+            try:
+                await file.aread(executor)
+            except Exception:
                 pass
-        return TimestreamFile(filename=filename, fetcher=self._files[filename])
 
-    def iter(self, tar_contents=True):
+        loop = asyncio.get_running_loop()
+        # one thread lists files, as the walk (and the index's sqlite cursor) isn't thread-safe
+        lister = ThreadPoolExecutor(max_workers=1)
+        executor = ThreadPoolExecutor(max_workers=threads)
+        window = deque()
+        files = self.iter(tar_contents=False)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(lister, list,
+                                                   itertools.islice(files, batch))
+                if not chunk:
+                    break
+                for file in chunk:
+                    if prefetch <= 0:
+                        yield file
+                        continue
+                    window.append((file, asyncio.ensure_future(fetch(file))))
+                    if len(window) >= prefetch:
+                        file, task = window.popleft()
+                        await task
+                        yield file
+            while window:
+                file, task = window.popleft()
+                await task
+                yield file
+        finally:
+            for _, task in window:
+                task.cancel()
+            # e.g. if iteration stopped early, close the walk (and any index's sqlite
+            # connection) on the thread that it ran on
+            await loop.run_in_executor(lister, files.close)
+            lister.shutdown(wait=False)
+            executor.shutdown(wait=False)
+
+    def _iter(self, tar_contents=True, bounds=None):
+        """Yields files in instant order, only those also within the TimeFilter bounds if given"""
+        self.flush()  # bundles we have open for writing can't be read
+        filters = [f for f in (self.timefilter, bounds) if f is not None]
+        index = self._fresh_index()
+        if index is not None:
+            with index:
+                for file in index.files(mmap=self.mmap, timefilters=filters):
+                    if path_has_extension(file.filename, self.format):
+                        yield file
+            return
+
+        def within(datetime):
+            return all(f(datetime) for f in filters)
+
+        def name_within(name, parent):
+            return all(f.name_within(name, parent) for f in filters)
+
         def walk_archive(path):
-            if zipfile.is_zipfile(str(path)):
-                with zipfile.ZipFile(str(path)) as zip:
-                    # ensure sorted iteration
+            kind = archive_pool.kind(path)
+            if kind == "zip":
+                with archive_pool.open_zip(path) as zip:
                     entries = zip.infolist()
-                    entries.sort(key=lambda entry: extract_datetime(entry.filename))
-                    for entry in entries:
-                        if entry.is_dir():
-                            continue
-                        if not path_is_timestream_file(entry.filename, extensions=self.format):
-                            continue
-                        if self.timefilter is not None and not self.timefilter.partial_within(op.basename(entry.filename)):
-                            continue
-                        self._files[op.basename(entry.filename)] = ZipContentFetcher(path, entry.filename)
-                        yield TimestreamFile(filename=entry.filename,
-                                                fetcher=ZipContentFetcher(path, entry.filename))
-            elif tarfile.is_tarfile(path):
-                self.sorted = False
-                warnings.warn("Extracting files from a tar file. Sorted iteration is not guaranteed")
-                with tarfile.TarFile(path) as tar:
-                    for entry in tar:
-                        if not entry.isfile():
-                            continue
-                        if not path_is_timestream_file(entry.name, extensions=self.format):
-                            continue
-                        if self.timefilter is not None and not self.timefilter.partial_within(op.basename(entry.name)):
-                            continue
-                        if tar_contents:
-                            filebytes = tar.extractfile(entry).read()
-                            yield TimestreamFile.from_bytes(filebytes, filename=entry.name)
-                        else:
-                            self._files[op.basename(entry.name)] = TarContentFetcher(path, entry.name)
-                            yield TimestreamFile(filename=entry.name,
-                                                    fetcher=TarContentFetcher(path, entry.name))
+                files = []
+                for entry in entries:
+                    if entry.is_dir():
+                        continue
+                    if not path_has_extension(entry.filename, self.format):
+                        continue
+                    instant = parse_ts_filename(entry.filename)
+                    if instant is None:
+                        continue
+                    if not within(instant.datetime):
+                        continue
+                    fetcher = ZipContentFetcher(path, entry.filename, mmap=self.mmap,
+                                                size=entry.file_size, crc32=entry.CRC)
+                    files.append(TimestreamFile(instant=instant, filename=entry.filename, fetcher=fetcher))
+                # ensure sorted iteration
+                files.sort(key=lambda file: file.instant.sortkey)
+                yield from files
+            elif kind == "tar":
+                # the tar's member index lets us read members in sorted, not archive, order
+                files = []
+                for member, (offset, size) in archive_pool.tar_members(path).items():
+                    if not path_has_extension(member, self.format):
+                        continue
+                    instant = parse_ts_filename(member)
+                    if instant is None:
+                        continue
+                    if not within(instant.datetime):
+                        continue
+                    fetcher = TarContentFetcher(path, member, size=size)
+                    files.append(TimestreamFile(instant=instant, filename=member, fetcher=fetcher))
+                files.sort(key=lambda file: file.instant.sortkey)
+                for file in files:
+                    if tar_contents:
+                        file.content  # tar_contents asks for the content to be resident
+                    yield file
             else: raise ValueError(f"'{path}' appears not to be an archive")
 
+        def walk_archive_or_warn(path):
+            try:
+                yield from walk_archive(path)
+            except Exception as exc:
+                warnings.warn(f"{exc.__class__.__name__}: {str(exc)} at '{path}'")
+
         def is_archive(path):
-            return op.exists(path) and op.isfile(path) and \
-                (zipfile.is_zipfile(str(path)) or tarfile.is_tarfile(path))
+            try:
+                return archive_pool.kind(path) is not None
+            except OSError:
+                return False
+
+        def lower_bound(name, parent, default):
+            """Sort key before any instant within the date-named directory or bundle `name`
+
+            Names that aren't dated (see `extract_partial_date`) take their parent's, default.
+            """
+            datestr = extract_partial_date(name, parent)
+            if datestr is None:
+                return default
+            try:
+                date, time = parse_partial_date(datestr)
+            except ValueError:
+                return default  # digits that aren't a date (e.g. "cam_0000"), so undated
+            return (instant_ticks(dt.datetime.combine(date, time or dt.time.min)) - 1, "")
+
+        # Files are merged from all sources (each bundle, and the loose files of each directory)
+        # with a heap. A source is a sorted iterator of files, and each has one entry in the heap,
+        # keyed by the instant of its next file. Bundles are only opened when they reach the top
+        # of the heap, keyed by the earliest instant their name allows until then. A file is
+        # yielded once it sorts before every directory the walk has yet to visit.
+        heap = []
+        seq = itertools.count()  # breaks ties, so we never compare iterators
+        pending = {}  # directory -> lower bound of its contents, for directories yet to be walked
+        dates = {}  # directory -> partial date of it (or its closest dated parent), if any
+        minkey = (instant_ticks(dt.datetime.min) - 1, "")
+        maxkey = (instant_ticks(dt.datetime.max) - 1, "")
+
+        def push(files):
+            for file in files:
+                heapq.heappush(heap, (file.instant.sortkey, next(seq), files, file))
+                break
+
+        def pop_until(watermark):
+            while heap and heap[0][0] <= watermark:
+                _, _, files, file = heapq.heappop(heap)
+                if files is None:
+                    # an unopened bundle: file is its path
+                    push(walk_archive_or_warn(file))
+                else:
+                    yield file
+                    push(files)
 
         try:
             if is_archive(self.path):
@@ -259,27 +797,42 @@ class TimeStream(object):
         except Exception as exc:
             warnings.warn(f"{exc.__class__.__name__}: {str(exc)} at '{self.path}'")
 
-        for root, dirs, files in os.walk(self.path):
+        for root, dirs, files in self.walkers[self.walker](self.path):
+            lowest = pending.pop(root, minkey)
+            parent = dates.pop(root, None)
             # ensure sorted iteration
             dirs.sort()
-            files.sort(key=lambda f: extract_datetime(f))
+            if filters:
+                # prune date-named directories outside the filter, so we never descend into them
+                dirs[:] = [d for d in dirs if name_within(d, parent)]
+            for d in dirs:
+                pending[op.join(root, d)] = lower_bound(d, parent, lowest)
+                dates[op.join(root, d)] = extract_partial_date(d, parent) or parent
+            loose = []
             for file in files:
-                path = op.join(root, file)
-                if self.timefilter is not None and not self.timefilter.partial_within(file):
-                    continue
                 if file.startswith("."):
                     continue
+                path = op.join(root, file)
                 try:
-                    if not (op.isfile(path) and os.access(path, os.R_OK)):
-                        raise RuntimeError(f"Could not read {path}, skipping")
-                    if is_archive(path):
-                        yield from walk_archive(path)
-                    if path_is_timestream_file(path, extensions=self.format):
-                        self._files[op.basename(path)] = FileContentFetcher(path)
-                        yield TimestreamFile.from_path(path)
+                    instant = parse_ts_filename(file)
+                    if instant is None or file.lower().endswith((".zip", ".tar")):
+                        # not named like an image, so possibly a bundle (see path_may_be_archive)
+                        if not name_within(file, parent):
+                            continue
+                        if is_archive(path):
+                            heapq.heappush(heap, (lower_bound(file, parent, lowest), next(seq), None, path))
+                            continue
+                    if instant is None or not path_has_extension(file, self.format):
+                        continue
+                    if not within(instant.datetime):
+                        continue
+                    loose.append(TimestreamFile.from_path(path, instant=instant))
                 except Exception as exc:
                     warnings.warn(f"{exc.__class__.__name__}: {str(exc)} at '{path}'")
-
+            loose.sort(key=lambda file: file.instant.sortkey)
+            push(iter(loose))
+            yield from pop_until(min(pending.values(), default=maxkey))
+        yield from pop_until(maxkey)
 
     def _timestream_path(self, file):
         """Gets path for timestream file.
@@ -313,42 +866,299 @@ class TimeStream(object):
         return file.instant.datetime.strftime(bpath)
 
     def write(self, file):
+        self.write_many([file])
+
+    def write_many(self, files):
+        """Writes each of files, opening (and locking) each bundle or directory only once
+
+        files are grouped by the bundle (or, for bundle_level "none", the directory) they
+        belong in, and each group written in one go.
+        """
         if self.name is None:
             raise RuntimeError("TSv2Stream not opened")
-        if not isinstance(file, TimestreamFile):
-            raise TypeError("file should be a TimestreamFile")
-        subpath = self._timestream_path(file)
+        groups = OrderedDict()
+        for file in files:
+            if not isinstance(file, TimestreamFile):
+                raise TypeError("file should be a TimestreamFile")
+            groups.setdefault(self._destination(file), []).append(
+                (self._timestream_path(file), file))
+        for key, group in groups.items():
+            if self.bundle == "none":
+                self._write_loose(key, group)
+            else:
+                self._write_bundle(key, group)
+
+    def _destination(self, file):
+        """The bundle file would be written to, or for bundle_level "none", its directory"""
         if self.bundle == "none":
+            return op.dirname(op.join(self.path, self._timestream_path(file)))
+        if self.bundle == "root":
+            self._strip_root_extension(file)
+        return self._bundle_archive_path(file)
+
+    def _strip_root_extension(self, file):
+        self.path = str(self.path)
+        for ext in [".tar", ".zip", f".{file.format}"]:
+            if self.path.lower().endswith(ext):
+                self.path = self.path[:-len(ext)]
+        self.path = Path(self.path)
+
+    def _makedirs(self, path):
+        """os.makedirs(path, exist_ok=True), remembering which directories have been made"""
+        if path and path not in self._made_dirs:  # i.e. if not $PWD
+            os.makedirs(path, exist_ok=True)
+            self._made_dirs.add(path)
+
+    _tmp_ids = itertools.count()
+
+    def _write_loose(self, outdir, group):
+        self._makedirs(outdir)
+        for subpath, file in group:
             outpath = op.join(self.path, subpath)
-            os.makedirs(op.dirname(outpath), exist_ok=True)
-            with FileLock(outpath):
-                with open(outpath, 'wb') as fh:
-                    fh.write(file.content)
-        else:
-            if self.bundle == "root":
-                self.path = str(self.path)
-                for ext in [".tar", ".zip", f".{file.format}"]:
-                    if self.path.lower().endswith(ext):
-                        self.path = self.path[:-len(ext)]
-                self.path = Path(self.path)
-            bundle = self._bundle_archive_path(file)
-            bdir = op.dirname(bundle)
-            if bdir:  # i.e. if not $PWD
-                os.makedirs(bdir, exist_ok=True)
-            with FileLock(bundle):
-                with zipfile.ZipFile(bundle, mode="a", compression=zipfile.ZIP_STORED,
-                                     allowZip64=True) as zip:
-                    pathinzip = op.join(self.name, subpath)
-                    if pathinzip not in zip.namelist():
-                        zip.writestr(pathinzip, file.content)
+            # hidden, so never read as part of the timestream
+            tmppath = op.join(outdir, f".{op.basename(outpath)}.{os.getpid()}.{next(self._tmp_ids)}.tmp")
+            source = _source_path(file)
+            try:
+                if source is not None:
+                    copy_file(source, tmppath, link=self.link)
+                    if self.sync == "file":
+                        fsync_path(tmppath)
+                else:
+                    with open(tmppath, 'xb') as fh:
+                        file.copy_to(fh)
+                        if self.sync == "file":
+                            fh.flush()
+                            os.fsync(fh.fileno())
+            except BaseException:
+                if op.lexists(tmppath):
+                    os.unlink(tmppath)
+                raise
+            if self.sync == "group":
+                with self._write_lock:
+                    if not self._pending:
+                        self._pending_since = time.monotonic()
+                    self._pending.append((tmppath, outpath))
+            else:
+                os.replace(tmppath, outpath)
+                if self.sync == "file":
+                    fsync_path(outdir)
+        if self.sync == "group":
+            with self._write_lock:
+                if self._pending and (len(self._pending) >= self.sync_every or
+                        time.monotonic() - self._pending_since >= self.flush_interval):
+                    self._commit_files(self._pending)
+
+    def _write_bundle(self, bundle, group):
+        self._makedirs(op.dirname(bundle))
+        # read any content that can't be streamed in before taking the lock
+        members = [(op.join(self.name, subpath), file, None if _unread(file) else file.content)
+                   for subpath, file in group]
+        with self._write_lock:
+            appender = self._bundle_appender(bundle)
+            try:
+                for member, file, content in members:
+                    raw = _raw_zip_member(file) if content is None else None
+                    if content is not None:
+                        appender.write(member, content)
+                    elif raw is not None:
+                        appender.write_raw(member, *raw)
+                    elif _source_path(file) is not None:
+                        appender.write_file(member, _source_path(file))
                     else:
-                        file_crc = zlib.crc32(file.content)
-                        zip_crc = zip.getinfo(pathinzip).CRC
-                        if file_crc != zip_crc:
-                            raise RuntimeError(f"ERROR: trying to overwrite file with different content: zip={bundle}, subpath={subpath}")
+                        with file.open() as fh:
+                            appender.write_stream(member, fh)
+            finally:
+                if time.monotonic() - appender.opened >= self.flush_interval:
+                    self.flush(bundle)
+
+    def _bundle_appender(self, bundle):
+        """Returns the open ZipAppender for bundle, opening it (and closing others) if needed"""
+        appender = self._bundles.get(bundle)
+        if appender is not None:
+            self._bundles.move_to_end(bundle)
+            return appender
+        while len(self._bundles) >= max(self.max_open_bundles, 1):
+            self._bundles.popitem(last=False)[1].close()
+        appender = ZipAppender(bundle)
+        self._bundles[bundle] = appender
+        return appender
+
+    @staticmethod
+    def _commit_files(pending):
+        """Makes pending (temporary, final) files durable, then renames them into place"""
+        files = pending[:]
+        del pending[:]
+        if not files:
+            return
+        # concurrent fsyncs can share the filesystem's journal commits
+        with ThreadPoolExecutor(min(len(files), 16)) as executor:
+            list(executor.map(fsync_path, [tmppath for tmppath, _ in files]))
+            for tmppath, outpath in files:
+                os.replace(tmppath, outpath)
+            list(executor.map(fsync_path, {op.dirname(outpath) for _, outpath in files}))
+
+    @staticmethod
+    def _flush_writes(bundles, pending):
+        TimeStream._commit_files(pending)
+        while bundles:
+            bundles.popitem(last=False)[1].close()
+
+    def flush(self, bundle=None):
+        """Finishes writing to any open bundles (or just bundle), making them readable
+
+        Also commits any files pending with sync="group" (unless just flushing bundle).
+        """
+        with self._write_lock:
+            if bundle is None:
+                self._flush_writes(self._bundles, self._pending)
+            elif bundle in self._bundles:
+                self._bundles.pop(bundle).close()
 
     def __iter__(self):
         return self.iter()
 
     def close(self):
-        pass
+        self.flush()
+
+
+def _writer_main(stream, flush_interval, files, errors):
+    """Writes files from the queue files to stream, until given None"""
+    # when spawned, stream is an unpickled copy, which would flush after every write
+    stream.flush_interval = flush_interval
+    try:
+        while True:
+            item = files.get()
+            if item is None:
+                break
+            instant, filename, format, content, fetcher = item
+            try:
+                stream.write(TimestreamFile(instant=instant, filename=filename, fetcher=fetcher,
+                                            content=content, format=format))
+            except Exception as exc:
+                errors.put(f"{filename}: {str(exc)}")
+    finally:
+        stream.close()
+        errors.put(None)
+
+
+class TimeStreamWriter(object):
+    """Writes to a TimeStream from dedicated writer processes
+
+    Files given to write() are sent to one of writers processes, which write them to stream.
+    All files of a bundle go to the same writer, so each bundle has exactly one owner: it
+    may be kept open between writes, and no time is spent waiting for locks. A
+    TimeStreamWriter may be passed to the workers of a TSPipeline (e.g. in a WriteFileStep),
+    which then send files straight to the writers.
+
+    close() must be called once writing is done. Files that fail to be written are warned
+    about then, and a RuntimeError is raised if a writer process died.
+    """
+    _live = {}  # key -> TimeStreamWriter, for those created in (or shared with) this process
+    _keys = itertools.count()
+
+    def __init__(self, stream, writers=1, queue_size=64):
+        if not isinstance(stream, TimeStream):
+            raise TypeError("stream should be a TimeStream")
+        if stream.name is None:
+            raise RuntimeError("TSv2Stream not opened")
+        ctx = multiprocessing.get_context()
+        stream.flush()  # so that forked writers don't inherit open bundles
+        self.key = f"{os.getpid()}-{next(self._keys)}"
+        self.stream = stream
+        self.queues = [ctx.Queue(queue_size) for _ in range(max(writers, 1))]
+        self.errors = ctx.Queue()
+        self.processes = [ctx.Process(target=_writer_main, daemon=True,
+                                      args=(stream, stream.flush_interval, files, self.errors))
+                          for files in self.queues]
+        for process in self.processes:
+            process.start()
+        self._live[self.key] = self
+
+    @classmethod
+    def shared(cls):
+        """The state of this process's writers, to be given to share() in a worker process"""
+        return {key: writer._shared_state() for key, writer in cls._live.items()}
+
+    @classmethod
+    def share(cls, shared):
+        """Makes writers from shared() usable in this process, e.g. as a pool initializer"""
+        for key, state in shared.items():
+            if key not in cls._live:
+                writer = cls.__new__(cls)
+                writer.__dict__.update(state)
+                cls._live[key] = writer
+
+    def _shared_state(self):
+        return {"key": self.key, "stream": self.stream, "queues": self.queues,
+                "errors": self.errors, "processes": None}
+
+    def __getstate__(self):
+        # queues can only be passed to other processes as they start, so they are shared
+        # with workers by share() (or fork), and only looked up here
+        return {"key": self.key}
+
+    def __setstate__(self, state):
+        key = state["key"]
+        if key not in self._live:
+            raise RuntimeError("TimeStreamWriter is not shared with this process "
+                               "(see TimeStreamWriter.share)")
+        self.__dict__.update(self._live[key]._shared_state())
+
+    def _route(self, file):
+        """Picks the writer for file, such that all files of a bundle use the same writer"""
+        stream = self.stream
+        if stream.bundle == "root":
+            key = ""
+        elif stream.bundle == "none":
+            key = stream._timestream_path(file)
+        else:
+            key = stream._bundle_archive_path(file)
+        return self.queues[zlib.crc32(key.encode()) % len(self.queues)]
+
+    def write(self, file):
+        if not isinstance(file, TimestreamFile):
+            raise TypeError("file should be a TimestreamFile")
+        if self.processes is not None and not all(p.is_alive() for p in self.processes):
+            raise RuntimeError("a TimeStreamWriter writer process has died")
+        # unread files are sent by their fetchers, for the writer to copy or stream
+        if _unread(file):
+            content, fetcher = None, file.fetcher
+        else:
+            content, fetcher = bytes(file.content), None
+        self._route(file).put((file.instant, file.filename, file.format, content, fetcher))
+
+    def write_many(self, files):
+        for file in files:
+            self.write(file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Waits for all files to be written. Only does anything in the creating process."""
+        if self.processes is None:
+            return
+        processes, self.processes = self.processes, None
+        self._live.pop(self.key, None)
+        for files in self.queues:
+            files.put(None)
+        finished = 0
+        while finished < len(processes):
+            try:
+                error = self.errors.get(timeout=1)
+            except queue.Empty:
+                if any(p.is_alive() for p in processes):
+                    continue
+                break
+            if error is None:
+                finished += 1
+            else:
+                warnings.warn(f"failed to write {error}")
+        for process in processes:
+            process.join()
+        died = [p.exitcode for p in processes if p.exitcode != 0]
+        if died:
+            raise RuntimeError(f"TimeStreamWriter writer processes died (exit codes {died})")
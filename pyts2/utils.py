@@ -5,10 +5,14 @@
 
 import datetime as dt
 from signal import *
+import errno
+import io
+import shutil
 import sys
 import warnings
 import os
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile, ZIP_STORED
 
 
@@ -22,6 +26,101 @@ def nowarnings(func):
     return wrapped
 
 
+def fsync_path(path):
+    """fsync()s the file or directory at path"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+CHUNK_SIZE = 1 << 20  # for reading, copying and checksumming files a piece at a time
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+def copy_file(src, dst, link=False):
+    """Copies the file src to the new file dst, in the kernel where possible
+
+    If link is True, dst is first tried as a hardlink to src. Otherwise, dst is a reflink of
+    src (sharing its extents, on e.g. btrfs or XFS) if possible, or is copied with
+    os.copy_file_range or os.sendfile, which don't pass the data through python, falling back
+    to a chunked copy. Returns which of "link", "clone", "copy_file_range", "sendfile" or
+    "copy" was used.
+    """
+    if link:
+        try:
+            os.link(src, dst)
+            return "link"
+        except OSError:
+            pass
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        try:
+            import fcntl
+            fcntl.ioctl(outfd, FICLONE, infd)
+            return "clone"
+        except (ImportError, OSError):
+            pass
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            try:
+                while True:
+                    if method == "copy_file_range":
+                        copied = os.copy_file_range(infd, outfd, 1 << 30)
+                    else:
+                        copied = os.sendfile(outfd, infd, None, 1 << 30)
+                    if copied == 0:
+                        return method
+            except OSError as exc:
+                # e.g. across filesystems, or not supported by either of them
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                                     errno.EOPNOTSUPP, errno.ENOTSUP):
+                    raise
+                os.lseek(infd, 0, os.SEEK_SET)
+                os.lseek(outfd, 0, os.SEEK_SET)
+                os.ftruncate(outfd, 0)
+        shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+        return "copy"
+
+
+def copy_range(infd, outfd, offset, size):
+    """Copies the size bytes at offset in infd to outfd (at its current position)
+
+    As with copy_file, the data is copied by the kernel (os.copy_file_range or os.sendfile)
+    where possible. Returns which of "copy_file_range", "sendfile" or "copy" was used.
+    """
+    done = 0
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        try:
+            while done < size:
+                count = min(size - done, 1 << 30)
+                if method == "copy_file_range":
+                    copied = os.copy_file_range(infd, outfd, count, offset + done)
+                else:
+                    copied = os.sendfile(outfd, infd, offset + done, count)
+                if copied == 0:
+                    raise EOFError(f"file ended {size - done} bytes early")
+                done += copied
+            return method
+        except OSError as exc:
+            # carry on from where this method stopped with the next
+            if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                                 errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    while done < size:
+        chunk = memoryview(os.pread(infd, min(size - done, CHUNK_SIZE), offset + done))
+        if not chunk:
+            raise EOFError(f"file ended {size - done} bytes early")
+        done += len(chunk)
+        while chunk:
+            chunk = chunk[os.write(outfd, chunk):]
+    return "copy"
+
+
 def find_files(base):
     if os.path.exists(base) and os.path.isfile(base):
         yield base
@@ -30,6 +129,134 @@ def find_files(base):
             yield os.path.join(root, file)
 
 
+def serial_walk(top):
+    """Walks `top` with os.walk, yielding (root, dirs, files) like os.walk.
+
+    `files` only includes regular files (or symlinks to them), and as with os.walk, `dirs`
+    may be modified in-place to prune or reorder the directories that are descended into.
+    """
+    for root, dirs, files in os.walk(top):
+        yield root, dirs, [f for f in files if op.isfile(op.join(root, f))]
+
+
+def parallel_walk(top, threads=8):
+    """Like serial_walk, but lists directories on a thread pool with os.scandir.
+
+    Yields in the same (top-down) order as serial_walk. After each directory is yielded, all of
+    its (possibly pruned) subdirectories are listed concurrently, so on high-latency network
+    filesystems sibling year/month/day/hour directories cost about one round trip. The
+    file/directory type of each entry comes from the scandir DirEntry, avoiding a stat per
+    file on most filesystems. Symlinks to directories are not followed.
+    """
+    def scan(path):
+        dirs, files = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.name)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            # like os.walk, ignore directories we can't list
+            pass
+        return dirs, files
+
+    def walk(executor, root, listing):
+        dirs, files = listing.result()
+        yield root, dirs, files
+        children = [(op.join(root, d), executor.submit(scan, op.join(root, d))) for d in dirs]
+        for path, child in children:
+            yield from walk(executor, path, child)
+
+    if not op.isdir(top):
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        yield from walk(executor, top, executor.submit(scan, top))
+
+
+class _SizedReader(io.RawIOBase):
+    """A read-only, seekable binary file of self.size bytes"""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class BufferReader(_SizedReader):
+    """A read-only, seekable binary file over a buffer (e.g. bytes or a memoryview).
+
+    Unlike io.BytesIO, the buffer is not copied, so decoders can read straight from the
+    memory-mapped content of zip bundle members (see `pyts2.archive.ZipMapping`).
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast("B")
+        self.size = len(self.buffer)
+        self.pos = 0
+
+    def readinto(self, b):
+        data = self.buffer[self.pos:self.pos + len(b)]
+        n = len(data)
+        memoryview(b).cast("B")[:n] = data
+        self.pos += n
+        return n
+
+
+class FileSlice(_SizedReader):
+    """A read-only, seekable binary file of the size bytes at offset in the file at path.
+
+    Reads are positional (os.pread), from a descriptor of its own, so e.g. the members of
+    bundles can be streamed without reading them whole, or sharing the bundle's handle.
+    """
+
+    def __init__(self, path, offset, size):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readinto(self, b):
+        n = max(min(len(b), self.size - self.pos), 0)
+        if n == 0:
+            return 0
+        if hasattr(os, "preadv"):
+            n = os.preadv(self.fd, [memoryview(b).cast("B")[:n]], self.offset + self.pos)
+        else:
+            data = os.pread(self.fd, n, self.offset + self.pos)
+            n = len(data)
+            memoryview(b).cast("B")[:n] = data
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
 class CatchSignalThenExit(object):
     """Context manager to catch any signals, then exit.
 
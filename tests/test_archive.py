@@ -0,0 +1,364 @@
+from pyts2.archive import ArchivePool, TarReader, ZipAppender, ZipMapping, archive_pool, recover_zip, sniff_archive
+import pyts2.archive
+import pyts2.timestream
+from pyts2.timestream import TimeStream, TimestreamFile, ZipContentFetcher, TarContentFetcher
+from pyts2.utils import BufferReader
+
+from .utils import *
+from .data import *
+
+import errno
+import io
+import pickle
+import shutil
+import tarfile
+import warnings
+import zipfile
+import zlib
+
+
+def test_pool_reuse(data):
+    pool = ArchivePool(maxopen=2)
+    path = data("timestreams/nested.zip")
+    with pool.open_zip(path) as zip:
+        first = zip
+        names = zip.namelist()
+    with pool.open_zip(path) as zip:
+        assert zip is first
+    assert len(pool) == 1
+    assert pool.read_zip(path, names[0]) == first.read(names[0])
+
+    tarpath = data("timestreams/nested.tar")
+    with pool.open_tar(tarpath) as tar:
+        member = list(tar.members)[-1]
+    assert len(pool.read_tar(tarpath, member)) > 0
+    assert len(pool) == 2
+
+    # LRU eviction closes the least recently used handle
+    pool.read_zip(data("timestreams/flat.zip"), "flat/2001_02_01_09_14_15_00.tif")
+    assert len(pool) == 2
+    assert first.fp is None
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_pool_invalidation(data, tmpdir):
+    path = str(tmpdir.join("out.zip"))
+    shutil.copy(data("timestreams/flat.zip"), path)
+    pool = ArchivePool()
+    with pool.open_zip(path) as zip:
+        first = zip
+        nfiles = len(zip.namelist())
+
+    with zipfile.ZipFile(path, mode="a") as zip:
+        zip.writestr("flat/2001_02_03_09_14_15_00.tif", b"new file")
+
+    with pool.open_zip(path) as zip:
+        assert zip is not first
+        assert len(zip.namelist()) == nfiles + 1
+    assert pool.read_zip(path, "flat/2001_02_03_09_14_15_00.tif") == b"new file"
+
+
+def test_pooled_fetchers(data):
+    for timestream in ["nested.zip", "zipball-day", "nested.tar", "tarball-day"]:
+        loose = {f.instant: f.content for f in TimeStream(data("timestreams/nested"))}
+        for file in TimeStream(data(f"timestreams/{timestream}")).iter(tar_contents=False):
+            assert isinstance(file.fetcher, (ZipContentFetcher, TarContentFetcher))
+            assert file.content == loose[file.instant]
+
+
+def test_tar_reader(data, tmpdir):
+    path = str(tmpdir.join("nested.tar"))
+    shutil.copy(data("timestreams/nested.tar"), path)
+    sidecar = str(tmpdir.join(".nested.tar.tarindex"))
+
+    reader = TarReader(path)
+    assert op.exists(sidecar)
+    with tarfile.TarFile(path) as tar:
+        expect = {entry.name: tar.extractfile(entry).read() for entry in tar if entry.isfile()}
+    assert set(reader.members) == set(expect)
+    for name in reversed(list(expect)):
+        assert reader.read(name) == expect[name]
+    with pytest.raises(KeyError):
+        reader.read("not a member")
+    reader.close()
+
+    # the sidecar is used when fresh, and rebuilt when the tar changes
+    mtime = os.stat(sidecar).st_mtime_ns
+    TarReader(path).close()
+    assert os.stat(sidecar).st_mtime_ns == mtime
+    with tarfile.TarFile(path, mode="a") as tar:
+        tar.add(data("timestreams/flat/2001_02_01_09_14_15_00.tif"), arcname="new_2001_02_03_09_14_15_00.tif")
+    reader = TarReader(path)
+    assert "new_2001_02_03_09_14_15_00.tif" in reader.members
+    assert len(reader.read("new_2001_02_03_09_14_15_00.tif")) > 0
+    reader.close()
+
+
+def test_zip_mapping(data, tmpdir):
+    path = str(tmpdir.join("mixed.zip"))
+    shutil.copy(data("timestreams/flat.zip"), path)
+    with zipfile.ZipFile(path, mode="a") as zip:
+        zip.writestr("flat/2001_02_03_09_14_15_00.tif", b"deflated" * 100,
+                     compress_type=zipfile.ZIP_DEFLATED)
+        expect = {name: zip.read(name) for name in zip.namelist()}
+
+    mapping = ZipMapping(path)
+    for name, content in expect.items():
+        view = mapping.view(name)
+        if name == "flat/2001_02_03_09_14_15_00.tif":
+            assert view is None
+        else:
+            assert isinstance(view, memoryview)
+            assert view == content
+    # closing with views still alive defers unmapping until they are released
+    mapping.close()
+    del view
+
+    pool = ArchivePool()
+    for name, content in expect.items():
+        got = pool.view_zip(path, name)
+        assert got == content
+    assert isinstance(pool.view_zip(path, "flat/2001_02_03_09_14_15_00.tif"), bytes)
+    pool.close()
+
+
+def test_mmap_fetchers(data):
+    loose = {f.instant: f.content for f in TimeStream(data("timestreams/nested"))}
+    for timestream in ["nested.zip", "zipball-day"]:
+        files = list(TimeStream(data(f"timestreams/{timestream}"), mmap=True))
+        assert len(files) == len(loose)
+        for file in files:
+            assert isinstance(file.content, memoryview)
+            assert file.content == loose[file.instant]
+            assert file.md5sum == TimestreamFile.from_bytes(loose[file.instant], file.filename).md5sum
+            # views aren't picklable, so pickled files carry a copy of their content
+            unpickled = pickle.loads(pickle.dumps(file))
+            assert unpickled.content == loose[file.instant]
+        # and so do files from the instant index
+        stream = TimeStream(data(f"timestreams/{timestream}"), mmap=True, index="off")
+        assert all(isinstance(f.content, memoryview) for f in stream.instants.files())
+
+
+def test_buffer_reader():
+    content = bytes(range(256)) * 4
+    reader = BufferReader(memoryview(content))
+    assert reader.read(10) == content[:10]
+    assert reader.tell() == 10
+    reader.seek(-6, io.SEEK_END)
+    assert reader.read() == content[-6:]
+    assert reader.read(1) == b""
+    reader.seek(100)
+    buf = bytearray(20)
+    assert reader.readinto(buf) == 20
+    assert buf == content[100:120]
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+
+
+def test_sniff_archive(data, tmpdir):
+    assert sniff_archive(data("timestreams/flat.zip")) == "zip"
+    assert sniff_archive(data("timestreams/flat.tar")) == "tar"
+    assert sniff_archive(data("timestreams/flat/2001_02_01_09_14_15_00.tif")) is None
+    empty = str(tmpdir.join("empty.zip"))
+    zipfile.ZipFile(empty, mode="w").close()
+    assert sniff_archive(empty) == "zip"
+    prefixed = str(tmpdir.join("prefixed.zip"))
+    with open(prefixed, "wb") as fh, open(data("timestreams/flat.zip"), "rb") as zipfh:
+        fh.write(b"#!/bin/sh\n" + zipfh.read())
+    assert sniff_archive(prefixed) == "zip"
+    notatar = str(tmpdir.join("zeros.tar"))
+    with open(notatar, "wb") as fh:
+        fh.write(bytes(1024))
+    assert sniff_archive(notatar) is None
+
+
+def test_pool_kind(data, tmpdir, monkeypatch):
+    sniffed = []
+    def counting_sniff(path):
+        sniffed.append(path)
+        return sniff_archive(path)
+    monkeypatch.setattr(pyts2.archive, "sniff_archive", counting_sniff)
+
+    pool = ArchivePool()
+    path = str(tmpdir.join("bundle"))
+    shutil.copy(data("timestreams/flat.zip"), path)
+    assert pool.kind(path) == "zip"
+    assert pool.kind(path) == "zip"
+    assert len(sniffed) == 1
+    # replacing the file invalidates the cached verdict
+    shutil.copy(data("timestreams/flat.tar"), path)
+    assert pool.kind(path) == "tar"
+    assert len(sniffed) == 2
+    assert pool.kind(str(tmpdir)) is None
+    assert len(sniffed) == 2
+
+    # walking a timestream never sniffs files named like timestream images
+    monkeypatch.setattr(pyts2.timestream, "archive_pool", pool)
+    sniffed.clear()
+    for timestream in ["flat", "nested", "zipball-day"]:
+        assert len(list(TimeStream(data(f"timestreams/{timestream}"), index="off"))) == 10
+    assert len(sniffed) > 0
+    assert all(f.endswith(".zip") for f in sniffed)
+
+
+def test_zip_appender(data, tmpdir):
+    path = str(tmpdir.join("bundle.zip"))
+    files = list(TimeStream(data("timestreams/nested")))
+    appender = ZipAppender(path)
+    for file in files[:5]:
+        appender.write(file.filename, file.content)
+    appender.write(files[0].filename, files[0].content)
+    with pytest.raises(RuntimeError):
+        appender.write(files[0].filename, b"different content")
+    appender.close()
+
+    # reopening continues the same bundle
+    appender = ZipAppender(path)
+    for file in files[5:]:
+        appender.write(file.filename, file.content)
+    appender.close()
+    with zipfile.ZipFile(path) as zip:
+        assert zip.namelist() == [f.filename for f in files]
+
+
+def test_recover_zip(data, tmpdir):
+    path = str(tmpdir.join("bundle.zip"))
+    files = list(TimeStream(data("timestreams/nested")))
+    with zipfile.ZipFile(path, "w") as zip:
+        for file in files[:4]:
+            zip.writestr(file.filename, file.content)
+        cut = zip.infolist()[3].header_offset + 100
+    # a crash part way through writing a member leaves no central directory
+    with open(path, "r+b") as fh:
+        fh.truncate(cut)
+    with pytest.raises(zipfile.BadZipFile):
+        zipfile.ZipFile(path)
+
+    with warnings.catch_warnings(record=True) as caught:
+        appender = ZipAppender(path)
+    assert "Recovered 3 files" in str(caught[0].message)
+    appender.write(files[4].filename, files[4].content)
+    appender.close()
+    with zipfile.ZipFile(path) as zip:
+        assert zip.testzip() is None
+        assert zip.namelist() == [f.filename for f in files[:3] + files[4:5]]
+        assert zip.read(files[1].filename) == files[1].content
+    # the damaged file is kept, hidden
+    assert op.getsize(str(tmpdir.join(".bundle.zip.damaged"))) == cut
+
+    # a member being streamed in when the writer died still has its placeholder header, which
+    # isn't taken for an empty member
+    path = str(tmpdir.join("streamed.zip"))
+    with zipfile.ZipFile(path, "w") as zip:
+        zip.writestr(files[0].filename, files[0].content)
+        info = zipfile.ZipInfo(files[1].filename)
+        info.file_size = len(files[1].content)
+        member = zip.open(info, "w")
+        member.write(files[1].content[:10])
+        zip.fp.flush()
+        with open(path, "rb") as fh:
+            crashed = fh.read()
+        member.close()
+    with open(path, "wb") as fh:
+        fh.write(crashed)
+    assert recover_zip(path) == 1
+    with zipfile.ZipFile(path) as zip:
+        assert zip.namelist() == [files[0].filename]
+    with open(str(tmpdir.join(".streamed.zip.damaged")), "rb") as fh:
+        assert fh.read() == crashed
+
+    with open(path, "wb") as fh:
+        fh.write(b"not a zip file")
+    assert recover_zip(path) is None
+    with pytest.raises(zipfile.BadZipFile):
+        ZipAppender(path)
+
+
+def test_zip_appender_write_file(data, tmpdir):
+    path = str(tmpdir.join("bundle.zip"))
+    files = list(TimeStream(data("timestreams/flat")))
+    appender = ZipAppender(path)
+    for file in files:
+        appender.write_file(file.filename, file.fetcher.path)
+    appender.write(files[0].filename, files[0].content)
+    appender.write_file(files[1].filename, files[1].fetcher.path)
+    other = str(tmpdir.join("other"))
+    with open(other, "wb") as fh:
+        fh.write(b"different content")
+    with pytest.raises(RuntimeError):
+        appender.write_file(files[2].filename, other)
+    appender.close()
+    with zipfile.ZipFile(path) as zip:
+        assert zip.testzip() is None
+        assert [zip.read(f.filename) for f in files] == [f.content for f in files]
+
+
+class _FailingReader(io.BytesIO):
+    """Content whose reads fail with EIO (or, if short, end early) after `good` bytes"""
+
+    def __init__(self, content, good, short=False):
+        super().__init__(content)
+        self.good = good
+        self.short = short
+
+    def read(self, size=-1):
+        if self.tell() >= self.good:
+            if self.short:
+                return b""
+            raise OSError(errno.EIO, "Input/output error")
+        return super().read(min(size, self.good - self.tell()) if size >= 0 else self.good)
+
+
+def test_zip_appender_rollback(data, tmpdir):
+    path = str(tmpdir.join("bundle.zip"))
+    files = list(TimeStream(data("timestreams/flat")))
+    content = bytes(range(256)) * (10_000_000 // 256)
+    appender = ZipAppender(path)
+    appender.write(files[0].filename, files[0].content)
+    # sources that fail part way leave nothing of themselves behind
+    with pytest.raises(OSError):
+        appender.write_stream("failed.tif", _FailingReader(content, 2 << 20))
+    with pytest.raises(EOFError):
+        appender.write_stream("short.tif", _FailingReader(content, 2 << 20, short=True))
+    source = str(tmpdir.join("source"))
+    with open(source, "wb") as fh:
+        fh.write(content[:1000])
+    with pytest.raises(EOFError):
+        appender.write_raw("raw.tif", source, 0, 2000, zlib.crc32(content[:2000]))
+    appender.write(files[1].filename, files[1].content)
+    appender.write_stream("failed.tif", io.BytesIO(content))
+    appender.close()
+    with zipfile.ZipFile(path) as zip:
+        assert zip.testzip() is None
+        assert zip.namelist() == [files[0].filename, files[1].filename, "failed.tif"]
+        assert zip.read("failed.tif") == content
+        assert zip.infolist()[1].header_offset == zip.infolist()[0].header_offset + \
+            zip.infolist()[0].compress_size + len(zip.infolist()[0].FileHeader())
+
+
+def test_zip_appender_write_raw(data, tmpdir):
+    src = data("timestreams/nested.zip")
+    path = str(tmpdir.join("bundle.zip"))
+    with zipfile.ZipFile(src) as zip:
+        infos = [info for info in zip.infolist() if not info.is_dir()]
+        contents = [zip.read(info) for info in infos]
+    appender = ZipAppender(path)
+    appender.write("first", b"written normally")
+    for info in infos:
+        offset, size = archive_pool.zip_span(src, info.filename)
+        appender.write_raw(info.filename, src, offset, size, info.CRC)
+    # rewriting the same data is a no-op, different data is an error
+    appender.write_raw(infos[0].filename, src, *archive_pool.zip_span(src, infos[0].filename),
+                       infos[0].CRC)
+    with pytest.raises(RuntimeError):
+        appender.write_raw(infos[0].filename, src, *archive_pool.zip_span(src, infos[0].filename),
+                           infos[0].CRC ^ 1)
+    appender.write("last", b"written after")
+    appender.close()
+    with zipfile.ZipFile(path) as zip:
+        assert zip.testzip() is None
+        assert [zip.read(info.filename) for info in infos] == contents
+        assert [zip.getinfo(info.filename).CRC for info in infos] == [info.CRC for info in infos]
+        assert zip.read("first") == b"written normally"
+        assert zip.read("last") == b"written after"
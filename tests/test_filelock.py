@@ -0,0 +1,90 @@
+from pyts2.filelock import FileLock, FileLockException
+
+from .utils import *
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+
+def _hold_lock(path, locked, release):
+    with FileLock(path):
+        locked.set()
+        release.wait(10)
+
+
+def test_filelock(tmpdir):
+    path = str(tmpdir.join("file"))
+    with FileLock(path) as lock:
+        assert lock.is_locked
+        assert op.exists(path + ".lock")
+    assert not lock.is_locked
+    assert not op.exists(path + ".lock")
+
+    # a lockfile left by a crash doesn't hold the lock
+    open(path + ".lock", "w").close()
+    with FileLock(path, timeout=None):
+        pass
+    assert not op.exists(path + ".lock")
+
+
+def test_filelock_threads(tmpdir):
+    path = str(tmpdir.join("file"))
+    inside = []
+    overlapped = []
+
+    def work():
+        for i in range(20):
+            with FileLock(path):
+                inside.append(1)
+                if len(inside) > 1:
+                    overlapped.append(1)
+                time.sleep(0.0005)
+                inside.pop()
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == []
+    assert not op.exists(path + ".lock")
+
+    with FileLock(path):
+        with pytest.raises(FileLockException):
+            FileLock(path, timeout=None).acquire()
+        with pytest.raises(FileLockException):
+            FileLock(path, timeout=0.05).acquire()
+
+
+def test_filelock_processes(tmpdir):
+    path = str(tmpdir.join("file"))
+    ctx = multiprocessing.get_context()
+    locked, release = ctx.Event(), ctx.Event()
+    holder = ctx.Process(target=_hold_lock, args=(path, locked, release))
+    holder.start()
+    assert locked.wait(10)
+    with pytest.raises(FileLockException):
+        FileLock(path, timeout=None).acquire()
+    with pytest.raises(FileLockException):
+        FileLock(path, timeout=0.05).acquire()
+
+    # waiting blocks until the holder releases the lock
+    threading.Timer(0.1, release.set).start()
+    start = time.monotonic()
+    with FileLock(path, timeout=10):
+        assert time.monotonic() - start < 5
+    holder.join()
+
+    # the lock is released when its holder dies
+    locked.clear()
+    release.clear()
+    holder = ctx.Process(target=_hold_lock, args=(path, locked, release))
+    holder.start()
+    assert locked.wait(10)
+    os.kill(holder.pid, signal.SIGKILL)
+    holder.join()
+    with FileLock(path, timeout=5):
+        pass
@@ -0,0 +1,207 @@
+from pyts2.timestream import TimeStream, TimestreamFile
+from pyts2.index import TimeStreamIndex, InstantIndex
+from pyts2.time import *
+
+from .utils import *
+from .data import *
+
+import shutil
+import numpy as np
+import os
+import warnings
+import zipfile
+
+
+def test_index_read(data, tmpdir):
+    expect_insts = [TSInstant(t, subsecond=0, index=None)
+                    for t in SMALL_TIMESTREAMS["expect_times"]]
+    for name in ["flat", "nested", "nested.zip", "nested.tar", "tarball-day", "zipball-day"]:
+        src = data(f"timestreams/{name}")
+        path = str(tmpdir.join(name))
+        if op.isdir(src):
+            shutil.copytree(src, path)
+        else:
+            shutil.copy(src, path)
+
+        idx = TimeStreamIndex(path)
+        assert not idx.is_fresh()
+        idx.update()
+        assert idx.is_fresh()
+        assert len(idx) == len(expect_insts)
+        assert op.exists(path + ".tsidx")
+        idx.close()
+
+        stream = TimeStream(path)
+        got = list(stream)
+        assert [f.instant for f in got] == expect_insts
+        assert stream.sorted
+        for file in got:
+            assert len(file.content) > 0
+        assert list(stream.instants.keys()) == expect_insts
+        assert TimeStream(path)["2001_02_01_10_14_15_00.tif"].content == got[1].content
+        with pytest.raises(KeyError):
+            TimeStream(path)["Not a file"]
+
+
+def test_index_refresh(data, tmpdir):
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    with TimeStreamIndex(path) as idx:
+        idx.update()
+        assert idx.is_fresh()
+
+    # adding a file makes the index stale, so it isn't used until it is updated
+    out = TimeStream(path, name="nested")
+    newfile = TimestreamFile.from_bytes(b"not really a tif", "2001_02_03_09_14_15_00.tif")
+    out.write(newfile)
+    with TimeStreamIndex(path) as idx:
+        assert not idx.is_fresh()
+        assert len(idx) == 10
+    assert len(list(TimeStream(path))) == 11
+    assert len(list(TimeStream(path, index="update"))) == 11
+    with TimeStreamIndex(path) as idx:
+        assert idx.is_fresh()
+        assert len(idx) == 11
+
+    # removing files is noticed too
+    shutil.rmtree(op.join(path, "2001", "2001_02", "2001_02_01"))
+    with TimeStreamIndex(path) as idx:
+        assert not idx.is_fresh()
+        idx.update()
+        assert len(idx) == 6
+
+
+def test_index_invalid_dates(data, tmpdir):
+    # files and bundle members with impossible dates are skipped with a warning, as by the walk
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    with open(op.join(path, "2001", "bad_2001_02_30_09_00_00_00.tif"), "wb") as fh:
+        fh.write(b"not really a tif")
+    with zipfile.ZipFile(op.join(path, "2001", "bad_2001_02.tif.zip"), "w") as zip:
+        zip.writestr("bad_2001_02_30_10_00_00_00.tif", b"not really a tif")
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        walked = [f.instant for f in TimeStream(path, index="off")]
+        assert len(walked) == 10
+        with TimeStreamIndex(path) as idx:
+            idx.update()
+            assert idx.is_fresh()
+            assert len(idx) == 10
+        assert [f.instant for f in TimeStream(path)] == walked
+    assert sum("day is out of range" in str(w.message) for w in caught) == 4
+
+
+def test_index_batch_parse(data, tmpdir, monkeypatch):
+    # names are parsed a directory or bundle at a time, only invalid ones one by one
+    import pyts2.index
+    expect_insts = [TSInstant(t, subsecond=0, index=None)
+                    for t in SMALL_TIMESTREAMS["expect_times"]]
+    monkeypatch.setattr(pyts2.index, "parse_ts_filename",
+                        lambda name: pytest.fail(f"parsed {name} alone"))
+    for name in ["flat", "nested", "zipball-day"]:
+        path = str(tmpdir.join(name))
+        shutil.copytree(data(f"timestreams/{name}"), path)
+        with TimeStreamIndex(path) as idx:
+            idx.update()
+            assert [f.instant for f in idx.files()] == expect_insts
+
+
+def test_index_damaged_bundle(data, tmpdir):
+    # damaged bundles are skipped with a warning, as by the walk, and re-read once repaired
+    path = str(tmpdir.join("zipball-day"))
+    shutil.copytree(data("timestreams/zipball-day"), path)
+    bundle = op.join(path, "2001", "2001_02", "nested_2001_02_02.zip")
+    with open(bundle, "r+b") as fh:
+        fh.truncate(op.getsize(bundle) // 2)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert len(list(TimeStream(path, index="off"))) == 5
+        with TimeStreamIndex(path) as idx:
+            idx.update()
+            assert len(idx) == 5
+    assert sum("BadZipFile" in str(w.message) for w in caught) == 2
+
+    # repaired in place, which doesn't change its directory
+    shutil.copy(data("timestreams/zipball-day/2001/2001_02/nested_2001_02_02.zip"), bundle)
+    with TimeStreamIndex(path) as idx:
+        idx.update()
+        assert len(idx) == 10
+    assert [f.instant for f in TimeStream(path)] == \
+        [TSInstant(t, subsecond=0, index=None) for t in SMALL_TIMESTREAMS["expect_times"]]
+
+
+def test_index_filters(data, tmpdir, monkeypatch):
+    path = str(tmpdir.join("zipball-day"))
+    shutil.copytree(data("timestreams/zipball-day"), path)
+    TimeStreamIndex(path).update()
+
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1),
+                         dt.time(10, 0, 0), dt.time(12, 0, 0))
+    stream = TimeStream(path, timefilter=tfilter)
+    assert [f.instant for f in stream] == [TSInstant.from_path("2001_02_01_10_14_15"),
+                                           TSInstant.from_path("2001_02_01_11_14_15")]
+    assert len(list(TimeStream(path, format="jpg"))) == 0
+    with pytest.raises(KeyError):
+        stream["2001_02_02_10_14_15_00.tif"]
+
+    # indexed files are filtered in batches, by TimeFilter.mask, never one at a time
+    monkeypatch.setattr(TimeFilter, "__call__", lambda self, datetime: pytest.fail("called"))
+    with TimeStreamIndex(path) as idx:
+        got = list(idx.files(timefilters=[tfilter], batch=3))
+        assert [f.instant for f in got] == [TSInstant.from_path("2001_02_01_10_14_15"),
+                                            TSInstant.from_path("2001_02_01_11_14_15")]
+        day = TimeFilter(dt.date(2001, 2, 2), dt.date(2001, 2, 2))
+        assert len(list(idx.files(timefilters=[tfilter, day]))) == 0
+    assert len(list(TimeStream(path, timefilter=tfilter))) == 2
+
+
+def test_instant_index(data):
+    stream = TimeStream(data("timestreams/gvlike"), index="off")
+    files = list(stream)
+    instants = InstantIndex(reversed(files))
+    assert len(instants) == len(files) == 10
+    assert list(instants) == [f.instant for f in files]
+    assert instants.times.dtype == np.int64
+    assert len(instants.sources) == 1
+    for file in files:
+        assert file.instant in instants
+        got = instants[file.instant]
+        assert isinstance(got, TimestreamFile)
+        assert got.instant == file.instant
+        assert got.filename == file.filename
+        assert got.content == file.content
+    notthere = TSInstant(GVLIKE_TIMESTREAM["expect_datetime"], 0, "11")
+    assert notthere not in instants
+    with pytest.raises(KeyError):
+        instants[notthere]
+    with pytest.raises(KeyError):
+        instants[TSInstant(GVLIKE_TIMESTREAM["expect_datetime"], 0, None)]
+    assert instants.find("gvlike_2001_02_01_09_14_15_00_05.tif") == 4
+    with pytest.raises(KeyError):
+        instants.find("other_2001_02_01_09_14_15_00_05.tif")
+    with pytest.raises(ValueError):
+        InstantIndex([TimestreamFile.from_bytes(b"", "2001_02_01_09_14_15_00.tif")])
+
+
+def test_instant_index_select(data):
+    stream = TimeStream(data("timestreams/nested"), index="off")
+    tfilter = TimeFilter(dates=[(dt.date(2001, 2, 1), dt.date(2001, 2, 1))],
+                         times=[(dt.time(9), dt.time(10)), (dt.time(13), None)])
+    rows = stream.instants.select(tfilter)
+    expect = [f.instant for f in TimeStream(data("timestreams/nested"), timefilter=tfilter)]
+    assert len(expect) > 0
+    assert [stream.instants.instant(i) for i in rows] == expect
+
+
+def test_instant_index_sources(data):
+    expect_insts = [TSInstant(t, subsecond=0, index=None)
+                    for t in SMALL_TIMESTREAMS["expect_times"]]
+    for timestream in ["nested", "nested.zip", "tarball-day", "zipball-day"]:
+        stream = TimeStream(data(f"timestreams/{timestream}"), index="off")
+        instants = stream.instants
+        assert isinstance(instants, InstantIndex)
+        assert list(instants.keys()) == expect_insts
+        for file, indexed in zip(stream, instants.files()):
+            assert indexed.instant == file.instant
+            assert indexed.filename == file.filename
+            assert indexed.content == file.content
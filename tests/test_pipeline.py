@@ -1,5 +1,6 @@
 from pyts2.pipeline import *
 from pyts2 import *
+from pyts2.time import TimeFilter
 
 from .data import *
 from .utils import *
@@ -92,6 +93,11 @@ def test_pipeline(data, tmpdir):
         files = {}
         for file in pipe.process(TimeStream(data("timestreams/flat")), ncpus=ncpus):
             files[str(file.instant)] = file.md5sum
+        prefetched = {}
+        input = TimeStream(data("timestreams/flat")).iter(prefetch=4)
+        for file in TSPipeline().process(input, ncpus=ncpus):
+            prefetched[str(file.instant)] = file.md5sum
+        assert prefetched == files
 
         newfiles = {}
         for file in output:
@@ -100,3 +106,27 @@ def test_pipeline(data, tmpdir):
         assert files == newfiles
     dotest(1)
     dotest(3)
+
+
+def test_pipeline_timefilter(data):
+    pipe = TSPipeline(timefilter=TimeFilter(endtime=dt.time(11)))
+    files = list(pipe.process(TimeStream(data("timestreams/flat"))))
+    assert [f.instant.datetime.hour for f in files] == [9, 10] * 2
+    assert pipe.n == 4
+
+
+def test_write_file_step_batch(data, tmpdir):
+    fakeout = PretendTimestream()
+    step = WriteFileStep(fakeout, batch=4)
+    files = list(TimeStream(data("timestreams/flat")))
+    for file in files:
+        assert step.process_file(file) is file
+    assert len(fakeout.files) == 8
+    step.finish()
+    assert fakeout.files == files
+
+    output = TimeStream(tmpdir.join("out"), bundle_level="day", name="out")
+    pipe = TSPipeline(WriteFileStep(output, batch=3))
+    got = {f.instant: f.md5sum for f in pipe.process(TimeStream(data("timestreams/flat")))}
+    pipe.finish()
+    assert {f.instant: f.md5sum for f in TimeStream(tmpdir.join("out"))} == got
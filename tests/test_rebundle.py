@@ -0,0 +1,74 @@
+from pyts2.timestream import TimeStream, ZipContentFetcher
+from pyts2.rebundle import rebundle
+from pyts2.time import TimeFilter
+from pyts2.utils import find_files
+
+from .utils import *
+from .data import *
+
+import os
+import shutil
+import warnings
+
+
+def _stream_files(path):
+    return [(f.instant, f.content, f.crc32) for f in TimeStream(path, index="off")]
+
+
+def test_rebundle(data, tmpdir, monkeypatch):
+    src = str(tmpdir.join("in"))
+    shutil.copytree(data("timestreams/zipball-day"), src)
+    expect = _stream_files(src)
+
+    # zip members are copied raw, without reading their content
+    def no_reading(self):
+        raise AssertionError("zip member content was read")
+    monkeypatch.setattr(ZipContentFetcher, "get", no_reading)
+    monkeypatch.setattr(ZipContentFetcher, "open", no_reading)
+    for ncpus in [1, 2]:
+        path = str(tmpdir.join(f"hour{ncpus}"))
+        with TimeStream(path, bundle_level="hour", name="nested") as out:
+            copied, deleted = rebundle(TimeStream(src), out, ncpus=ncpus)
+        assert copied == len(expect)
+        assert deleted == []
+        assert op.exists(op.join(path, "2001/2001_02/2001_02_01/nested_2001_02_01_09.tif.zip"))
+        monkeypatch.undo()
+        assert _stream_files(path) == expect
+        monkeypatch.setattr(ZipContentFetcher, "get", no_reading)
+        monkeypatch.setattr(ZipContentFetcher, "open", no_reading)
+    monkeypatch.undo()
+
+    # unbundled files are bundled, and with delete, sources are removed once verified
+    loose = str(tmpdir.join("loose"))
+    shutil.copytree(data("timestreams/nested"), loose)
+    month = str(tmpdir.join("month"))
+    with TimeStream(month, bundle_level="month", name="nested") as out:
+        copied, deleted = rebundle(TimeStream(loose), out, ncpus=2, delete=True)
+    assert copied == len(expect)
+    assert len(deleted) == len(expect)
+    assert list(find_files(loose)) == []
+    assert _stream_files(month) == expect
+
+    # and from bundles to unbundled files, deleting source bundles
+    with TimeStream(str(tmpdir.join("out")), name="nested") as out:
+        copied, deleted = rebundle(TimeStream(month), out, delete=True)
+    assert copied == len(expect)
+    assert deleted == [op.join(month, "2001", "nested_2001_02.tif.zip")]
+    assert _stream_files(str(tmpdir.join("out"))) == expect
+
+
+def test_rebundle_keeps_partial_sources(data, tmpdir):
+    src = str(tmpdir.join("in"))
+    shutil.copytree(data("timestreams/zipball-day"), src)
+    tfilter = TimeFilter(starttime=dt.time(10), endtime=dt.time(23))
+    with TimeStream(str(tmpdir.join("out")), bundle_level="hour", name="nested") as out:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            copied, deleted = rebundle(TimeStream(src, timefilter=tfilter), out, delete=True)
+    assert copied == 8
+    assert deleted == []
+    assert len([w for w in caught if "not deleting" in str(w.message)]) == 2
+    assert len(_stream_files(src)) == 10
+
+    with pytest.raises(ValueError):
+        rebundle(TimeStream(src), TimeStream(src, bundle_level="hour"))
@@ -1,5 +1,9 @@
-from pyts2.time import TSInstant, TimeFilter, parse_partial_date
+from pyts2.time import TSInstant, TimeFilter, parse_partial_date, extract_partial_date
+from pyts2.time import parse_date, parse_ts_filename, parse_ts_filenames, DaylightFilter
 import datetime as dt
+import numpy as np
+import pickle
+import random
 
 from .utils import *
 
@@ -23,6 +27,31 @@ def test_tsinstant_cmp():
         assert bigger <= bigger
 
 
+def test_tsinstant_keys():
+    a = TSInstant("2019_12_31_23_59_59", 1, None)
+    assert not hasattr(a, "__dict__")
+    assert a.ticks == TSInstant(dt.datetime(2019, 12, 31, 23, 59, 59), 1).ticks
+    assert str(a) == "2019_12_31_23_59_59_01"
+    assert a.sortkey == (a.ticks, "")
+
+    # equal instants hash equal, and differ by index
+    b = TSInstant("2019_12_31_23_59_59", 1, "x")
+    assert len({a, TSInstant("2019_12_31_23_59_59", 1, None), b}) == 2
+    assert a != b and not a < b and not b < a and a <= b and a >= b
+    assert a != "2019_12_31_23_59_59_01"
+    assert TSInstant("1969_12_31_23_59_59", 5) < TSInstant("1970_01_01_00_00_00", 0)
+    assert pickle.loads(pickle.dumps(b)) == b
+
+    # sorting by sortkey agrees with sorting by datetime, subsecond and index
+    random.seed(42)
+    instants = [TSInstant(dt.datetime(2001, 1, 1) + dt.timedelta(seconds=random.randrange(100)),
+                          random.randrange(3), random.choice([None, "1", "2"]))
+                for _ in range(1000)]
+    expect = sorted(instants, key=lambda i: (i.datetime, i.subsecond, i.index or ""))
+    assert sorted(instants, key=lambda i: i.sortkey) == expect
+    assert [i.ticks for i in sorted(instants)] == [i.ticks for i in expect]
+
+
 def test_timefilter():
     dtnow = dt.datetime.now()
     dnow = dtnow.date()
@@ -75,6 +104,80 @@ def test_timefilter():
     assert not filt.partial_within("2019_11_29_17_00_01")
 
 
+def test_timefilter_intervals():
+    schedule = TimeFilter(dates=[(dt.date(2019, 3, 1), dt.date(2019, 3, 10)),
+                                 (dt.date(2019, 3, 5), dt.date(2019, 3, 12)),
+                                 (dt.date(2019, 6, 1), None)],
+                          times=[(dt.time(6), dt.time(8)), (dt.time(12), dt.time(13, 30))])
+    # overlapping date intervals are merged
+    assert list(schedule.days[0]) == [17956, 18048]
+    assert schedule(dt.datetime(2019, 3, 11, 7, 30))
+    assert schedule(dt.datetime(2030, 1, 1, 13, 30))
+    assert not schedule(dt.datetime(2019, 3, 11, 9, 0))
+    assert not schedule(dt.datetime(2019, 3, 13, 7, 0))
+    assert schedule.partial_within("2019_03")
+    assert not schedule.partial_within("2019_04")
+    assert schedule.partial_within("2019_03_12_13")
+    assert not schedule.partial_within("2019_03_12_14")
+    assert not schedule.partial_within("2019_03_12_13_31")
+    with pytest.raises(ValueError):
+        TimeFilter(times=[(dt.time(8), dt.time(6))])
+
+    # the vectorised mask agrees with testing each time
+    rng = np.random.default_rng(42)
+    times = np.datetime64("2019-01-01") + rng.integers(0, 365 * 86400, 10000).astype("m8[s]")
+    for filt in [schedule, TimeFilter(),
+                 TimeFilter(dt.date(2019, 2, 2), dt.date(2019, 11, 29), dt.time(8, 2, 4), dt.time(17))]:
+        mask = filt.mask(times)
+        assert mask.dtype == bool
+        assert list(mask) == [filt(t) for t in times.astype(dt.datetime)]
+        micros = times.astype("M8[us]").astype(np.int64)
+        assert (filt.mask(micros) == mask).all()
+    assert not schedule.mask(np.array(["NaT"], dtype="M8[s]"))[0]
+
+
+def test_daylight_filter():
+    # Canberra: sunrise 07:11 and sunset 16:58 at the winter solstice, 05:45 and 20:17 in summer
+    canberra = DaylightFilter(-35.28, 149.13, timezone="Australia/Sydney")
+    assert not canberra(dt.datetime(2019, 6, 21, 7, 5))
+    assert canberra(dt.datetime(2019, 6, 21, 7, 15))
+    assert canberra(dt.datetime(2019, 6, 21, 16, 55))
+    assert not canberra(dt.datetime(2019, 6, 21, 17, 5))
+    assert canberra(dt.datetime(2019, 12, 21, 5, 50))
+    assert not canberra(dt.datetime(2019, 12, 21, 20, 25))
+    twilight = DaylightFilter(-35.28, 149.13, timezone=10, margin=30)
+    assert twilight(dt.datetime(2019, 6, 21, 6, 45))
+    assert not twilight(dt.datetime(2019, 6, 21, 6, 35))
+    # in UTC, the Canberra day spans midnight
+    utc = DaylightFilter(-35.28, 149.13)
+    assert utc(dt.datetime(2019, 12, 31, 23, 30)) and utc(dt.datetime(2020, 1, 1, 2, 0))
+    assert not utc(dt.datetime(2020, 1, 1, 12, 0))
+
+    # polar night and midnight sun
+    arctic = DaylightFilter(80, 15)
+    assert not arctic(dt.datetime(2019, 12, 21, 11, 0))
+    assert arctic(dt.datetime(2019, 6, 21, 0, 0))
+
+    # partial dates are within if they contain any daylight
+    assert canberra.partial_within("2019_06_21")
+    assert canberra.partial_within("2019_06_21_07")
+    assert not canberra.partial_within("2019_06_21_03")
+    assert not canberra.partial_within("2019_06_21_07_05")
+    assert not arctic.partial_within("2019_12")
+    assert arctic.partial_within("2019")
+    # and other filter arguments also apply
+    late = DaylightFilter(-35.28, 149.13, timezone=10, starttime=dt.time(12))
+    assert not late(dt.datetime(2019, 6, 21, 11, 0))
+    assert late(dt.datetime(2019, 6, 21, 13, 0))
+
+    rng = np.random.default_rng(1)
+    times = np.datetime64("2019-01-01") + rng.integers(0, 2 * 365 * 86400, 5000).astype("m8[s]")
+    for filt in [canberra, utc, arctic, late]:
+        mask = filt.mask(times)
+        assert list(mask) == [filt(t) for t in times.astype(dt.datetime)]
+        assert 0 < mask.sum() < len(times)
+
+
 def test_parsepartial():
     dmin = dt.date.min
     dmax = dt.date.max
@@ -122,3 +225,88 @@ def test_parsepartial():
            (dmax.replace(2019, 12, 31), tmax.replace(23, 59, 00))
     assert parse_partial_date("blahname_2019_12_31_23_59_00_blahsubsec.blah", max=True) == \
            (dmax.replace(2019, 12, 31), tmax.replace(23, 59, 00))
+
+
+def test_extract_partial_date():
+    assert extract_partial_date("2019") == "2019"
+    assert extract_partial_date("2019_12_31_23") == "2019_12_31_23"
+    assert extract_partial_date("some/dir/2019_12_31") == "2019_12_31"
+    assert extract_partial_date("stream_2019_12.jpg.zip") == "2019_12"
+    assert extract_partial_date("stream~2_2019_12_31.tar") == "2019_12_31"
+    assert extract_partial_date("camera1") is None
+    assert extract_partial_date("cam1234x") is None
+    assert extract_partial_date("2019_12_31_23_59_59_00.jpg") is None
+    # only whole names laid out as a timestream's are dated
+    assert extract_partial_date("cam_1234") is None
+    assert extract_partial_date("pos_0012") is None
+    assert extract_partial_date("2019_12_31_23_59") is None
+    assert extract_partial_date("stream_2019_12.jpg.zip.bak") is None
+    assert extract_partial_date("stream_2019_12.jpg.zip", parent="2019") == "2019_12"
+    assert extract_partial_date("2019_12", parent="2019") == "2019_12"
+    assert extract_partial_date("pos_0012.zip", parent="2019") is None
+    assert extract_partial_date("2018_12", parent="2019") is None
+
+
+def test_timefilter_name_within():
+    filt = TimeFilter(dt.date(2019, 2, 2), dt.date(2019, 11, 29),
+                      dt.time(8, 2, 4, 0), dt.time(17, 0, 0, 0))
+    assert filt.name_within("2019")
+    assert not filt.name_within("2018")
+    assert filt.name_within("2019_11_29")
+    assert not filt.name_within("2019_11_30")
+    assert filt.name_within("2019_11_29_08")
+    assert not filt.name_within("2019_11_29_07")
+    assert not filt.name_within("2019_11_29_18")
+    assert filt.name_within("stream_2019_02.tif.zip")
+    assert not filt.name_within("stream_2019_01.tif.zip")
+    assert not filt.name_within("stream_2019_11_29_07.tif.zip")
+    assert filt.name_within("stream_2019_11_29_08_02_04_00.jpg")
+    assert not filt.name_within("stream_2019_11_29_08_02_03_00_01.jpg")
+    # names without dates can't be excluded
+    assert filt.name_within("camera1")
+    assert filt.name_within("not-a-timestream.jpg")
+    # nor can names whose digits aren't a valid date
+    assert filt.name_within("cam_0000")
+    assert filt.name_within("cam_1234")
+    assert filt.name_within("site_9999")
+    assert filt.name_within("pos_0012.zip", parent="2019")
+    assert not filt.name_within("stream_2019_01.tif.zip", parent="2019")
+    assert filt.name_within("run_2019_13")
+    assert filt.name_within("stream_2019_02_30_08_02_04_00.jpg")
+
+
+def test_parse_ts_filename():
+    testcases = [
+        ("2019_12_31_23_59_01_00.jpg", dt.datetime(2019, 12, 31, 23, 59, 1), 0, None),
+        ("/x/cam_2019_12_31_23_59_01_05.tif", dt.datetime(2019, 12, 31, 23, 59, 1), 5, None),
+        ("gvlike_2001_02_01_09_14_15_00_05.tif", dt.datetime(2001, 2, 1, 9, 14, 15), 0, "05"),
+        ("2001_02_01_09_14_15_00_left_01.cr2", dt.datetime(2001, 2, 1, 9, 14, 15), 0, "left_01"),
+        ("2001_02_01_09_14_15.png", dt.datetime(2001, 2, 1, 9, 14, 15), 0, None),
+    ]
+    for name, datetime, subsec, index in testcases:
+        instant = parse_ts_filename(name)
+        assert (instant.datetime, instant.subsecond, instant.index) == (datetime, subsec, index)
+        assert TSInstant.from_path(name) == instant
+    assert parse_ts_filename("not-a-timestream.jpg") is None
+    with pytest.raises(ValueError):
+        parse_ts_filename("2019_02_31_23_59_01_00.jpg")
+    with pytest.raises(ValueError):
+        TSInstant.from_path("not-a-timestream.jpg")
+
+    assert parse_date("2019_12_31_23_59_01") == dt.datetime(2019, 12, 31, 23, 59, 1)
+    assert parse_date("2019-12-31T23:59:01") == dt.datetime(2019, 12, 31, 23, 59, 1)
+    with pytest.raises(ValueError):
+        parse_date("2019_13_31_23_59_01")
+
+    names = [name for name, *_ in testcases]
+    names += ["not-a-timestream.jpg", "2019_02_29_00_00_00_00.jpg", "2020_02_29_00_00_00_00.jpg"]
+    times, subsecs, indices = parse_ts_filenames(names)
+    assert times.dtype == np.dtype("M8[s]")
+    for i, (name, datetime, subsec, index) in enumerate(testcases):
+        assert times[i] == np.datetime64(datetime)
+        assert subsecs[i] == subsec
+        assert indices[i] == index
+    assert np.isnat(times[-3]) and np.isnat(times[-2])
+    assert times[-1] == np.datetime64("2020-02-29T00:00:00")
+    times, subsecs, indices = parse_ts_filenames([])
+    assert len(times) == len(subsecs) == len(indices) == 0
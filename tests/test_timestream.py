@@ -1,11 +1,29 @@
-from pyts2.timestream import TimeStream
+from pyts2.timestream import TimeStream, TimestreamFile, TimeStreamWriter, FileContentFetcher, ZipContentFetcher, TarContentFetcher, prefetch_content
+from pyts2.index import TimeStreamIndex
 from pyts2.time import *
-from pyts2.utils import find_files
+from pyts2.utils import copy_file, find_files, serial_walk, parallel_walk
+
+import pyts2.timestream
 
 from .utils import *
 from .data import *
 
+import asyncio
 import datetime as dt
+import errno
+import gc
+import hashlib
+import io
+import itertools
+import os
+import pickle
+import shutil
+import sys
+import time
+import warnings
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
 def test_read(data):
     timestreams = [
@@ -25,14 +43,31 @@ def test_read(data):
     for timestream in timestreams:
         stream = TimeStream(timestream)
         for i, file in enumerate(stream):
-            assert stream.sorted == ('tar' not in timestream)
+            assert stream.sorted
             assert isinstance(file.instant, TSInstant)
-            if stream.sorted:
-                assert file.instant == expect_insts[i]
+            assert file.instant == expect_insts[i]
 
         assert list(sorted(stream.instants.keys())) == expect_insts
 
 
+def test_parallel_walker(data):
+    def walk(walker, top):
+        result = []
+        for root, dirs, files in walker(top):
+            dirs.sort()
+            result.append((root, list(dirs), sorted(files)))
+        return result
+    assert walk(parallel_walk, data("timestreams")) == walk(serial_walk, data("timestreams"))
+    assert list(parallel_walk(data("timestreams/flat.zip"))) == []
+
+    for timestream in ["flat", "nested", "tarball-day", "zipball-day", "gvlike"]:
+        serial = TimeStream(data(f"timestreams/{timestream}"), index="off")
+        parallel = TimeStream(data(f"timestreams/{timestream}"), index="off", walker="parallel")
+        assert [f.filename for f in parallel] == [f.filename for f in serial]
+    with pytest.raises(ValueError):
+        TimeStream(data("timestreams/flat"), walker="nonsense")
+
+
 def test_gvlike(data):
     for i, file in enumerate(TimeStream(data("timestreams/gvlike"))):
         expect_inst = TSInstant(GVLIKE_TIMESTREAM["expect_datetime"],
@@ -129,6 +164,65 @@ def test_dict(data):
             stream["Not a file"]
 
 
+def test_time_lookups(data):
+    times = SMALL_TIMESTREAMS["expect_times"]
+    for timestream in ["nested", "nested.zip", "zipball-day", "tarball-day"]:
+        stream = TimeStream(data(f"timestreams/{timestream}"))
+        assert stream.at(TSInstant(times[3])).instant == TSInstant(times[3])
+        assert stream.at(times[3]).instant == TSInstant(times[3])
+        assert stream.at("2001_02_01_12_14_15").instant == TSInstant(times[3])
+        with pytest.raises(KeyError):
+            stream.at(TSInstant(times[3], subsecond=1))
+
+        noon = dt.datetime(2001, 2, 1, 12, 0, 0)
+        assert stream.nearest(noon).instant == TSInstant(times[3])
+        assert stream.nearest(dt.datetime(2001, 2, 1, 11, 30)).instant == TSInstant(times[2])
+        assert stream.nearest("2001_02_01_12_50_00").instant == TSInstant(times[4])
+        assert stream.nearest(dt.date(2001, 2, 2)).instant == TSInstant(times[5])
+        assert stream.nearest(noon, tolerance=dt.timedelta(hours=1)).instant == TSInstant(times[3])
+        with pytest.raises(KeyError):
+            stream.nearest(noon, tolerance=dt.timedelta(minutes=10))
+        assert stream.nearest(dt.datetime(1999, 1, 1)).instant == TSInstant(times[0])
+        assert stream.nearest(dt.datetime(2020, 1, 1)).instant == TSInstant(times[-1])
+
+        got = [f.instant for f in stream.between(times[1], times[3])]
+        assert got == [TSInstant(t) for t in times[1:4]]
+        got = [f.instant for f in stream.between(dt.date(2001, 2, 2))]
+        assert got == [TSInstant(t) for t in times[5:]]
+        assert [f.instant for f in stream[times[1]:times[3]]] == [TSInstant(t) for t in times[1:3]]
+        assert [f.instant for f in stream[:times[2]]] == [TSInstant(t) for t in times[:2]]
+        assert [f.instant for f in stream[times[8]:]] == [TSInstant(t) for t in times[8:]]
+        assert stream[times[3]:times[1]] == []
+        assert len(stream[times[1]:times[3]][0].content) > 0
+        with pytest.raises(ValueError):
+            stream[times[1]:times[3]:2]
+
+
+def test_time_ranges_prune(data, tmpdir, monkeypatch):
+    # without an index, ranges only walk the bundles (and directories) that could hold them
+    times = SMALL_TIMESTREAMS["expect_times"]
+    stream = TimeStream(data("timestreams/zipball-day"), index="off")
+    opened = set()  # bundles looked at
+    kind = pyts2.timestream.archive_pool.kind
+
+    def record(path):
+        if str(path).endswith(".zip"):
+            opened.add(op.basename(path))
+        return kind(path)
+    monkeypatch.setattr(pyts2.timestream.archive_pool, "kind", record)
+    assert [f.instant for f in stream.between(times[6], times[8])] == \
+        [TSInstant(t) for t in times[6:9]]
+    assert [f.instant for f in stream[times[5]:]] == [TSInstant(t) for t in times[5:]]
+    assert [f.instant for f in stream[times[6]:times[8]]] == [TSInstant(t) for t in times[6:8]]
+    assert stream[times[8]:times[6]] == []
+    assert opened == {"nested_2001_02_02.zip"}
+    assert stream._instants is None
+    # though ranges that include it do
+    assert [f.instant for f in stream.between(times[3], times[6])] == \
+        [TSInstant(t) for t in times[3:7]]
+    assert opened == {"nested_2001_02_01.zip", "nested_2001_02_02.zip"}
+
+
 def test_read_with_filter(data):
     timestreams = [
         data("timestreams/nested/"), # with trailing slash
@@ -151,6 +245,173 @@ def test_read_with_filter(data):
                 assert file.instant in expect_insts
         assert list(sorted(stream.instants.keys())) == expect_insts
 
+def test_filter_prunes_dirs(data, tmpdir):
+    import shutil
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    # a file that passes the filter, but lives in a directory that doesn't, so should never be
+    # found as the directory is pruned during the walk
+    hidden = op.join(path, "2001", "2001_02", "2001_02_02", "2001_02_02_10")
+    shutil.copy(data("timestreams/flat/2001_02_01_10_14_15_00.tif"),
+                op.join(hidden, "misplaced_2001_02_01_10_30_00_00.tif"))
+    with open(op.join(path, "README.txt"), "w") as fh:
+        fh.write("not a timestream file")
+
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1),
+                         dt.time(10, 0, 0), dt.time(12, 0, 0))
+    stream = TimeStream(path, timefilter=tfilter, index="off")
+    assert [f.instant for f in stream] == [TSInstant.from_path("2001_02_01_10_14_15"),
+                                           TSInstant.from_path("2001_02_01_11_14_15")]
+
+
+def test_filter_undated_names(data, tmpdir):
+    # names ending in a valid year, but not laid out as a timestream's, aren't pruned
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    extra = []
+    for i, subdir in enumerate([op.join("2001", "pos_0012"), "cam_9999", "site_2000"]):
+        os.makedirs(op.join(path, subdir))
+        name = f"other_2001_02_01_10_4{i}_00_00.tif"
+        shutil.copy(data("timestreams/flat/2001_02_01_10_14_15_00.tif"), op.join(path, subdir, name))
+        extra.append(TSInstant.from_path(name))
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1))
+    expect = sorted(extra + [TSInstant(t) for t in SMALL_TIMESTREAMS["expect_times"][:5]])
+    for walker in TimeStream.walkers:
+        stream = TimeStream(path, index="off", walker=walker, timefilter=tfilter)
+        assert [f.instant for f in stream] == expect
+    # as the index finds them
+    indexed = TimeStream(path, index="update", timefilter=tfilter)
+    assert [f.instant for f in indexed] == expect
+
+
+def test_mixed_bundles_sorted(data, tmpdir):
+    # a stream part way through bundling: some hours loose, some in hour or day bundles
+    path = tmpdir.join("mixed")
+    levels = ["none", "hour", "none", "hour", "none", "day", "day", "none", "hour", "day"]
+    for level, file in zip(levels, TimeStream(data("timestreams/nested"))):
+        TimeStream(path, format="tif", bundle_level=level, name="mixed").write(file)
+
+    expect_insts = [TSInstant(t, subsecond=0, index=None)
+                    for t in SMALL_TIMESTREAMS["expect_times"]]
+    for walker in TimeStream.walkers:
+        stream = TimeStream(path, index="off", walker=walker)
+        assert [f.instant for f in stream] == expect_insts
+        assert stream.sorted
+        assert [f.instant for f in stream.iter(tar_contents=False)] == expect_insts
+
+
+def test_undated_dirs(data, tmpdir):
+    # directories whose names end in digits that aren't a date, or aren't laid out as a
+    # timestream's, are just undated, so their files are merged in order with the rest
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    for name in ["cam_0000", "run_2019_13", "cam_9999"]:
+        os.makedirs(op.join(path, "2001", name))
+        shutil.copy(data("timestreams/flat/2001_02_01_10_14_15_00.tif"),
+                    op.join(path, "2001", name, "other_2001_02_01_10_30_00_00.tif"))
+    expect_insts = [TSInstant(t, subsecond=0, index=None)
+                    for t in SMALL_TIMESTREAMS["expect_times"]]
+    extra = TSInstant.from_path("2001_02_01_10_30_00")
+    # and a bundle whose date disagrees with its directory's
+    with zipfile.ZipFile(op.join(path, "2001", "other_2005_01.tif.zip"), "w") as zip:
+        zip.writestr("other_2001_02_01_10_50_00_00.tif", b"not really a tif")
+    late = TSInstant.from_path("2001_02_01_10_50_00")
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1),
+                         dt.time(10, 0, 0), dt.time(12, 0, 0))
+    for walker in TimeStream.walkers:
+        stream = TimeStream(path, index="off", walker=walker)
+        assert [f.instant for f in stream] == sorted(expect_insts + [extra] * 3 + [late])
+        stream = TimeStream(path, index="off", walker=walker, timefilter=tfilter)
+        assert [f.instant for f in stream] == [TSInstant.from_path("2001_02_01_10_14_15"),
+                                               extra, extra, extra, late,
+                                               TSInstant.from_path("2001_02_01_11_14_15")]
+
+
+def test_prefetch(data):
+    for timestream in ["flat", "nested.zip", "tarball-day"]:
+        stream = TimeStream(data(f"timestreams/{timestream}"))
+        expect = [(f.instant, f.content) for f in stream]
+        got = []
+        for file in stream.iter(prefetch=3, prefetch_bytes=1000):
+            assert file._content is not None  # already read
+            got.append((file.instant, file.content))
+        assert got == expect
+
+
+def test_prefetch_bounds():
+    class CountingFetcher(object):
+        fetched = 0
+
+        def get(self):
+            CountingFetcher.fetched += 1
+            return b"x" * 100
+
+    files = [TimestreamFile(filename=f"2001_02_01_09_14_{i:02d}_00.jpg", fetcher=CountingFetcher())
+             for i in range(20)]
+    for count, max_bytes, expect_ahead in [(4, None, 4), (10, 250, 5), (10, 50, 3)]:
+        CountingFetcher.fetched = 0
+        for i, file in enumerate(prefetch_content(files, count, max_bytes=max_bytes, threads=2)):
+            assert CountingFetcher.fetched <= i + expect_ahead
+            file.clear_content()
+        assert CountingFetcher.fetched == 20
+
+
+def test_aiter(data, tmpdir):
+    async def read(path, prefetch, index="off"):
+        files = []
+        async for file in TimeStream(path, index=index).aiter(prefetch=prefetch, batch=3):
+            if prefetch:
+                assert file._content is not None
+            files.append((file.instant, await file.aread()))
+        return files
+
+    for timestream in ["nested", "nested.zip", "tarball-day"]:
+        path = data(f"timestreams/{timestream}")
+        expect = [(f.instant, f.content) for f in TimeStream(path, index="off")]
+        assert len(expect) == 10
+        for prefetch in [0, 1, 4, 20]:
+            assert asyncio.run(read(path, prefetch)) == expect
+
+    # the on-disk index is read from a single thread
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    TimeStreamIndex(path).update()
+    expect = [(f.instant, f.content) for f in TimeStream(path, index="off")]
+    assert asyncio.run(read(path, 2, index="auto")) == expect
+
+    # stopping early closes the index on its own thread
+    async def first(prefetch):
+        async for file in TimeStream(path).aiter(prefetch=prefetch, batch=3):
+            return file.instant
+    unraisable = []
+    hook = sys.unraisablehook
+    sys.unraisablehook = unraisable.append
+    try:
+        for prefetch in [0, 2]:
+            assert asyncio.run(first(prefetch)) == expect[0][0]
+        gc.collect()
+    finally:
+        sys.unraisablehook = hook
+    assert unraisable == []
+
+    async def read_all(files):
+        return await asyncio.gather(*[file.aread() for file in files])
+    files = list(TimeStream(data("timestreams/nested.zip")))
+    assert asyncio.run(read_all(files)) == [f.content for f in files]
+
+
+def test_daylight_timefilter(data):
+    # the test streams are from 09:14 to 13:14, which is night in Canberra if times are UTC
+    for timestream in ["nested", "zipball-day"]:
+        path = data(f"timestreams/{timestream}")
+        assert len(list(TimeStream(path, timefilter=DaylightFilter(-35.28, 149.13)))) == 0
+        daytime = DaylightFilter(-35.28, 149.13, timezone="Australia/Sydney")
+        assert len(list(TimeStream(path, timefilter=daytime))) == 10
+        london = DaylightFilter(51.5, 0, endtime=dt.time(12))
+        assert [f.instant.datetime.hour for f in TimeStream(path, timefilter=london)] == \
+            [9, 10, 11] * 2
+
+
 def test_zip_overwrite(data, tmpdir):
     in_stream = TimeStream(data("timestreams/nested"))
     out_stream = TimeStream(path=tmpdir.join("test_ts.zip"), bundle_level='root', name="output")
@@ -163,3 +424,238 @@ def test_zip_overwrite(data, tmpdir):
     file._content = b"this isn't the correct content"
     with pytest.raises(RuntimeError):
         out_stream.write(file)
+
+
+def test_bundles_kept_open(data, tmpdir):
+    path = str(tmpdir.join("out"))
+    files = list(TimeStream(data("timestreams/nested")))
+    with TimeStream(path, format="tif", bundle_level="day", name="out",
+                    flush_interval=60) as out:
+        for file in files:
+            out.write(file)
+        # one appender per day, both still open
+        assert len(out._bundles) == 2
+        # reading the stream back flushes them first
+        assert [f.content for f in out] == [f.content for f in files]
+        assert len(out._bundles) == 0
+        out.write(files[0])
+        assert len(out._bundles) == 1
+    assert len(out._bundles) == 0
+    assert [f.content for f in TimeStream(path)] == [f.content for f in files]
+
+    # at most max_open_bundles are held open, and unpickled copies write straight through
+    path = str(tmpdir.join("out2"))
+    out = TimeStream(path, format="tif", bundle_level="hour", name="out", max_open_bundles=3,
+                     flush_interval=60)
+    for file in files:
+        out.write(file)
+        assert len(out._bundles) <= 3
+    copy = pickle.loads(pickle.dumps(out))
+    assert copy.flush_interval == 0
+    out.close()
+    copy.write(files[0])
+    assert len(copy._bundles) == 0
+    assert len(list(TimeStream(path))) == len(files)
+
+    # by default, each write is complete when it returns: its bundle is readable, and unlocked
+    path = str(tmpdir.join("out3"))
+    out = TimeStream(path, format="tif", bundle_level="day", name="out")
+    out.write(files[0])
+    assert len(out._bundles) == 0
+    bundle = out._bundle_archive_path(files[0])
+    with zipfile.ZipFile(bundle) as zip:
+        assert zip.testzip() is None
+    start = time.monotonic()
+    TimeStream(path, format="tif", bundle_level="day", name="out").write(files[1])
+    assert time.monotonic() - start < 5
+    out.write(files[2])
+    assert [f.content for f in TimeStream(path)] == [f.content for f in files[:3]]
+
+
+def _write_to(writer, file):
+    writer.write(file)
+    return file.filename
+
+
+def test_timestream_writer(data, tmpdir):
+    files = list(TimeStream(data("timestreams/nested")))
+    for level in ["none", "hour", "root"]:
+        path = str(tmpdir.join(level, "out"))
+        out = TimeStream(path, format="tif", bundle_level=level, name="out")
+        with TimeStreamWriter(out, writers=3) as writer:
+            assert len(writer.processes) == 3
+            for file in files[:5]:
+                writer.write(file)
+            # workers of a process pool send to the same writers
+            with ProcessPoolExecutor(2, initializer=TimeStreamWriter.share,
+                                     initargs=(TimeStreamWriter.shared(),)) as pool:
+                done = list(pool.map(_write_to, itertools.repeat(writer), files[5:]))
+            assert done == [f.filename for f in files[5:]]
+        assert writer.processes is None
+        got = list(TimeStream(path + ".tif.zip" if level == "root" else path))
+        assert [f.instant for f in got] == [f.instant for f in files]
+        assert [f.content for f in got] == [f.content for f in files]
+
+    # failed writes are reported on close
+    file = TimestreamFile.from_bytes(b"other content", files[0].filename)
+    writer = TimeStreamWriter(TimeStream(path, bundle_level="root", name="out"))
+    writer.write(file)
+    with warnings.catch_warnings(record=True) as caught:
+        writer.close()
+    assert "failed to write" in str(caught[0].message)
+    with pytest.raises(RuntimeError):
+        pickle.loads(pickle.dumps(writer))
+
+
+def test_write_many(data, tmpdir, monkeypatch):
+    files = list(TimeStream(data("timestreams/nested")))
+    made = []
+    makedirs = os.makedirs
+    monkeypatch.setattr(os, "makedirs", lambda path, **kw: (made.append(path), makedirs(path, **kw)))
+    for level in ["none", "day", "hour"]:
+        path = str(tmpdir.join(level, "out"))
+        made.clear()
+        with TimeStream(path, format="tif", bundle_level=level, name="out") as out:
+            out.write_many(reversed(files[:6]))
+            out.write_many(files[6:])
+            out.write(files[0])
+        # each directory is only made once
+        assert len(made) == len(set(made))
+        got = list(TimeStream(path))
+        assert [f.content for f in got] == [f.content for f in files]
+    with pytest.raises(TypeError):
+        out.write_many([b"not a file"])
+
+
+def test_loose_write_sync(data, tmpdir, monkeypatch):
+    files = list(TimeStream(data("timestreams/nested")))
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (synced.append(fd), fsync(fd)))
+    for sync in TimeStream.sync_modes:
+        path = str(tmpdir.join(sync))
+        synced.clear()
+        out = TimeStream(path, format="tif", name="out", sync=sync, sync_every=4,
+                         flush_interval=60)
+        for i, file in enumerate(files):
+            out.write(file)
+            written = list(TimeStream(path, index="off"))
+            if sync == "group":
+                # files only appear, all at once, when sync_every are pending
+                assert len(written) == (i + 1) // 4 * 4
+            else:
+                assert len(written) == i + 1
+        out.close()
+        # no temporary files are left behind
+        assert len(list(find_files(path))) == len(files)
+        assert [f.content for f in TimeStream(path)] == [f.content for f in files]
+        # each file and its directory is synced
+        assert len(synced) == {"none": 0, "file": 20, "group": 20}[sync]
+    with pytest.raises(ValueError):
+        TimeStream(sync="always")
+
+
+def test_copy_file(data, tmpdir, monkeypatch):
+    src = data("timestreams/flat/2001_02_01_09_14_15_00.tif")
+    with open(src, "rb") as fh:
+        content = fh.read()
+    dst = str(tmpdir.join("linked"))
+    assert copy_file(src, dst, link=True) == "link"
+    assert os.path.samefile(src, dst)
+    dst = str(tmpdir.join("copied"))
+    assert copy_file(src, dst) in ("clone", "copy_file_range", "sendfile", "copy")
+    assert not os.path.samefile(src, dst)
+    with open(dst, "rb") as fh:
+        assert fh.read() == content
+    with pytest.raises(FileExistsError):
+        copy_file(src, dst)
+
+    # falls back when the kernel can't copy
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "cross-device")
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    monkeypatch.setattr(os, "sendfile", unsupported, raising=False)
+    dst = str(tmpdir.join("fallback"))
+    assert copy_file(src, dst) in ("clone", "copy")
+    with open(dst, "rb") as fh:
+        assert fh.read() == content
+
+
+def test_write_without_reading(data, tmpdir, monkeypatch):
+    src = str(tmpdir.join("src"))
+    shutil.copytree(data("timestreams/nested"), src)
+    expect = [f.content for f in TimeStream(src)]
+    monkeypatch.setattr(FileContentFetcher, "get", lambda self: pytest.fail("content was read"))
+    for level, link in [("none", False), ("none", True), ("day", False)]:
+        path = str(tmpdir.join(f"{level}-{link}"))
+        with TimeStream(path, format="tif", bundle_level=level, name="out", link=link) as out:
+            for file in TimeStream(src):
+                out.write(file)
+        monkeypatch.undo()
+        assert [f.content for f in TimeStream(path)] == expect
+        if level == "none":
+            first = next(iter(TimeStream(path))).fetcher.path
+            assert (os.stat(first).st_nlink > 1) == link
+        monkeypatch.setattr(FileContentFetcher, "get", lambda self: pytest.fail("content was read"))
+
+
+def test_file_open(data, tmpdir, monkeypatch):
+    expect = [f.content for f in TimeStream(data("timestreams/nested"))]
+    for name in ["nested", "nested.zip", "nested.tar", "tarball-day", "zipball-day"]:
+        files = list(TimeStream(data(f"timestreams/{name}"), index="off"))
+        with monkeypatch.context() as m:
+            for fetcher in [FileContentFetcher, ZipContentFetcher, TarContentFetcher]:
+                m.setattr(fetcher, "get", lambda self: pytest.fail("content was read"))
+            for file, content in zip(files, expect):
+                with file.open() as fh:
+                    assert fh.read() == content
+                    fh.seek(2)
+                    assert fh.read(3) == content[2:5]
+                    assert fh.seek(0, io.SEEK_END) == len(content)
+                assert len(file) == len(content)
+                assert file.md5sum == hashlib.md5(content).hexdigest()
+                assert file.checksum("sha1", chunk_size=7) == hashlib.sha1(content).hexdigest()
+                out = io.BytesIO()
+                file.copy_to(out, chunk_size=7)
+                assert out.getvalue() == content
+            # streamed into bundles and loose files
+            for level in ["none", "day"]:
+                path = str(tmpdir.join(name, level))
+                with TimeStream(path, format="tif", bundle_level=level, name="out") as out:
+                    out.write_many(files)
+        for level in ["none", "day"]:
+            assert [f.content for f in TimeStream(str(tmpdir.join(name, level)))] == expect
+    file = TimestreamFile.from_bytes(b"some content", "2001_02_01_09_14_15_00.tif")
+    with file.open() as fh:
+        assert fh.read() == b"some content"
+
+
+def test_file_metadata(data, tmpdir, monkeypatch):
+    expect = [f.content for f in TimeStream(data("timestreams/nested"))]
+    for fetcher in [FileContentFetcher, ZipContentFetcher, TarContentFetcher]:
+        monkeypatch.setattr(fetcher, "get", lambda self: pytest.fail("content was read"))
+        monkeypatch.setattr(fetcher, "open", lambda self: pytest.fail("content was read"))
+    for name in ["nested", "nested.zip", "nested.tar", "tarball-day", "zipball-day"]:
+        path = str(tmpdir.join(name))
+        src = data(f"timestreams/{name}")
+        if op.isdir(src):
+            shutil.copytree(src, path)
+        else:
+            shutil.copy(src, path)
+        for index in ["off", "update"]:
+            files = list(TimeStream(path, index=index).iter(tar_contents=False))
+            assert [f.size for f in files] == [len(c) for c in expect]
+            assert [len(f) for f in files] == [len(c) for c in expect]
+            for file, content in zip(files, expect):
+                if isinstance(file.fetcher, ZipContentFetcher):
+                    assert file.crc32 == zlib.crc32(content)
+                else:
+                    assert file.crc32 is None
+                assert isinstance(file.mtime, float)
+                # roughly when the test data was made, not the epoch
+                assert file.mtime > 1e9
+    monkeypatch.undo()
+    file = TimestreamFile.from_bytes(b"some content", "2001_02_01_09_14_15_00.tif")
+    assert file.size == 12
+    assert file.crc32 == zlib.crc32(b"some content")
+    assert file.mtime is None
@@ -1,6 +1,7 @@
 import re
 import os
 import os.path as op
+import shutil
 import zipfile
 from io import BytesIO
 import json
@@ -27,8 +28,13 @@ def getdatapath(path):
     return f"tests/data/{path}"
 
 @pytest.fixture
-def data():
-    return getdatapath
+def data(tmp_path_factory):
+    """Gets paths in a fresh copy of the test data, as reading (e.g. tar bundles, which write
+    member index sidecars) can write next to it"""
+    datadir = tmp_path_factory.mktemp("data")
+    shutil.copytree(getdatapath(""), datadir, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns("largedata", ".*.tarindex"))
+    return lambda path: f"{datadir}/{path}"
 
 
 @pytest.fixture